@@ -0,0 +1 @@
+"""Benchmarks of LAtool, runnable with asv or ``python -m benchmarks.run``"""
@@ -0,0 +1,114 @@
+"""Benchmarks of the readers and writers in :mod:`latool.io`"""
+
+import os
+import tempfile
+
+from latool.io import (
+    convert_pgen,
+    read_msp_ts,
+    read_rfmix_fb,
+    read_rfmix_msp,
+    write_pgen,
+    write_Q,
+    write_rfmix_fb,
+)
+
+from .common import PARAM_NAMES, PARAMS, inputs, open_dataset, tree_sequence
+
+
+class ReadRFMIX:
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        self.paths = inputs(n_sample, n_marker, n_ancestry)
+
+    def time_read_rfmix_msp(self, *args):
+        read_rfmix_msp(self.paths["msp"])
+
+    def peakmem_read_rfmix_msp(self, *args):
+        read_rfmix_msp(self.paths["msp"])
+
+    def time_read_rfmix_fb(self, *args):
+        read_rfmix_fb(self.paths["fb"])
+
+    def peakmem_read_rfmix_fb(self, *args):
+        read_rfmix_fb(self.paths["fb"])
+
+
+class ReadTreeSequence:
+    params = [[50, 200], [1e7, 5e7], [2, 3]]
+    param_names = ["n_sample", "sequence_length", "n_ancestry"]
+
+    def setup(self, n_sample, sequence_length, n_ancestry):
+        self.path, self.ancpop = tree_sequence(n_sample, sequence_length, n_ancestry)
+
+    def time_read_msp_ts(self, *args):
+        read_msp_ts(self.path, "ADMIX", self.ancpop)
+
+    def peakmem_read_msp_ts(self, *args):
+        read_msp_ts(self.path, "ADMIX", self.ancpop)
+
+
+class ConvertPgen:
+    """RFMIX to pgen, read then written versus pipelined"""
+
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        self.paths = inputs(n_sample, n_marker, n_ancestry)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.out = os.path.join(self.tmpdir.name, "out")
+
+    def teardown(self, *args):
+        self.tmpdir.cleanup()
+
+    def time_sequential(self, *args):
+        write_pgen(self.out, read_rfmix_fb(self.paths["fb"]), "POP0", chunk_size=200)
+
+    def peakmem_sequential(self, *args):
+        write_pgen(self.out, read_rfmix_fb(self.paths["fb"]), "POP0", chunk_size=200)
+
+    def time_pipelined(self, *args):
+        convert_pgen(self.paths["fb"], self.out, "POP0", chunk_size=200, n_workers=2)
+
+    def peakmem_pipelined(self, *args):
+        convert_pgen(self.paths["fb"], self.out, "POP0", chunk_size=200, n_workers=2)
+
+
+class Write:
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        self.ds = open_dataset(n_sample, n_marker, n_ancestry)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.out = os.path.join(self.tmpdir.name, "out")
+
+    def teardown(self, *args):
+        self.tmpdir.cleanup()
+
+    def time_write_pgen(self, *args):
+        write_pgen(self.out, self.ds, "POP0")
+
+    def peakmem_write_pgen(self, *args):
+        write_pgen(self.out, self.ds, "POP0")
+
+    def time_write_rfmix_fb(self, *args):
+        write_rfmix_fb(self.ds, self.out + ".fb.tsv")
+
+    def peakmem_write_rfmix_fb(self, *args):
+        write_rfmix_fb(self.ds, self.out + ".fb.tsv")
+
+    def time_write_Q(self, *args):
+        write_Q(self.ds, self.out + ".Q")
+
+    def peakmem_write_Q(self, *args):
+        write_Q(self.ds, self.out + ".Q")
+
+    def time_to_zarr(self, *args):
+        self.ds.to_zarr(self.out + ".zarr", mode="w")
+
+    def peakmem_to_zarr(self, *args):
+        self.ds.to_zarr(self.out + ".zarr", mode="w")
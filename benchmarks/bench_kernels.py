@@ -0,0 +1,63 @@
+"""Benchmarks of the compiled kernels of :mod:`latool._kernels` against the
+NumPy expressions they replace"""
+
+import numpy as np
+
+from latool import _kernels
+
+from .common import PARAM_NAMES, PARAMS
+from .synthetic import simulate_codes
+
+
+class Kernels:
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        self.codes = simulate_codes(n_marker, n_sample, n_ancestry)
+        self.n_ancestry = n_ancestry
+        self.locanc = np.eye(n_ancestry, dtype=np.uint8)[self.codes]
+        # compile outside of the timings
+        _kernels.one_hot(self.codes[:1], n_ancestry)
+        _kernels.code_dosage(self.codes[:1], 0)
+        _kernels.ploidy_sum(self.locanc[:1], 0)
+        _kernels.adjacent_equal(self.locanc[:2])
+        _kernels.marker_sum(self.locanc[:1])
+
+    def time_one_hot(self, *args):
+        _kernels.one_hot(self.codes, self.n_ancestry)
+
+    def time_one_hot_numpy(self, *args):
+        np.eye(self.n_ancestry, dtype=np.uint8)[self.codes]
+
+    def time_code_dosage(self, *args):
+        _kernels.code_dosage(self.codes, 0)
+
+    def time_code_dosage_numpy(self, *args):
+        np.eye(self.n_ancestry, dtype=np.uint8)[self.codes][..., 0].sum(axis=2)
+
+    def time_ploidy_sum(self, *args):
+        _kernels.ploidy_sum(self.locanc, 0)
+
+    def time_ploidy_sum_numpy(self, *args):
+        self.locanc[..., 0].sum(axis=2)
+
+    def time_adjacent_equal(self, *args):
+        _kernels.adjacent_equal(self.locanc)
+
+    def time_adjacent_equal_numpy(self, *args):
+        rows = self.locanc.reshape(self.locanc.shape[0], -1)
+        rows = rows.view(np.dtype((np.void, rows.shape[1])))
+        rows[1:, 0] == rows[:-1, 0]
+
+    def time_marker_sum(self, *args):
+        _kernels.marker_sum(self.locanc)
+
+    def time_marker_sum_numpy(self, *args):
+        self.locanc.sum(axis=(0, 2), dtype=np.float64)
+
+    def peakmem_code_dosage(self, *args):
+        _kernels.code_dosage(self.codes, 0)
+
+    def peakmem_code_dosage_numpy(self, *args):
+        np.eye(self.n_ancestry, dtype=np.uint8)[self.codes][..., 0].sum(axis=2)
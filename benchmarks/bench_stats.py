@@ -0,0 +1,37 @@
+"""Benchmarks of the LAD functions in :mod:`latool.stats`"""
+
+from latool.stats import LAD_eigvals, effective_tests, empirical_LAD, theoretical_LAD
+
+from .common import PARAM_NAMES, PARAMS, open_dataset
+
+
+class LAD:
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        ds = open_dataset(n_sample, n_marker, n_ancestry)
+        self.dosage = ds["locanc"].sel(ancestry="POP0").sum(dim="ploidy")
+        self.genetic_position = ds["genetic_position"]
+        self.eigvals = LAD_eigvals(self.dosage, k=50, seed=0)
+
+    def time_empirical_LAD(self, *args):
+        empirical_LAD(self.dosage)
+
+    def peakmem_empirical_LAD(self, *args):
+        empirical_LAD(self.dosage)
+
+    def time_theoretical_LAD(self, *args):
+        theoretical_LAD(genetic_map=self.genetic_position)
+
+    def peakmem_theoretical_LAD(self, *args):
+        theoretical_LAD(genetic_map=self.genetic_position)
+
+    def time_LAD_eigvals(self, *args):
+        LAD_eigvals(self.dosage, k=50, seed=0)
+
+    def peakmem_LAD_eigvals(self, *args):
+        LAD_eigvals(self.dosage, k=50, seed=0)
+
+    def time_effective_tests(self, *args):
+        effective_tests(self.eigvals)
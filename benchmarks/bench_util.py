@@ -0,0 +1,57 @@
+"""Benchmarks of :mod:`latool.util` and :mod:`latool.annotate`"""
+
+import numpy as np
+
+from latool.annotate import GeneticMap, genetic_distance
+from latool.util import fill_pos, simplify
+
+from .common import PARAM_NAMES, PARAMS, inputs, open_dataset
+
+
+class Simplify:
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        self.ds = open_dataset(n_sample, n_marker, n_ancestry)
+
+    def time_simplify(self, *args):
+        simplify(self.ds).load()
+
+    def peakmem_simplify(self, *args):
+        simplify(self.ds).load()
+
+
+class FillPos:
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        self.ds = open_dataset(n_sample, n_marker, n_ancestry)
+        left = self.ds["left_position"].values
+        self.positions = np.linspace(left[0], left[-1], 2 * n_marker).astype(int)
+
+    def time_fill_pos(self, *args):
+        fill_pos(self.ds, self.positions).load()
+
+    def peakmem_fill_pos(self, *args):
+        fill_pos(self.ds, self.positions).load()
+
+
+class GeneticDistance:
+    params = PARAMS
+    param_names = PARAM_NAMES
+
+    def setup(self, n_sample, n_marker, n_ancestry):
+        self.ds = open_dataset(n_sample, n_marker, n_ancestry)
+        self.genetic_map = inputs(n_sample, n_marker, n_ancestry)["map"]
+        self.loaded_map = GeneticMap.from_file(self.genetic_map, cache=False)
+
+    def time_genetic_distance(self, *args):
+        genetic_distance(self.ds, self.loaded_map)
+
+    def peakmem_genetic_distance(self, *args):
+        genetic_distance(self.ds, self.loaded_map)
+
+    def time_read_genetic_map(self, *args):
+        GeneticMap.from_file(self.genetic_map, cache=False)
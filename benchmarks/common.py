@@ -0,0 +1,45 @@
+"""Shared parameters and cached synthetic inputs of the benchmarks"""
+
+import os
+import tempfile
+
+import xarray as xr
+
+from .synthetic import input_paths, simulate_ts, write_all
+
+N_SAMPLE = [100, 500]
+N_MARKER = [1000, 5000]
+N_ANCESTRY = [2, 3]
+
+PARAMS = [N_SAMPLE, N_MARKER, N_ANCESTRY]
+PARAM_NAMES = ["n_sample", "n_marker", "n_ancestry"]
+
+CACHE_DIR = os.environ.get(
+    "LATOOL_BENCH_DIR", os.path.join(tempfile.gettempdir(), "latool_bench")
+)
+
+
+def inputs(n_sample: int, n_marker: int, n_ancestry: int) -> dict:
+    """Paths to the synthetic inputs of one scale, generated on first use"""
+    directory = os.path.join(CACHE_DIR, f"{n_sample}_{n_marker}_{n_ancestry}")
+    done = os.path.join(directory, "done")
+    if not os.path.exists(done):
+        write_all(directory, n_marker, n_sample, n_ancestry)
+        open(done, "w").close()
+    return input_paths(directory)
+
+
+def open_dataset(n_sample: int, n_marker: int, n_ancestry: int) -> xr.Dataset:
+    """Synthetic dataset loaded in memory"""
+    return xr.open_zarr(inputs(n_sample, n_marker, n_ancestry)["zarr"]).load()
+
+
+def tree_sequence(n_sample: int, sequence_length: float, n_ancestry: int):
+    """Path to a simulated tree sequence and its ancestral populations"""
+    path = os.path.join(
+        CACHE_DIR, f"ts_{n_sample}_{int(sequence_length)}_{n_ancestry}.trees"
+    )
+    if not os.path.exists(path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        simulate_ts(path, n_sample, sequence_length, n_ancestry)
+    return path, [f"POP{a}" for a in range(n_ancestry)]
@@ -0,0 +1,86 @@
+"""Run the benchmarks without asv
+
+| Every ``time_*`` and ``peakmem_*`` method of the benchmark classes is run
+| for each combination of parameters. Time is the best of ``--repeat`` runs,
+| and peak memory is the largest allocation traced by ``tracemalloc`` during
+| a run, which covers numpy arrays but not memory allocated by extensions
+| such as pgenlib. Use asv for RSS measurements and comparison of commits::
+
+    python -m benchmarks.run --quick
+    python -m benchmarks.run --bench "ReadRFMIX|Simplify"
+"""
+
+import argparse
+import importlib
+import inspect
+import itertools
+import pkgutil
+import re
+import time
+import tracemalloc
+
+import benchmarks
+
+
+def _benchmark_classes():
+    for module_info in pkgutil.iter_modules(benchmarks.__path__):
+        if not module_info.name.startswith("bench_"):
+            continue
+        module = importlib.import_module(f"benchmarks.{module_info.name}")
+        for name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ == module.__name__:
+                yield f"{module_info.name}.{name}", cls
+
+
+def _run(method, values, repeat: int):
+    if method.__name__.startswith("time_"):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            method(*values)
+            best = min(best, time.perf_counter() - start)
+        return f"{best * 1e3:10.1f} ms"
+    else:
+        tracemalloc.start()
+        method(*values)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return f"{peak / 2**20:10.1f} MB"
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bench", default=".", help="regex on benchmark names")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--quick", action="store_true", help="only the smallest parameters"
+    )
+    args = parser.parse_args(args)
+    pattern = re.compile(args.bench)
+
+    for cls_name, cls in _benchmark_classes():
+        methods = [
+            name
+            for name in dir(cls)
+            if name.startswith(("time_", "peakmem_"))
+            and pattern.search(f"{cls_name}.{name}")
+        ]
+        if not methods:
+            continue
+        params = [p[:1] for p in cls.params] if args.quick else cls.params
+        for values in itertools.product(*params):
+            label = ", ".join(f"{k}={v}" for k, v in zip(cls.param_names, values))
+            bench = cls()
+            try:
+                bench.setup(*values)
+            except NotImplementedError:
+                continue
+            for name in methods:
+                result = _run(getattr(bench, name), values, args.repeat)
+                print(f"{cls_name}.{name} ({label}): {result}", flush=True)
+            if hasattr(bench, "teardown"):
+                bench.teardown(*values)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Synthetic local ancestry data at configurable scales
+
+Local ancestry of each haplotype follows a Markov switching model along the
+markers: at every marker a haplotype starts a new tract with probability
+``switch_rate``, and the ancestry of a new tract is drawn from ``proportions``.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from latool.util import _marker_slices
+
+_WRITE_CHUNK = 1000
+
+
+def simulate_codes(
+    n_marker: int,
+    n_sample: int,
+    n_ancestry: int = 2,
+    switch_rate: float = 0.01,
+    proportions=None,
+    seed: int = 0,
+) -> np.ndarray:
+    """Ancestry codes of dims (marker, sample, ploidy)"""
+    rng = np.random.default_rng(seed)
+    if proportions is None:
+        proportions = np.full(n_ancestry, 1 / n_ancestry)
+
+    codes = np.empty((n_marker, n_sample, 2), dtype=np.uint8)
+    codes[0] = rng.choice(n_ancestry, size=(n_sample, 2), p=proportions)
+    for i in range(1, n_marker):
+        switch = rng.random((n_sample, 2)) < switch_rate
+        new = rng.choice(n_ancestry, size=(n_sample, 2), p=proportions)
+        codes[i] = np.where(switch, new, codes[i - 1])
+    return codes
+
+
+def _names(n_sample: int, n_ancestry: int):
+    return [f"indiv{i}" for i in range(n_sample)], [
+        f"POP{a}" for a in range(n_ancestry)
+    ]
+
+
+def make_dataset(codes: np.ndarray, marker_spacing: int = 1000) -> xr.Dataset:
+    """Dataset with the schema of :func:`latool.io.read_rfmix_msp`"""
+    n_marker, n_sample, _ = codes.shape
+    n_ancestry = int(codes.max()) + 1
+    samples, ancestries = _names(n_sample, n_ancestry)
+    left = np.arange(n_marker, dtype=np.uint32) * marker_spacing + 1
+    right = left + marker_spacing
+
+    return xr.Dataset(
+        data_vars={
+            "locanc": (
+                ["marker", "sample", "ploidy", "ancestry"],
+                np.eye(n_ancestry, dtype=np.uint8)[codes],
+            ),
+            "left_position": ("marker", left),
+            "right_position": ("marker", right),
+            "genetic_position": ("marker", left * 1e-6),
+        },
+        coords={
+            "marker": (left + right) // 2,
+            "chrom": ("marker", np.full(n_marker, "1")),
+            "sample": samples,
+            "ploidy": np.array([0, 1], dtype=np.int8),
+            "ancestry": ancestries,
+        },
+    )
+
+
+def write_msp(path: str, codes: np.ndarray, marker_spacing: int = 1000):
+    """Write ancestry codes as RFMIX .msp.tsv"""
+    n_marker, n_sample, _ = codes.shape
+    samples, ancestries = _names(n_sample, int(codes.max()) + 1)
+    spos = np.arange(n_marker) * marker_spacing + 1
+    epos = spos + marker_spacing
+    with open(path, "w") as f:
+        popcode = "\t".join(f"{a}={i}" for i, a in enumerate(ancestries))
+        f.write(f"#Subpopulation order/codes: {popcode}\n")
+        hap_cols = "\t".join(f"{s}.{h}" for s in samples for h in range(2))
+        f.write(f"#chm\tspos\tepos\tsgpos\tegpos\tn snps\t{hap_cols}\n")
+        for s in _marker_slices(n_marker, _WRITE_CHUNK):
+            info = pd.DataFrame(
+                {
+                    "chm": 1,
+                    "spos": spos[s],
+                    "epos": epos[s],
+                    "sgpos": spos[s] * 1e-6,
+                    "egpos": epos[s] * 1e-6,
+                    "n snps": 10,
+                }
+            )
+            hap = pd.DataFrame(codes[s].reshape(s.stop - s.start, -1))
+            pd.concat([info, hap], axis=1).to_csv(
+                f, sep="\t", header=False, index=False, float_format="%.4f"
+            )
+
+
+def write_fb(path: str, codes: np.ndarray, marker_spacing: int = 1000, seed: int = 0):
+    """Write ancestry codes as RFMIX .fb.tsv posteriors with some uncertainty"""
+    rng = np.random.default_rng(seed)
+    n_marker, n_sample, _ = codes.shape
+    n_ancestry = int(codes.max()) + 1
+    samples, ancestries = _names(n_sample, n_ancestry)
+    pos = np.arange(n_marker) * marker_spacing + 1
+    with open(path, "w") as f:
+        f.write("#reference_panel_population:\t" + "\t".join(ancestries) + "\n")
+        cols = "\t".join(
+            f"{s}:::hap{h + 1}:::{a}"
+            for s in samples
+            for h in range(2)
+            for a in ancestries
+        )
+        f.write(
+            "chromosome\tphysical_position\tgenetic_position\t"
+            "genetic_marker_index\t" + cols + "\n"
+        )
+        for s in _marker_slices(n_marker, _WRITE_CHUNK):
+            prob = np.eye(n_ancestry)[codes[s]]
+            prob += rng.random(prob.shape) * 0.05
+            prob /= prob.sum(axis=-1, keepdims=True)
+            info = pd.DataFrame(
+                {
+                    "chromosome": 1,
+                    "physical_position": pos[s],
+                    "genetic_position": pos[s] * 1e-6,
+                    "genetic_marker_index": np.arange(s.start, s.stop),
+                }
+            )
+            prob = pd.DataFrame(prob.reshape(s.stop - s.start, -1))
+            pd.concat([info, prob], axis=1).to_csv(
+                f, sep="\t", header=False, index=False, float_format="%.3f"
+            )
+
+
+def write_genetic_map(path: str, n_marker: int, marker_spacing: int = 1000):
+    """Write a genetic map covering the synthetic markers at 1 cM/Mb"""
+    pos = np.arange(0, (n_marker + 1) * marker_spacing + 1, 100 * marker_spacing)
+    with open(path, "w") as f:
+        f.write("chr position COMBINED_rate(cM/Mb) Genetic_Map(cM)\n")
+        for p in pos:
+            f.write(f"1 {p} 1.0 {p * 1e-6}\n")
+
+
+def simulate_ts(
+    path: str,
+    n_sample: int,
+    sequence_length: float = 1e7,
+    n_ancestry: int = 2,
+    admixture_time: int = 10,
+    seed: int = 1,
+):
+    """Simulate an admixed population with msprime and save the tree sequence
+
+    A census is taken just before the admixture event, so that
+    :func:`latool.io.read_msp_ts` can trace the ancestry of the population
+    ``ADMIX`` back to the populations ``POP0``, ``POP1``, ... The simulation
+    stops right after the census, as older history does not affect local
+    ancestry.
+    """
+    import msprime
+
+    _, ancestries = _names(0, n_ancestry)
+    demography = msprime.Demography()
+    demography.add_population(name="ADMIX", initial_size=10_000)
+    for a in ancestries:
+        demography.add_population(name=a, initial_size=10_000)
+    demography.add_admixture(
+        time=admixture_time,
+        derived="ADMIX",
+        ancestral=ancestries,
+        proportions=[1 / n_ancestry] * n_ancestry,
+    )
+    demography.add_census(time=admixture_time + 0.5)
+
+    ts = msprime.sim_ancestry(
+        samples={"ADMIX": n_sample},
+        demography=demography,
+        sequence_length=sequence_length,
+        recombination_rate=1e-8,
+        end_time=admixture_time + 1,
+        random_seed=seed,
+    )
+    ts.dump(path)
+    return ancestries
+
+
+def input_paths(directory: str) -> dict:
+    """Paths of the inputs written by :func:`write_all`"""
+    return {
+        "msp": os.path.join(directory, "synthetic.msp.tsv"),
+        "fb": os.path.join(directory, "synthetic.fb.tsv"),
+        "map": os.path.join(directory, "synthetic.map"),
+        "zarr": os.path.join(directory, "synthetic.zarr"),
+    }
+
+
+def write_all(directory: str, n_marker: int, n_sample: int, n_ancestry: int = 2):
+    """Write .msp.tsv, .fb.tsv, genetic map and zarr inputs, return their paths"""
+    os.makedirs(directory, exist_ok=True)
+    codes = simulate_codes(n_marker, n_sample, n_ancestry)
+    paths = input_paths(directory)
+    write_msp(paths["msp"], codes)
+    write_fb(paths["fb"], codes)
+    write_genetic_map(paths["map"], n_marker)
+    make_dataset(codes).to_zarr(paths["zarr"], mode="w")
+    return paths
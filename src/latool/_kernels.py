@@ -0,0 +1,384 @@
+"""Compiled kernels for local ancestry arrays
+
+| Kernels are compiled with ``numba.njit(parallel=True, cache=True)`` on first
+| use and cached to disk next to this module, so importing latool does not
+| import numba. Loops run in parallel over markers, or over samples for
+| reductions along markers, and write into preallocated outputs without the
+| full-size temporaries of the equivalent NumPy expressions. The number of
+| threads follows ``numba.set_num_threads``.
+"""
+
+import functools
+from types import SimpleNamespace
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def _compile() -> SimpleNamespace:
+    """Compile the kernels on first use, cached on disk by numba"""
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def one_hot(codes, out):
+        M, N, P = codes.shape
+        for m in prange(M):
+            for n in range(N):
+                for p in range(P):
+                    out[m, n, p, :] = 0
+                    out[m, n, p, codes[m, n, p]] = 1
+
+    @njit(parallel=True, cache=True)
+    def code_dosage(codes, code, out):
+        M, N, P = codes.shape
+        for m in prange(M):
+            for n in range(N):
+                total = 0
+                for p in range(P):
+                    total += codes[m, n, p] == code
+                out[m, n] = total
+
+    @njit(parallel=True, cache=True)
+    def ploidy_sum(locanc, a, out):
+        M, N, P, _ = locanc.shape
+        for m in prange(M):
+            for n in range(N):
+                total = locanc[m, n, 0, a]
+                for p in range(1, P):
+                    total += locanc[m, n, p, a]
+                out[m, n] = total
+
+    @njit(parallel=True, cache=True)
+    def adjacent_equal(rows, out):
+        M, K = rows.shape
+        for m in prange(1, M):
+            equal = True
+            for k in range(K):
+                if rows[m, k] != rows[m - 1, k]:
+                    equal = False
+                    break
+            out[m] = equal
+
+    @njit(parallel=True, cache=True)
+    def marker_sum(locanc, weight, out):
+        M, N, P, A = locanc.shape
+        for n in prange(N):
+            for m in range(M):
+                for p in range(P):
+                    for a in range(A):
+                        out[n, a] += weight[m] * locanc[m, n, p, a]
+
+    @njit(cache=True)
+    def _field_end(buf, i, e, sep):
+        while i < e and buf[i] != sep:
+            i += 1
+        return i
+
+    @njit(cache=True)
+    def _token_equal(buf, s, e, key, n):
+        if e - s != n:
+            return False
+        for i in range(n):
+            if buf[s + i] != key[i]:
+                return False
+        return True
+
+    @njit(cache=True)
+    def _parse_uint(buf, s, e):
+        if s >= e:
+            return -1
+        value = 0
+        for i in range(s, e):
+            c = buf[i]
+            if c < 48 or c > 57:
+                return -1
+            value = value * 10 + c - 48
+        return value
+
+    @njit(cache=True)
+    def _parse_float(buf, s, e):
+        sign, value, scale, i = 1.0, 0.0, 1.0, s
+        if i < e and (buf[i] == 45 or buf[i] == 43):
+            sign = -1.0 if buf[i] == 45 else 1.0
+            i += 1
+        n_digit = 0
+        while i < e and 48 <= buf[i] <= 57:
+            value = value * 10 + buf[i] - 48
+            i += 1
+            n_digit += 1
+        if i < e and buf[i] == 46:
+            i += 1
+            while i < e and 48 <= buf[i] <= 57:
+                scale /= 10
+                value += (buf[i] - 48) * scale
+                i += 1
+                n_digit += 1
+        if i < e and (buf[i] == 101 or buf[i] == 69):
+            i += 1
+            negative = i < e and buf[i] == 45
+            if i < e and (buf[i] == 45 or buf[i] == 43):
+                i += 1
+            exponent = _parse_uint(buf, i, e)
+            if exponent < 0:
+                return np.nan
+            value *= 10.0 ** (-exponent if negative else exponent)
+            i = e
+        if n_digit == 0 or i != e:
+            return np.nan
+        return sign * value
+
+    @njit(parallel=True, cache=True)
+    def la_vcf(
+        buf,
+        starts,
+        ends,
+        out_col,
+        keys,
+        key_len,
+        region_chrom,
+        region_start,
+        region_end,
+        pos,
+        chrom_new,
+        status,
+        codes,
+        probs,
+    ):
+        with_prob = probs.shape[0] > 0
+        A = probs.shape[3]
+        for m in prange(starts.shape[0]):
+            s, e = starts[m], ends[m]
+            chrom_end = _field_end(buf, s, e, 9)
+            if m > 0:
+                prev_end = _field_end(buf, starts[m - 1], ends[m - 1], 9)
+                chrom_new[m] = not _token_equal(
+                    buf,
+                    s,
+                    chrom_end,
+                    buf[starts[m - 1] : prev_end],
+                    prev_end - starts[m - 1],
+                )
+            pos_end = _field_end(buf, chrom_end + 1, e, 9)
+            pos[m] = _parse_uint(buf, chrom_end + 1, pos_end)
+            if pos[m] < 0:
+                status[m] = 2
+                continue
+            if region_chrom.shape[0] > 0 and (
+                not _token_equal(buf, s, chrom_end, region_chrom, region_chrom.shape[0])
+                or pos[m] < region_start
+                or pos[m] > region_end
+            ):
+                status[m] = 1
+                continue
+
+            # ID, REF, ALT, QUAL, FILTER and INFO, then FORMAT
+            i = pos_end
+            for _ in range(6):
+                i = _field_end(buf, i + 1, e, 9)
+            format_end = _field_end(buf, i + 1, e, 9)
+            index = np.full(4, -1)
+            u, t = 0, i + 1
+            while t <= format_end:
+                t_end = _field_end(buf, t, format_end, 58)
+                for k in range(4):
+                    if _token_equal(buf, t, t_end, keys[k], key_len[k]):
+                        index[k] = u
+                t, u = t_end + 1, u + 1
+            if (
+                index[0] < 0
+                or index[1] < 0
+                or (with_prob and (index[2] < 0 or index[3] < 0))
+            ):
+                status[m] = 2
+                continue
+
+            col, i = 0, format_end
+            while i < e:
+                field_end = _field_end(buf, i + 1, e, 9)
+                n = out_col[col] if col < out_col.shape[0] else -1
+                if n >= 0:
+                    u, t = 0, i + 1
+                    while t <= field_end:
+                        t_end = _field_end(buf, t, field_end, 58)
+                        if u == index[0] or u == index[1]:
+                            code = _parse_uint(buf, t, t_end)
+                            if code < 0 or code > 255:
+                                status[m] = 2
+                            codes[m, n, 0 if u == index[0] else 1] = code
+                        elif with_prob and (u == index[2] or u == index[3]):
+                            p, a = 0 if u == index[2] else 1, 0
+                            while t <= t_end and a < A:
+                                v_end = _field_end(buf, t, t_end, 44)
+                                probs[m, n, p, a] = _parse_float(buf, t, v_end)
+                                if np.isnan(probs[m, n, p, a]):
+                                    status[m] = 2
+                                t, a = v_end + 1, a + 1
+                            if a != A or t <= t_end:
+                                status[m] = 2
+                            t = t_end
+                        t, u = t_end + 1, u + 1
+                i, col = field_end, col + 1
+            if col != out_col.shape[0]:
+                status[m] = 2
+
+    return SimpleNamespace(
+        la_vcf=la_vcf,
+        one_hot=one_hot,
+        code_dosage=code_dosage,
+        ploidy_sum=ploidy_sum,
+        adjacent_equal=adjacent_equal,
+        marker_sum=marker_sum,
+    )
+
+
+def one_hot(codes: np.ndarray, n_ancestry: int) -> np.ndarray:
+    """One-hot encode ancestry codes of dims (marker, sample, ploidy)
+
+    Returns:
+        uint8 array of dims (marker, sample, ploidy, ancestry)
+
+    """
+    codes = np.ascontiguousarray(codes)
+    if codes.size and (codes.min() < 0 or codes.max() >= n_ancestry):
+        raise ValueError(f"Ancestry codes must be in [0, {n_ancestry})")
+    out = np.empty(codes.shape + (n_ancestry,), dtype=np.uint8)
+    _compile().one_hot(codes, out)
+    return out
+
+
+def code_dosage(codes: np.ndarray, code: int) -> np.ndarray:
+    """Number of haplotypes of each sample carrying ``code``, i.e. the one-hot
+    encoding of ``codes`` summed over ploidy, without forming it
+
+    Returns:
+        uint8 array of dims (marker, sample)
+
+    """
+    codes = np.ascontiguousarray(codes)
+    out = np.empty(codes.shape[:2], dtype=np.uint8)
+    _compile().code_dosage(codes, codes.dtype.type(code), out)
+    return out
+
+
+def ploidy_sum(locanc: np.ndarray, ancestry_index: int) -> np.ndarray:
+    """Dosage of one ancestry from ``locanc`` of dims (marker, sample, ploidy,
+    ancestry), read in place
+
+    Returns:
+        Array of dims (marker, sample), of the dtype of ``locanc`` for floats
+        and uint8 for hard calls
+
+    """
+    dtype = locanc.dtype if locanc.dtype.kind == "f" else np.uint8
+    out = np.empty(locanc.shape[:2], dtype=dtype)
+    _compile().ploidy_sum(locanc, ancestry_index, out)
+    return out
+
+
+def adjacent_equal(rows: np.ndarray) -> np.ndarray:
+    """Whether each row equals the previous row, stopping at the first
+    differing byte
+
+    Args:
+        rows: array with one marker per row, flattened to bytes
+
+    Returns:
+        bool array, False for the first row
+
+    """
+    rows = np.ascontiguousarray(rows).reshape(rows.shape[0], -1)
+    rows = rows.view(np.uint8).reshape(rows.shape[0], -1)
+    out = np.zeros(rows.shape[0], dtype=np.bool_)
+    _compile().adjacent_equal(rows, out)
+    return out
+
+
+def parse_la_vcf(
+    block: np.ndarray,
+    out_col: np.ndarray,
+    n_ancestry: int,
+    posterior: bool,
+    region: tuple = None,
+) -> SimpleNamespace:
+    """Parse complete VCF data lines with FLARE-style local ancestry
+
+    | Lines are parsed in parallel straight from the bytes. Ancestry codes
+    | are read from the ``AN1`` and ``AN2`` FORMAT fields, and posteriors
+    | from ``ANP1`` and ``ANP2``. Only the sample columns selected by
+    | ``out_col`` are parsed, and only the first two fields of lines outside
+    | ``region``.
+
+    Args:
+        block: uint8 array of lines, each ending with a newline
+        out_col: output index of every sample column, or -1 to skip it
+        n_ancestry: number of ancestries
+        posterior: parse ``ANP1`` and ``ANP2``
+        region: (chrom, start, end) with 1-based inclusive positions
+
+    Returns:
+        Namespace with ``pos``, ``chrom_new`` (whether the chromosome differs
+        from the previous line), ``status`` (0 parsed, 1 outside region, 2
+        malformed), uint8 ``codes`` of dims (line, sample, ploidy) and float32
+        ``probs`` of dims (line, sample, ploidy, ancestry) if ``posterior``
+
+    """
+    ends = np.flatnonzero(block == ord("\n"))
+    starts = np.append(0, ends[:-1] + 1)
+    # drop the carriage return of CRLF lines
+    ends = ends - (block[np.maximum(ends - 1, 0)] == ord("\r"))
+    M, N = ends.shape[0], int(np.sum(out_col >= 0))
+
+    keys = np.zeros((4, 4), dtype=np.uint8)
+    key_len = np.zeros(4, dtype=np.int64)
+    for k, key in enumerate([b"AN1", b"AN2", b"ANP1", b"ANP2"]):
+        keys[k, : len(key)] = np.frombuffer(key, dtype=np.uint8)
+        key_len[k] = len(key)
+    chrom, start, end = region if region is not None else ("", 0, 0)
+
+    out = SimpleNamespace(
+        pos=np.empty(M, dtype=np.int64),
+        chrom_new=np.zeros(M, dtype=np.bool_),
+        status=np.zeros(M, dtype=np.int8),
+        codes=np.zeros((M, N, 2), dtype=np.uint8),
+        probs=np.zeros(
+            (M, N, 2, n_ancestry) if posterior else (0, 0, 0, 1), np.float32
+        ),
+    )
+    out.chrom_new[:1] = True
+    _compile().la_vcf(
+        block,
+        starts,
+        ends,
+        np.asarray(out_col, dtype=np.int64),
+        keys,
+        key_len,
+        np.frombuffer(chrom.encode(), dtype=np.uint8),
+        start,
+        end,
+        out.pos,
+        out.chrom_new,
+        out.status,
+        out.codes,
+        out.probs,
+    )
+    out.starts = starts
+    return out
+
+
+def marker_sum(locanc: np.ndarray, weight: np.ndarray = None) -> np.ndarray:
+    """Weighted sum over markers and ploidy of ``locanc`` of dims (marker,
+    sample, ploidy, ancestry)
+
+    Args:
+        locanc: local ancestry block
+        weight: weight of each marker, one by default
+
+    Returns:
+        float64 array of dims (sample, ancestry)
+
+    """
+    if weight is None:
+        weight = np.ones(locanc.shape[0])
+    out = np.zeros((locanc.shape[1], locanc.shape[3]))
+    _compile().marker_sum(locanc, np.asarray(weight, dtype=np.float64), out)
+    return out
@@ -1,14 +1,193 @@
 """"Module for annotating Xarray with external annotations"""
 
+import functools
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict, Tuple, Union
+
 import numpy as np
 import pandas as pd
 import xarray as xr
 
+from . import instrument
+
+_logger = logging.getLogger(__name__)
+
+
+class GeneticMap:
+    """Genetic map held as sorted position and cM arrays per chromosome
+
+    | Parse a map once with :meth:`GeneticMap.from_file`. For local files the
+    | parsed arrays are saved to a ``<genetic_map>.latool_cache`` directory next
+    | to the source and memory-mapped on later loads, as long as the
+    | modification time and size of the source are unchanged. The cache is
+    | written to a temporary directory and moved into place, so concurrent
+    | processes never read a partial cache.
+
+    Args:
+        maps: dict from chromosome name to (position, cM) arrays sorted by position
+
+    """
+
+    def __init__(self, maps: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.maps = maps
+
+    @property
+    def chroms(self):
+        return list(self.maps)
+
+    @classmethod
+    @instrument.instrumented
+    def from_file(
+        cls,
+        genetic_map: str,
+        chrom_col: int = 0,
+        pos_col: int = 1,
+        cM_col: int = 3,
+        pd_kwargs: dict = {},
+        cache: bool = True,
+    ) -> "GeneticMap":
+        """Read a genetic map
+
+        Args:
+            genetic_map: path or url to the genetic map
+            chrom_col: column number (0-based) of the chromosome in the genetic map
+            pos_col: column number (0-based) of the position in the genetic map
+            cM_col: column number (0-based) of the cM in the genetic map
+            pd_kwargs: keyword arguments to be passed to pandas.read_csv
+            cache: read and write the binary cache for local files
+
+        Returns:
+            GeneticMap
+
+        """
+        cache_dir = f"{genetic_map}.latool_cache"
+        meta = None
+        signature = _file_signature(genetic_map)
+        if cache and signature is not None:
+            meta = {
+                "mtime_ns": signature[0],
+                "size": signature[1],
+                "columns": [chrom_col, pos_col, cM_col],
+                "pd_kwargs": repr(sorted(pd_kwargs.items())),
+            }
+            maps = cls._read_cache(cache_dir, meta)
+            if maps is not None:
+                return cls(maps)
+
+        csv_kwargs = {"sep": " "}
+        csv_kwargs.update(pd_kwargs)
+        df = pd.read_csv(genetic_map, **csv_kwargs)
+        df = df.iloc[:, [chrom_col, pos_col, cM_col]]
+        df.columns = ["chrom", "pos", "cM"]
+
+        maps = {}
+        for chrom, df_chrom in df.groupby("chrom", sort=False):
+            df_chrom = df_chrom.sort_values("pos")
+            maps[str(chrom)] = (
+                df_chrom["pos"].to_numpy(dtype=np.float64),
+                df_chrom["cM"].to_numpy(dtype=np.float64),
+            )
+
+        if meta is not None:
+            cls._write_cache(cache_dir, meta, maps)
 
+        return cls(maps)
+
+    @staticmethod
+    def _read_cache(cache_dir: str, meta: dict):
+        try:
+            with open(os.path.join(cache_dir, "meta.json")) as f:
+                if json.load(f) != meta:
+                    return None
+            with open(os.path.join(cache_dir, "chroms.json")) as f:
+                chroms = json.load(f)
+            return {
+                chrom: tuple(
+                    np.load(os.path.join(cache_dir, f"{i}.npy"), mmap_mode="r")
+                )
+                for i, chrom in enumerate(chroms)
+            }
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_cache(cache_dir: str, meta: dict, maps: dict):
+        parent, name = os.path.split(os.path.abspath(cache_dir))
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix=f".{name}.", dir=parent)
+        except OSError:
+            _logger.info(f"Cannot write genetic map cache to {cache_dir}")
+            return
+        try:
+            for i, arrays in enumerate(maps.values()):
+                np.save(os.path.join(tmp_dir, f"{i}.npy"), np.stack(arrays))
+            with open(os.path.join(tmp_dir, "chroms.json"), "w") as f:
+                json.dump(list(maps), f)
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            # a stale cache is moved aside, as only empty directories are replaced
+            if os.path.exists(cache_dir):
+                stale = tempfile.mkdtemp(prefix=f".{name}.", dir=parent)
+                os.replace(cache_dir, stale)
+                shutil.rmtree(stale, ignore_errors=True)
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # e.g. another process moved its cache into place first
+            _logger.info(f"Cannot write genetic map cache to {cache_dir}")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def interpolate(self, chrom, positions) -> np.ndarray:
+        """Genetic positions in cM at the given physical positions
+
+        Args:
+            chrom: chromosome, with or without the ``chr`` prefix
+            positions: physical positions
+
+        Returns:
+            Linearly interpolated cM
+
+        """
+        chrom = str(chrom)
+        for key in [chrom, chrom[3:] if chrom.startswith("chr") else f"chr{chrom}"]:
+            if key in self.maps:
+                pos, cM = self.maps[key]
+                return np.interp(np.asarray(positions, dtype=np.float64), pos, cM)
+        raise KeyError(f"Chromosome {chrom} not found in the genetic map")
+
+
+def _file_signature(path: str) -> Tuple[int, int]:
+    """Modification time in ns and size of a local file, or None"""
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=8)
+def _load_genetic_map(
+    genetic_map: str,
+    signature: Tuple[int, int],
+    chrom_col: int,
+    pos_col: int,
+    cM_col: int,
+    pd_kwargs: Tuple,
+) -> GeneticMap:
+    # signature is only part of the key, so that changed files are reloaded
+    return GeneticMap.from_file(
+        genetic_map, chrom_col, pos_col, cM_col, pd_kwargs=dict(pd_kwargs)
+    )
+
+
+@instrument.instrumented
 def genetic_distance(
     ds: xr.Dataset,
-    genetic_map: str,
-    chrom: int,
+    genetic_map: Union[str, GeneticMap],
+    chrom: int = None,
     chrom_col: int = 0,
     pos_col: int = 1,
     cM_col: int = 3,
@@ -18,8 +197,12 @@ def genetic_distance(
 
     Args:
         ds: Dataset containing local ancestry
-        genetic_map: path or url to the genetic map
-        chrom: the chromosome to be used in the genetic map
+        genetic_map: path or url to the genetic map, or a :class:`GeneticMap`.
+            Maps given as paths are kept in a process-wide LRU cache, until
+            the file changes
+        chrom: the chromosome to be used in the genetic map. If not given, the
+            ``chrom`` coordinate of ``ds`` is used
+        chrom_col: column number (0-based) of the chromosome in the genetic map
         pos_col: column number (0-based) of the position in the genetic map
         cM_col: column number (0-based) of the cM in the genetic map
         pd_kwargs: keyword arguments to be passed to pandas.read_csv
@@ -30,17 +213,27 @@ def genetic_distance(
 
     """
 
-    csv_kwargs = {"sep": " "}
-    csv_kwargs.update(pd_kwargs)
+    if not isinstance(genetic_map, GeneticMap):
+        genetic_map = _load_genetic_map(
+            genetic_map,
+            _file_signature(genetic_map),
+            chrom_col,
+            pos_col,
+            cM_col,
+            tuple(sorted(pd_kwargs.items())),
+        )
 
-    genetic_map = pd.read_csv(genetic_map, **csv_kwargs)
-    genetic_map = genetic_map[genetic_map.iloc[:, chrom_col] == chrom]
-
-    _genetic_position = np.interp(
-        x=ds["marker"].values,
-        xp=genetic_map.iloc[:, pos_col],
-        fp=genetic_map.iloc[:, cM_col],
-    )
+    if chrom is not None:
+        _genetic_position = genetic_map.interpolate(chrom, ds["marker"].values)
+    elif "chrom" in ds.coords:
+        chroms = ds["chrom"].values
+        pos = ds["marker"].values
+        _genetic_position = np.empty(pos.shape[0])
+        for c in np.unique(chroms):
+            is_c = chroms == c
+            _genetic_position[is_c] = genetic_map.interpolate(c, pos[is_c])
+    else:
+        raise ValueError("chrom is required when ds has no chrom coordinate")
 
     ds["genetic_position"] = ("marker", _genetic_position)
 
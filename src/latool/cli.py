@@ -0,0 +1,459 @@
+"""
+Command line interface of LAtool
+
+Every subcommand reads its input lazily, processes it in chunks of
+``--chunk-size`` markers (or as many markers as :mod:`latool.plan` fits in
+``--max-memory``) and writes its output chunk by chunk, so memory use does not
+grow with the number of markers. RFMIX text input is first streamed into a
+temporary zarr store.
+
+Examples::
+
+    latool convert example.msp.tsv example.zarr
+    latool convert example.zarr example.pgen --ancestry AFR --threads 4
+    latool simplify example.zarr simplified.zarr --max-memory 2G
+    latool global-ancestry example.zarr example.Q --keep samples.txt
+    latool lad example.zarr lad.tsv --ancestry AFR --region 22:16000000-17000000
+"""
+
+import argparse
+import contextlib
+import logging
+import os
+import re
+import sys
+import tempfile
+
+from latool import __version__
+from latool.plan import parse_memory, plan_chunks
+
+__author__ = "tszfungc"
+__copyright__ = "tszfungc"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+_SUFFIXES = {
+    ".fb.tsv": "fb",
+    ".msp.tsv": "msp",
+    ".vcf": "vcf",
+    ".vcf.gz": "vcf",
+    ".ts": "ts",
+    ".trees": "ts",
+    ".zarr": "zarr",
+    ".pgen": "pgen",
+}
+
+# kind of work of each subcommand, for latool.plan
+_OPERATIONS = {
+    "convert": "dosage",
+    "simplify": "compare",
+    "annotate": "encode",
+    "global-ancestry": "encode",
+    "lad": "reduce",
+}
+
+
+def _infer_format(path: str, fmt: str = None) -> str:
+    if fmt is not None:
+        return fmt
+    for suffix, suffix_fmt in _SUFFIXES.items():
+        if path.rstrip("/").endswith(suffix):
+            return suffix_fmt
+    raise ValueError(f"Cannot infer the format of {path}, please specify it")
+
+
+def _parse_region(region: str):
+    """Parse region like ``22``, ``chr22:100-200`` to (chrom, start, end)"""
+    match = re.fullmatch(r"([^:]+)(?::(\d+)-(\d+))?", region.replace(",", ""))
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Invalid region {region}")
+    chrom, start, end = match.groups()
+    return chrom, int(start or 0), int(end) if end else None
+
+
+def _chunk_size(args, operation: str, n_sample: int, n_ancestry: int) -> int:
+    """Markers per chunk from --chunk-size, or planned within --max-memory"""
+    if args.chunk_size is not None:
+        return args.chunk_size
+    plan = plan_chunks(
+        operation,
+        n_sample,
+        n_ancestry,
+        max_memory=args.max_memory,
+        n_workers=args.threads,
+    )
+    _logger.info(f"Chunk plan: {plan}")
+    return plan.marker
+
+
+def _read_keep(fname: str):
+    """IDs of samples to keep, the first column of every non-empty line"""
+    with open(fname) as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+
+def _subset(ds, args):
+    """Apply --region and --keep lazily"""
+    if args.region is not None:
+        chrom, start, end = args.region
+        keep = ds["marker"].values >= start
+        if end is not None:
+            keep &= ds["marker"].values <= end
+        if "chrom" in ds.coords:
+            keep &= ds["chrom"].values == chrom
+        ds = ds.isel(marker=keep)
+    if args.keep is not None:
+        samples = _read_keep(args.keep)
+        ds = ds.sel(sample=ds["sample"].values[ds["sample"].isin(samples)])
+    return ds
+
+
+def _to_zarr(ds, store: str, append: bool = False):
+    # the sample-major companion is not written to marker-major stores
+    ds = ds.drop_encoding().drop_vars("locanc_by_sample", errors="ignore")
+    if "chrom" in ds.coords:
+        # variable-length strings, so chromosomes of any name can be appended
+        ds["chrom"] = ds["chrom"].astype(object)
+    if append:
+        ds.to_zarr(store, append_dim="marker")
+    else:
+        ds.to_zarr(store, mode="w")
+
+
+def open_input(args, tmpdir: str):
+    """Open the input as a Dataset chunked along marker
+
+    Args:
+      args (:obj:`argparse.Namespace`): parsed command line parameters
+      tmpdir (str): directory for the zarr store of streamed text input
+
+    Returns:
+      Tuple[:obj:`xarray.Dataset`, int]: lazily loaded local ancestry, and the
+      number of markers per chunk
+    """
+    import xarray as xr
+
+    from latool.io import rfmix_read
+
+    fmt = _infer_format(args.input, args.input_format)
+
+    if fmt in ["fb", "msp"]:
+        read_header = {
+            "fb": rfmix_read._read_fb_header,
+            "msp": rfmix_read._read_msp_header,
+        }
+        iter_chunks = {
+            "fb": rfmix_read._iter_rfmix_fb,
+            "msp": rfmix_read._iter_rfmix_msp,
+        }
+        with open(args.input) as f:
+            pops, indiv = read_header[fmt](f)
+        chunk_size = _chunk_size(args, "parse", indiv.shape[0], len(pops))
+        chunks = iter_chunks[fmt](args.input, chunk_size)
+    elif fmt == "vcf":
+        from latool.io import vcf_read
+
+        with vcf_read._open(args.input) as f:
+            pops, indiv, _ = vcf_read._read_la_vcf_header(f)
+        chunk_size = _chunk_size(args, "parse", indiv.shape[0], len(pops))
+        # samples and region are pushed down to the parser
+        samples, region = None, None
+        if args.keep is not None:
+            keep = set(_read_keep(args.keep))
+            samples = [s for s in indiv if s in keep]
+        if args.region is not None:
+            chrom, start, end = args.region
+            region = f"{chrom}:{start}" + (f"-{end}" if end is not None else "")
+        chunks = vcf_read._iter_la_vcf(args.input, chunk_size, samples, region)
+
+    if fmt in ["fb", "msp", "vcf"]:
+        store = os.path.join(tmpdir, "input.zarr")
+        n_marker = 0
+        for ds in chunks:
+            ds = _subset(ds, args)
+            if ds.sizes["marker"] > 0:
+                _to_zarr(ds, store, append=n_marker > 0)
+                n_marker += ds.sizes["marker"]
+        if n_marker == 0:
+            raise ValueError("No marker left after filtering")
+        ds = xr.open_zarr(store)
+    elif fmt == "zarr":
+        from latool.io import open_store
+
+        ds = _subset(open_store(args.input), args)
+    elif fmt == "ts":
+        import numpy as np
+        import tskit
+
+        from latool.io import read_msp_ts
+        from latool.io.ts_read import _admixed_nodes
+
+        if args.admixpop is None or args.ancpop is None:
+            raise ValueError("--admixpop and --ancpop are required for tree sequences")
+        ts = tskit.load(args.input)
+        # samples are pushed down as the nodes traced, as in latool.io.shard
+        keep = None
+        if args.keep is not None:
+            nodes = _admixed_nodes(ts, args.admixpop)
+            individual = ts.tables.nodes.individual[nodes]
+            sample = np.array([f"indiv{i:d}" for i in individual])
+            keep = nodes[np.isin(sample, _read_keep(args.keep))]
+            if keep.shape[0] == 0:
+                raise ValueError("No sample left after filtering")
+        ds = read_msp_ts(
+            ts,
+            args.admixpop,
+            args.ancpop,
+            keep=keep,
+            chunk_size=args.chunk_size,
+            max_memory=args.max_memory,
+        )
+        ds = _subset(ds, args)
+    else:
+        raise ValueError(f"Unknown input format {fmt}")
+
+    chunk_size = _chunk_size(
+        args, _OPERATIONS[args.command], ds.sizes["sample"], ds.sizes["ancestry"]
+    )
+    return ds.chunk({"marker": chunk_size}), chunk_size
+
+
+def write_output(ds, args, chunk_size: int):
+    """Write a Dataset in the output format, chunk by chunk"""
+    fmt = _infer_format(args.output, args.output_format)
+
+    if fmt == "zarr":
+        _to_zarr(ds, args.output)
+    elif fmt == "pgen":
+        from latool.io import convert_pgen
+
+        if args.ancestry is None:
+            raise ValueError("--ancestry is required for pgen output")
+        prefix = re.sub(r"\.pgen$", "", args.output)
+        convert_pgen(
+            ds, prefix, args.ancestry, chunk_size=chunk_size, n_workers=args.threads
+        )
+    elif fmt == "fb":
+        from latool.io import write_rfmix_fb
+
+        write_rfmix_fb(ds, args.output, chunk_size=chunk_size)
+    else:
+        raise ValueError(f"Unknown output format {fmt}")
+
+
+# ---- Subcommands ----
+
+
+def convert(args, ds, chunk_size):
+    write_output(ds, args, chunk_size)
+
+
+def simplify(args, ds, chunk_size):
+    from latool.util import simplify
+
+    write_output(simplify(ds, chunk_size=chunk_size), args, chunk_size)
+
+
+def annotate(args, ds, chunk_size):
+    from latool.annotate import genetic_distance
+
+    ds = genetic_distance(ds, args.genetic_map, args.chrom)
+    write_output(ds, args, chunk_size)
+
+
+def global_ancestry(args, ds, chunk_size):
+    from latool.io import write_Q
+
+    write_Q(ds, args.output)
+
+
+def lad(args, ds, chunk_size):
+    from latool.encoding import ancestry_dosage
+    from latool.stats import LAD_eigvals, effective_tests
+
+    if args.ancestry is None:
+        raise ValueError("--ancestry is required for lad")
+    da_locanc = ancestry_dosage(ds, args.ancestry)
+    eigvals = LAD_eigvals(da_locanc, k=args.k, chunk_size=chunk_size, seed=args.seed)
+    meff, threshold = effective_tests(eigvals, alpha=args.alpha, method=args.method)
+
+    with open(args.output, "w") as f:
+        f.write(f"#meff={meff}\tthreshold={threshold}\n")
+        f.write("eigenvalue\n")
+        f.write("".join(f"{v}\n" for v in eigvals.values))
+    print(f"Effective number of tests: {meff:g}, threshold: {threshold:g}")
+
+
+# ---- CLI ----
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args (List[str]): command line parameters as list of strings
+          (for example  ``["--help"]``).
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("input", help="input .fb.tsv, .msp.tsv, .vcf, .ts or .zarr")
+    common.add_argument("output", help="output path, or prefix for pgen")
+    common.add_argument(
+        "--from", dest="input_format", choices=["fb", "msp", "vcf", "ts", "zarr"]
+    )
+    common.add_argument("--to", dest="output_format", choices=["zarr", "pgen", "fb"])
+    common.add_argument("--threads", type=int, help="number of threads")
+    common.add_argument("--chunk-size", type=int, help="number of markers per chunk")
+    common.add_argument(
+        "--max-memory",
+        type=parse_memory,
+        help="memory budget used to plan the chunk size, e.g. 4G",
+    )
+    common.add_argument(
+        "--region", type=_parse_region, help="CHROM or CHROM:START-END to keep"
+    )
+    common.add_argument("--keep", help="file with IDs of samples to keep")
+    common.add_argument("--ancestry", help="target ancestry for pgen and lad")
+    common.add_argument("--admixpop", help="admixed population in a tree sequence")
+    common.add_argument(
+        "--ancpop", nargs="+", help="ancestral populations in a tree sequence"
+    )
+    common.add_argument(
+        "--profile",
+        action="store_true",
+        help="print time, throughput and peak memory of each phase to stderr",
+    )
+    common.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    common.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+
+    parser = argparse.ArgumentParser(description="Local ancestry toolkit")
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="LAtool {ver}".format(ver=__version__),
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser(
+        "convert", parents=[common], help="convert between formats"
+    )
+    p.set_defaults(func=convert)
+
+    p = subparsers.add_parser(
+        "simplify", parents=[common], help="merge identical consecutive markers"
+    )
+    p.set_defaults(func=simplify)
+
+    p = subparsers.add_parser(
+        "annotate", parents=[common], help="annotate genetic positions"
+    )
+    p.add_argument("--genetic-map", required=True, help="path to the genetic map")
+    p.add_argument("--chrom", help="chromosome if the input has no chrom coordinate")
+    p.set_defaults(func=annotate)
+
+    p = subparsers.add_parser(
+        "global-ancestry", parents=[common], help="write global ancestry .Q"
+    )
+    p.set_defaults(func=global_ancestry)
+
+    p = subparsers.add_parser(
+        "lad", parents=[common], help="effective number of tests from empirical LAD"
+    )
+    p.add_argument("--k", type=int, default=200, help="number of eigenvalues")
+    p.add_argument("--alpha", type=float, default=0.05, help="family-wise error rate")
+    p.add_argument("--method", choices=["liji", "simpleM"], default="liji")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=lad)
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel, stream=sys.stderr, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+@contextlib.contextmanager
+def _threads(n_threads: int):
+    """Limit dask and numba to ``n_threads`` threads"""
+    if n_threads is None:
+        yield
+        return
+
+    import dask
+    import numba
+
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    with dask.config.set(scheduler="threads", num_workers=n_threads):
+        yield
+
+
+def main(args):
+    """Run a subcommand with string arguments in a CLI fashion
+
+    Args:
+      args (List[str]): command line parameters as list of strings
+          (for example  ``["convert", "example.msp.tsv", "example.zarr"]``).
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    from latool import instrument
+
+    handlers = []
+    if args.loglevel is not None:
+        handlers.append(instrument.LogReporter())
+    if args.profile:
+        handlers.append(instrument.SummaryReporter())
+
+    with contextlib.ExitStack() as stack:
+        tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(_threads(args.threads))
+        stack.enter_context(instrument.instrument(*handlers))
+
+        with instrument.phase("input"):
+            ds, chunk_size = open_input(args, tmpdir)
+        _logger.info(
+            f"Processing {ds.sizes['marker']} markers in chunks of {chunk_size}"
+        )
+        with instrument.phase(args.command):
+            args.func(args, ds, chunk_size)
+
+    if args.profile:
+        print(handlers[-1].report(), file=sys.stderr)
+
+
+def run():
+    """Calls :func:`main` passing the CLI arguments extracted from :obj:`sys.argv`
+
+    This function can be used as entry point to create console scripts with setuptools.
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
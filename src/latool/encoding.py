@@ -0,0 +1,490 @@
+"""Module for compact encodings of local ancestry
+
+| In two-way admixture, the ancestry of a haplotype at a marker is a single
+| bit. :func:`pack_locanc` stores it as ``locanc_packed`` of dims
+| (marker, word), with haplotype ``h = 2 * sample + ploidy`` at bit ``h % 64``
+| of word ``h // 64``, 64 times smaller than one byte per haplotype and
+| ancestry. Dosages, global ancestry, :func:`latool.util.simplify` and
+| :func:`latool.stats.empirical_LAD` work on the packed words directly.
+
+| RFMIX .fb posteriors carry a few significant digits and sum to one over
+| ancestries. :func:`quantize_locanc` stores them as ``locanc_quantized``,
+| uint8 or uint16 fixed-point probabilities of all but the last ancestry, 4 to
+| 8 times smaller than float32. They are decoded chunk by chunk when used.
+"""
+
+import numpy as np
+import xarray as xr
+
+from . import _kernels, instrument
+from .plan import _chunk_size, _sample_block
+from .util import (
+    _block_slices,
+    _map_marker_blocks,
+    _marker_slices,
+    _marker_weight,
+    _sample_major,
+)
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    """Number of set bits in each uint64 word"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    # SWAR: sum bits in 2-, 4-, then 8-bit fields, and add up the 8 bytes
+    # with a multiplication
+    words = words - ((words >> np.uint64(1)) & _M1)
+    words = (words & _M2) + ((words >> np.uint64(2)) & _M2)
+    words = (words + (words >> np.uint64(4))) & _M4
+    with np.errstate(over="ignore"):
+        return (words * _H01) >> np.uint64(56)
+
+
+def _swap_ploidy(words: np.ndarray) -> np.ndarray:
+    """Swap the bits of the two haplotypes of each sample"""
+    return ((words >> np.uint64(1)) & _M1) | ((words & _M1) << np.uint64(1))
+
+
+def _pack_bits(bits: np.ndarray) -> np.ndarray:
+    """Pack (marker, haplotype) booleans into (marker, word) uint64"""
+    n_word = -(-bits.shape[1] // 64)
+    packed = np.packbits(bits, axis=1, bitorder="little")
+    padded = np.zeros((bits.shape[0], n_word * 8), dtype=np.uint8)
+    padded[:, : packed.shape[1]] = packed
+    return padded.view("<u8").astype(np.uint64)
+
+
+def _unpack_bits(words: np.ndarray, n_haplotype: int) -> np.ndarray:
+    """Unpack (marker, word) uint64 into (marker, haplotype) uint8"""
+    as_bytes = np.ascontiguousarray(words, dtype="<u8").view(np.uint8)
+    return np.unpackbits(as_bytes, axis=1, count=n_haplotype, bitorder="little")
+
+
+def _sample_dosage(words: np.ndarray, n_sample: int) -> np.ndarray:
+    """Dosage of the packed ancestry of each sample, from (marker, word) words"""
+    # add the two bits of each sample into a 2-bit field, then split the fields
+    fields = (words & _M1) + ((words >> np.uint64(1)) & _M1)
+    shifts = np.arange(0, 64, 2, dtype=np.uint64)
+    dosage = (fields[..., None] >> shifts) & np.uint64(3)
+    return dosage.reshape(words.shape[0], -1)[:, :n_sample].astype(np.uint8)
+
+
+def is_packed(ds: xr.Dataset) -> bool:
+    """Whether ``ds`` holds bit-packed local ancestry"""
+    return "locanc_packed" in ds
+
+
+@instrument.instrumented
+def pack_locanc(
+    ds: xr.Dataset,
+    ancestry: str = None,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Pack hard-called two-way local ancestry into bits
+
+    Args:
+        ds: Dataset containing ``locanc`` with two ancestries and 0/1 values,
+            e.g. from :func:`latool.io.read_rfmix_msp`
+        ancestry: ancestry whose haplotypes are set bits, the second one by
+            default
+        chunk_size: number of markers packed at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Dataset with ``locanc_packed`` of dims (marker, word) in place of
+        ``locanc``, keeping the sample, ploidy and ancestry coordinates. The
+        attrs of ``locanc_packed`` hold the packed ``ancestry``, ``n_sample``
+        and the ``dtype`` of ``locanc`` for :func:`unpack_locanc`
+
+    Example
+    -------
+    >>> from latool.io import read_rfmix_msp
+    >>> from latool.encoding import pack_locanc, unpack_locanc
+    >>> ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    >>> packed = pack_locanc(ds)
+    >>> packed["locanc_packed"].shape, packed["locanc_packed"].dtype
+    ((5, 2), dtype('uint64'))
+    >>> unpack_locanc(packed)["locanc"].equals(ds["locanc"])
+    True
+
+    """
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    if ds.sizes["ancestry"] != 2:
+        raise ValueError("Bit packing requires exactly two ancestries")
+    ancestries = ds["ancestry"].values
+    if ancestry is None:
+        ancestry = ancestries[1]
+    if ancestry not in ancestries:
+        raise KeyError(f"No ancestry {ancestry} found")
+
+    da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+    N = da_locanc.shape[1]
+    if da_locanc.shape[2] != 2:
+        raise ValueError("Bit packing requires diploid samples")
+    i_anc = int(np.flatnonzero(ancestries == ancestry)[0])
+
+    def _pack_block(block):
+        if not np.all((block == 0) | (block == 1)):
+            raise ValueError("Bit packing requires hard calls of 0 and 1")
+        if not np.all(block.sum(axis=-1) == 1):
+            raise ValueError("Each haplotype must carry exactly one ancestry")
+        return _pack_bits(block[..., i_anc].reshape(block.shape[0], 2 * N) > 0)
+
+    words = _map_marker_blocks(
+        _pack_block, da_locanc, (-(-2 * N // 64),), np.uint64, chunk_size
+    )
+
+    ds = ds.drop_vars("locanc")
+    ds["locanc_packed"] = xr.DataArray(
+        words,
+        dims=["marker", "word"],
+        attrs={
+            "ancestry": str(ancestry),
+            "n_sample": N,
+            "dtype": str(da_locanc.dtype),
+        },
+    )
+    return ds
+
+
+@instrument.instrumented
+def unpack_locanc(
+    ds: xr.Dataset,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Restore ``locanc`` of dims (marker, sample, ploidy, ancestry)
+
+    Args:
+        ds: Dataset from :func:`pack_locanc`
+        chunk_size: number of markers unpacked at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Dataset with ``locanc`` in place of ``locanc_packed``
+
+    """
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    da_packed = ds["locanc_packed"]
+    N = da_packed.attrs["n_sample"]
+    i_anc = int(np.flatnonzero(ds["ancestry"].values == da_packed.attrs["ancestry"])[0])
+
+    dtype = da_packed.attrs["dtype"]
+
+    def _unpack_block(words):
+        bits = _unpack_bits(words, 2 * N).reshape(-1, N, 2)
+        locanc = np.empty(bits.shape + (2,), dtype=dtype)
+        locanc[..., i_anc] = bits
+        locanc[..., 1 - i_anc] = 1 - bits
+        return locanc
+
+    locanc = _map_marker_blocks(_unpack_block, da_packed, (N, 2, 2), dtype, chunk_size)
+
+    ds = ds.drop_vars("locanc_packed")
+    ds["locanc"] = (["marker", "sample", "ploidy", "ancestry"], locanc)
+    return ds
+
+
+def is_quantized(ds: xr.Dataset) -> bool:
+    """Whether ``ds`` holds quantized local ancestry"""
+    return "locanc_quantized" in ds
+
+
+@instrument.instrumented
+def quantize_locanc(
+    ds: xr.Dataset,
+    dtype: str = "uint8",
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Quantize local ancestry probabilities to fixed point
+
+    | Probabilities of all but the last ancestry are rounded to multiples of
+    | ``1 / scale``, where ``scale`` is the largest value of ``dtype``, i.e.
+    | an error of at most ``0.5 / scale``, 0.002 for uint8 and 8e-6 for
+    | uint16. The last ancestry is decoded as one minus the others, so its
+    | rounding errors add up to at most ``(A - 1) * 0.5 / scale`` with A
+    | ancestries.
+
+    Args:
+        ds: Dataset containing ``locanc`` probabilities, e.g. from
+            :func:`latool.io.read_rfmix_fb`
+        dtype: ``uint8`` or ``uint16``
+        chunk_size: number of markers quantized at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Dataset with ``locanc_quantized`` of dims (marker, sample, ploidy,
+        quantized_ancestry) in place of ``locanc``. The attrs of
+        ``locanc_quantized`` hold the ``scale`` and the ``dtype`` of ``locanc``
+
+    Example
+    -------
+    >>> from latool.io import read_rfmix_fb
+    >>> from latool.encoding import dense_locanc, quantize_locanc
+    >>> ds = read_rfmix_fb("tests/testdata/example.fb.tsv")
+    >>> quantized = quantize_locanc(ds)
+    >>> quantized["locanc_quantized"].dims
+    ('marker', 'sample', 'ploidy', 'quantized_ancestry')
+    >>> float(abs(dense_locanc(quantized) - ds["locanc"]).max()) <= 0.5 / 255
+    True
+
+    """
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    if dtype not in ["uint8", "uint16"]:
+        raise ValueError(f"Unsupported dtype {dtype}")
+    scale = np.iinfo(dtype).max
+
+    da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+    N, P, A = da_locanc.shape[1:]
+
+    def _quantize_block(block):
+        block = block[..., :-1].astype(np.float64)
+        return np.clip(np.rint(block * scale), 0, scale).astype(dtype)
+
+    quantized = _map_marker_blocks(
+        _quantize_block, da_locanc, (N, P, A - 1), dtype, chunk_size
+    )
+
+    ds = ds.drop_vars("locanc")
+    ds["locanc_quantized"] = xr.DataArray(
+        quantized,
+        dims=["marker", "sample", "ploidy", "quantized_ancestry"],
+        attrs={"scale": int(scale), "dtype": str(da_locanc.dtype)},
+    )
+    return ds
+
+
+def _dequantize(da_quantized: xr.DataArray, ancestries) -> xr.DataArray:
+    """Decode fixed-point probabilities, elementwise so that dask stays lazy"""
+    prob = da_quantized.astype(da_quantized.attrs["dtype"])
+    prob = prob / da_quantized.attrs["scale"]
+    last = (1 - prob.sum(dim="quantized_ancestry")).clip(min=0)
+    prob = xr.concat(
+        [prob, last.expand_dims("quantized_ancestry", -1)], dim="quantized_ancestry"
+    )
+    return prob.rename(quantized_ancestry="ancestry").assign_coords(ancestry=ancestries)
+
+
+def dense_locanc(
+    ds: xr.Dataset,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.DataArray:
+    """``locanc`` of dims (marker, sample, ploidy, ancestry) in any encoding
+
+    | Packed and quantized encodings are decoded lazily: arrays in memory are
+    | wrapped in dask chunks of ``chunk_size`` markers, so that only the
+    | chunks being used are decoded.
+
+    Args:
+        ds: Dataset containing ``locanc``, ``locanc_packed`` or
+            ``locanc_quantized``
+        chunk_size: number of markers decoded at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        DataArray ``locanc``
+
+    """
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    if is_packed(ds):
+        if ds["locanc_packed"].chunks is None:
+            ds = ds.chunk({"marker": chunk_size})
+        return unpack_locanc(ds)["locanc"]
+    if is_quantized(ds):
+        da_quantized = ds["locanc_quantized"]
+        if da_quantized.chunks is None:
+            da_quantized = da_quantized.chunk({"marker": chunk_size})
+        return _dequantize(da_quantized, ds["ancestry"].values).rename("locanc")
+    return ds["locanc"]
+
+
+def ancestry_dosage(
+    ds: xr.Dataset,
+    ancestry: str,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.DataArray:
+    """Dosage of one ancestry summed over ploidy, in any encoding of ``ds``
+
+    Args:
+        ds: Dataset containing ``locanc``, ``locanc_packed`` or
+            ``locanc_quantized``
+        ancestry: target ancestry
+        chunk_size: number of markers decoded at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        DataArray of dims (marker, sample). Lazy if ``ds`` is dask-backed or
+        quantized
+
+    """
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    if ancestry not in ds["ancestry"].values:
+        raise KeyError(f"No ancestry {ancestry} found")
+    if is_quantized(ds):
+        da = dense_locanc(ds, chunk_size).sel(ancestry=ancestry).sum(dim="ploidy")
+        return da.transpose("marker", "sample")
+    if not is_packed(ds):
+        da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+        i_anc = int(np.flatnonzero(ds["ancestry"].values == ancestry)[0])
+        dtype = da_locanc.dtype if da_locanc.dtype.kind == "f" else np.uint8
+        dosage = _map_marker_blocks(
+            lambda block: _kernels.ploidy_sum(block, i_anc),
+            da_locanc,
+            (da_locanc.shape[1],),
+            dtype,
+            chunk_size,
+        )
+        coords = {
+            name: coord
+            for name, coord in da_locanc.coords.items()
+            if set(coord.dims) <= {"marker", "sample"}
+        }
+        return xr.DataArray(dosage, dims=["marker", "sample"], coords=coords)
+
+    da_packed = ds["locanc_packed"]
+    N = da_packed.attrs["n_sample"]
+    dosage = _map_marker_blocks(
+        lambda words: _sample_dosage(words, N), da_packed, (N,), np.uint8, chunk_size
+    )
+    if ancestry != da_packed.attrs["ancestry"]:
+        dosage = 2 - dosage
+
+    return xr.DataArray(
+        dosage,
+        dims=["marker", "sample"],
+        coords={"marker": ds["marker"].values, "sample": ds["sample"].values},
+    )
+
+
+def global_ancestry(
+    ds: xr.Dataset,
+    chunk_size: int = None,
+    max_memory: int = None,
+    weighted: bool = False,
+) -> xr.DataArray:
+    """Mean local ancestry over markers and ploidy, in any encoding of ``ds``
+
+    | Dense and quantized ``locanc`` are summed block by block with a
+    | compiled kernel, following the marker chunks of dask-backed data. With
+    | the sample-major companion of :func:`latool.io.open_store`, blocks of
+    | samples over all markers are summed instead.
+
+    Args:
+        ds: Dataset containing ``locanc``, ``locanc_packed`` or
+            ``locanc_quantized``
+        chunk_size: number of markers decoded at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+        weighted: weight markers by ``right_position - left_position`` when
+            these are present, so that the mean is over the genome rather
+            than over markers
+
+    Returns:
+        DataArray ``locanc`` of dims (sample, ancestry)
+
+    """
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    weight = _marker_weight(ds) if weighted else np.full(ds.sizes["marker"], 1.0)
+    weight = weight / weight.sum()
+    ancestries = ds["ancestry"].values
+
+    by_sample = _sample_major(ds)
+    if by_sample is not None:
+        total = np.empty(by_sample.shape[::3])
+        for b in _block_slices(by_sample, _sample_block("encode", ds, max_memory)):
+            block = by_sample[b].values.transpose(1, 0, 2, 3)
+            total[b] = _kernels.marker_sum(block, weight)
+            instrument.progress(bytes_read=block.nbytes)
+        return xr.DataArray(
+            total / by_sample.shape[2],
+            name="locanc",
+            dims=["sample", "ancestry"],
+            coords={"sample": ds["sample"].values, "ancestry": ancestries},
+        )
+
+    if not is_packed(ds):
+        da_locanc = dense_locanc(ds, chunk_size)
+        da_locanc = da_locanc.transpose("marker", "sample", "ploidy", "ancestry")
+        total = np.zeros(da_locanc.shape[1::2])
+        for s in _block_slices(da_locanc, chunk_size):
+            total += _kernels.marker_sum(da_locanc[s].values, weight[s])
+            instrument.progress(rows=s.stop - s.start)
+        return xr.DataArray(
+            total / da_locanc.shape[2],
+            name="locanc",
+            dims=["sample", "ancestry"],
+            coords={"sample": ds["sample"].values, "ancestry": ancestries},
+        )
+
+    da_packed = ds["locanc_packed"]
+    _, N = da_packed.shape[0], da_packed.attrs["n_sample"]
+    total = np.zeros(N)
+    for s in _block_slices(da_packed, chunk_size):
+        total += weight[s] @ _sample_dosage(da_packed[s].values, N)
+        instrument.progress(rows=s.stop - s.start)
+    frac = total / 2
+
+    is_packed_anc = ancestries == da_packed.attrs["ancestry"]
+    return xr.DataArray(
+        np.where(is_packed_anc, frac[:, None], 1 - frac[:, None]),
+        name="locanc",
+        dims=["sample", "ancestry"],
+        coords={"sample": ds["sample"].values, "ancestry": ancestries},
+    )
+
+
+def packed_corrcoef(
+    da_packed: xr.DataArray,
+    chunk_size: int = None,
+) -> np.ndarray:
+    """Correlation between markers of the dosage of the packed ancestry
+
+    | With haplotype bits ``w`` and sample dosage ``d``,
+    | ``sum(d_i * d_j) = popcount(w_i & w_j) + popcount(w_i & swap(w_j))``,
+    | where ``swap`` exchanges the two bits of each sample, and
+    | ``sum(d_i) = popcount(w_i)``.
+
+    Args:
+        da_packed: ``locanc_packed`` from :func:`pack_locanc`
+        chunk_size: number of rows of the matrix computed at a time, by default
+            as many as keep the temporary word arrays around 32 MB
+
+    Returns:
+        A marker by marker correlation matrix, as ``numpy.corrcoef`` of the
+        dosages
+
+    """
+    words = da_packed.values
+    swapped = _swap_ploidy(words)
+    N = da_packed.attrs["n_sample"]
+    M = words.shape[0]
+
+    if chunk_size is None:
+        chunk_size = max(1, 2**22 // (M * words.shape[1]))
+
+    sums = _popcount(words).sum(axis=1).astype(np.float64)
+    cross = np.empty((M, M))
+    for s in _marker_slices(M, chunk_size):
+        w = words[s, None, :]
+        cross[s] = _popcount(w & words[None]).sum(axis=2)
+        cross[s] += _popcount(w & swapped[None]).sum(axis=2)
+        instrument.progress(rows=s.stop - s.start)
+
+    cov = cross - np.outer(sums, sums) / N
+    sd = np.sqrt(np.diag(cov))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.clip(cov / np.outer(sd, sd), -1, 1)
@@ -0,0 +1,315 @@
+"""Module for profiling and progress instrumentation
+
+| Readers, writers and statistics report structured events to the handlers
+| installed with :func:`instrument`: a ``start`` and an ``end`` event for every
+| phase, and ``progress`` events with the rows processed and bytes read or
+| written in between. ``end`` events carry the elapsed time, the totals of the
+| phase and the peak resident set size of the process. Without handlers,
+| :func:`phase` and :func:`progress` return immediately.
+
+Example
+-------
+>>> from latool.instrument import SummaryReporter, instrument
+>>> from latool.io import read_rfmix_fb
+>>> reporter = SummaryReporter()
+>>> with instrument(reporter):
+...     ds = read_rfmix_fb("tests/testdata/example.fb.tsv")
+>>> reporter.totals["read_rfmix_fb"]["rows"]
+8
+"""
+
+import contextlib
+import functools
+import logging
+import sys
+import threading
+import time
+from typing import Callable, List, NamedTuple
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not available on Windows
+    resource = None
+
+_logger = logging.getLogger(__name__)
+
+_handlers: List[Callable] = []
+_local = threading.local()
+
+
+class Event(NamedTuple):
+    """Instrumentation event
+
+    Args:
+        kind: ``start``, ``progress`` or ``end``
+        phase: name of the phase, nested phases joined by ``/``
+        time: ``time.perf_counter()`` when the event was emitted
+        elapsed: seconds since the phase started
+        rows: rows processed in the phase so far
+        bytes_read: bytes read in the phase so far
+        bytes_written: bytes written in the phase so far
+        peak_rss: peak resident set size of the process in bytes, in ``end``
+            events only
+
+    """
+
+    kind: str
+    phase: str
+    time: float
+    elapsed: float = 0.0
+    rows: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss: int = None
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process in bytes, or None if unknown"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _emit(event: Event):
+    for handler in list(_handlers):
+        handler(event)
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+class _Phase:
+    def __init__(self, name: str, parent: str = None):
+        self.name = name
+        self.parent = parent
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        stack = _stack()
+        parent = stack[-1].name if stack else self.parent
+        if parent:
+            self.name = f"{parent}/{self.name}"
+        stack.append(self)
+        self.start = time.perf_counter()
+        _emit(Event("start", self.name, self.start))
+        return self
+
+    def __exit__(self, *exc):
+        _stack().remove(self)
+        now = time.perf_counter()
+        _emit(
+            Event(
+                "end",
+                self.name,
+                now,
+                now - self.start,
+                self.rows,
+                self.bytes_read,
+                self.bytes_written,
+                peak_rss(),
+            )
+        )
+        return False
+
+    def progress(self, rows: int = 0, bytes_read: int = 0, bytes_written: int = 0):
+        self.rows += rows
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        now = time.perf_counter()
+        _emit(
+            Event(
+                "progress",
+                self.name,
+                now,
+                now - self.start,
+                self.rows,
+                self.bytes_read,
+                self.bytes_written,
+            )
+        )
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def progress(self, rows: int = 0, bytes_read: int = 0, bytes_written: int = 0):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def enabled() -> bool:
+    """Whether any handler is installed"""
+    return bool(_handlers)
+
+
+def phase(name: str, parent: str = None):
+    """Context manager timing a phase
+
+    | Phases entered inside another phase of the same thread are named
+    | ``<outer>/<name>``. The returned object has a
+    | ``progress(rows, bytes_read, bytes_written)`` method.
+
+    Args:
+        name: name of the phase
+        parent: name of the outer phase for the first phase of a worker
+            thread, usually :func:`current` of the thread starting it
+
+    """
+    if not _handlers:
+        return _NULL_PHASE
+    return _Phase(name, parent)
+
+
+def current() -> str:
+    """Name of the innermost phase of the current thread, or None
+
+    | Threads start without phases. Pass the name as ``parent`` of
+    | :func:`phase` in a worker thread to nest its phases under this one.
+
+    """
+    stack = _stack()
+    return stack[-1].name if stack else None
+
+
+def progress(rows: int = 0, bytes_read: int = 0, bytes_written: int = 0):
+    """Report progress of the innermost phase of the current thread
+
+    Args:
+        rows: number of rows, e.g. markers, processed since the last report
+        bytes_read: number of bytes read since the last report
+        bytes_written: number of bytes written since the last report
+
+    """
+    if not _handlers:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].progress(rows, bytes_read, bytes_written)
+
+
+def instrumented(func: Callable) -> Callable:
+    """Decorator running ``func`` in a phase named after it"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _handlers:
+            return func(*args, **kwargs)
+        with _Phase(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def instrument(*handlers: Callable):
+    """Install handlers receiving :class:`Event` for the duration of the block
+
+    Args:
+        handlers: callables taking an :class:`Event`, e.g. a
+            :class:`SummaryReporter` or :class:`LogReporter`
+
+    """
+    _handlers.extend(handlers)
+    try:
+        yield
+    finally:
+        for handler in handlers:
+            _handlers.remove(handler)
+
+
+class SummaryReporter:
+    """Handler accumulating time, throughput and memory per phase
+
+    Attributes:
+        totals: dict from phase name to the number of ``calls`` and the total
+            ``seconds``, ``rows``, ``bytes_read`` and ``bytes_written``, and
+            the largest ``peak_rss``
+
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        if event.kind != "end":
+            return
+        with self._lock:
+            total = self.totals.setdefault(
+                event.phase,
+                {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "rows": 0,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "peak_rss": None,
+                },
+            )
+            total["calls"] += 1
+            total["seconds"] += event.elapsed
+            total["rows"] += event.rows
+            total["bytes_read"] += event.bytes_read
+            total["bytes_written"] += event.bytes_written
+            if event.peak_rss is not None:
+                total["peak_rss"] = max(total["peak_rss"] or 0, event.peak_rss)
+
+    def report(self) -> str:
+        """Table of the phases sorted by name, with throughput per second"""
+        lines = [
+            f"{'phase':<40} {'calls':>6} {'seconds':>9} {'rows/s':>11} "
+            f"{'MB read/s':>10} {'MB write/s':>10} {'peak RSS MB':>11}"
+        ]
+        for name, total in sorted(self.totals.items()):
+            seconds = max(total["seconds"], 1e-9)
+            peak = total["peak_rss"]
+            lines.append(
+                f"{name:<40} {total['calls']:>6} {total['seconds']:>9.3f} "
+                f"{total['rows'] / seconds:>11.1f} "
+                f"{total['bytes_read'] / seconds / 2**20:>10.2f} "
+                f"{total['bytes_written'] / seconds / 2**20:>10.2f} "
+                f"{'' if peak is None else f'{peak / 2**20:.1f}':>11}"
+            )
+        return "\n".join(lines)
+
+
+class LogReporter:
+    """Handler logging phases and progress with :mod:`logging`
+
+    Args:
+        logger: logger to write to, ``latool.instrument`` by default
+        level: level of the messages
+
+    """
+
+    def __init__(self, logger: logging.Logger = None, level: int = logging.INFO):
+        self.logger = logger or _logger
+        self.level = level
+
+    def __call__(self, event: Event):
+        if event.kind == "start":
+            self.logger.log(self.level, f"{event.phase}: started")
+        elif event.kind == "progress":
+            self.logger.log(
+                self.level,
+                f"{event.phase}: {event.rows} rows at {event.elapsed:.2f}s",
+            )
+        else:
+            self.logger.log(
+                self.level,
+                f"{event.phase}: finished {event.rows} rows in "
+                f"{event.elapsed:.2f}s",
+            )
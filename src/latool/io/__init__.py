@@ -1,14 +1,62 @@
-from .pgen_write import write_pgen
-from .rfmix_read import read_rfmix_fb, read_rfmix_msp
-from .rfmix_write import write_Q, write_rfmix_fb
-from .ts_read import read_msp_mutations, read_msp_ts
+"""Readers and writers of local ancestry
+
+Submodules are imported on first access, so that e.g. reading RFMIX output does
+not import msprime, tskit or pgenlib.
+"""
+
+import importlib
+
+_SUBMODULE = {
+    "write_pgen": "pgen_write",
+    "read_rfmix_fb": "rfmix_read",
+    "read_rfmix_msp": "rfmix_read",
+    "read_rfmix_genome": "rfmix_read",
+    "read_la_vcf": "vcf_read",
+    "write_Q": "rfmix_write",
+    "write_rfmix_fb": "rfmix_write",
+    "read_msp_ts": "ts_read",
+    "read_msp_mutations": "ts_read",
+    "convert_pgen": "convert",
+    "pipeline": "convert",
+    "write_sample_major": "layout",
+    "open_store": "layout",
+    "append_samples": "append",
+    "read_summary": "append",
+    "plan_shards": "shard",
+    "run_shard": "shard",
+    "run_shards": "shard",
+    "merge_shards": "shard",
+}
 
 __all__ = [
     "read_rfmix_fb",
     "read_rfmix_msp",
+    "read_rfmix_genome",
+    "read_la_vcf",
     "write_pgen",
     "read_msp_ts",
     "write_Q",
     "write_rfmix_fb",
     "read_msp_mutations",
+    "convert_pgen",
+    "pipeline",
+    "write_sample_major",
+    "open_store",
+    "append_samples",
+    "read_summary",
+    "plan_shards",
+    "run_shard",
+    "run_shards",
+    "merge_shards",
 ]
+
+
+def __getattr__(name):
+    if name in _SUBMODULE:
+        module = importlib.import_module(f".{_SUBMODULE[name]}", __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,165 @@
+"""Module for appending batches of samples to a zarr store
+
+| A cohort growing by batches of samples is kept in one marker-major zarr
+| store. :func:`append_samples` writes the chunks of the new samples only,
+| extends the sample-major companion of :mod:`latool.io.layout` if there is
+| one, and updates the sufficient statistics of
+| :func:`latool.stats.summary.summary_stats` kept in a summary companion,
+| ``example.summary.zarr`` for ``example.zarr``, from the new samples alone.
+| A pgen holds all samples of a variant in one record, so samples cannot be
+| appended to it. Instead every batch gets its own pgen fileset, listed in a
+| ``--pmerge-list`` file for plink2.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+from .. import instrument
+from ..plan import _chunk_size
+from ..stats.summary import merge_summary, summary_stats
+from .layout import _move_into_place, companion_store, open_store
+
+_logger = logging.getLogger(__name__)
+
+
+def _aligned_chunks(n_old: int, n_new: int, chunk: int) -> tuple:
+    """Chunks of ``n_new`` samples appended after ``n_old`` samples, such that
+    every chunk falls in one zarr chunk of ``chunk`` samples"""
+    first = min(n_new, -n_old % chunk)
+    rest = n_new - first
+    sizes = [first] + [chunk] * (rest // chunk) + [rest % chunk]
+    return tuple(size for size in sizes if size > 0)
+
+
+def _append_along_sample(store: str, da: xr.DataArray, n_old: int):
+    """Append the chunks of new samples of a variable to a zarr store"""
+    chunks = xr.open_zarr(store)[da.name].encoding["chunks"]
+    sizes = dict(zip(da.dims, chunks))
+    sizes["sample"] = _aligned_chunks(n_old, da.sizes["sample"], sizes["sample"])
+    new = da.drop_vars([c for c in da.coords if c != "sample"]).chunk(sizes)
+    new.to_dataset().to_zarr(store, append_dim="sample")
+
+
+def read_summary(store: str) -> xr.Dataset:
+    """Read the summary companion of a store written by :func:`append_samples`
+
+    Args:
+        store: path to the zarr store
+
+    Returns:
+        Dataset of :func:`latool.stats.summary.summary_stats`
+
+    """
+    return xr.open_zarr(companion_store(store, "summary")).load()
+
+
+def _write_summary(store: str, summary: xr.Dataset):
+    """Write the summary companion, moved into place once complete"""
+    out = companion_store(store, "summary")
+    parent, name = os.path.split(os.path.abspath(out))
+    tmp_dir = tempfile.mkdtemp(prefix=f".{name}.", dir=parent)
+    try:
+        summary.drop_encoding().to_zarr(tmp_dir, mode="w")
+        _move_into_place(tmp_dir, out)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@instrument.instrumented
+def append_samples(
+    store: str,
+    ds: xr.Dataset,
+    pgen: str = None,
+    pgen_ancestry: str = None,
+    lad_ancestry: str = None,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Append a batch of samples to a zarr store and update its summary
+
+    | The first batch creates the store. Later batches must have the same
+    | markers and ancestries, and new sample IDs. Only the new samples are
+    | read: their statistics are merged with the stored summary, so global
+    | ancestry, per-marker ancestry sums and LAD accumulators cover the whole
+    | cohort. A store without a summary, or whose summary does not match its
+    | samples, is summarized once from its samples.
+
+    Args:
+        store: path to the zarr store
+        ds: Dataset of the new samples, containing ``locanc`` in the data_vars
+        pgen: output prefix of the pgen filesets. Batch ``k`` is written to
+            ``<pgen>.batch<k>``, listed in ``<pgen>.pmerge_list``
+        pgen_ancestry: ancestry of the pgen dosage, required with ``pgen``
+        lad_ancestry: ancestry of the LAD accumulators, the same for every
+            batch. None for no accumulators
+        chunk_size: number of markers per block, planned from ``max_memory``
+            by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Summary of all samples in the store
+
+    """
+    if "locanc" not in ds:
+        raise KeyError("Appending requires dense locanc in the data_vars")
+    if pgen is not None and pgen_ancestry is None:
+        raise ValueError("pgen_ancestry is required with pgen")
+    ds = ds.drop_encoding()
+    summary = summary_stats(ds, lad_ancestry, chunk_size, max_memory)
+
+    if not os.path.isdir(store):
+        chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+        ds.chunk({"marker": chunk_size}).to_zarr(store, mode="w")
+        n_batch = 0
+    else:
+        ds_store = open_store(store)
+        for name in ["marker", "ancestry", "ploidy", "chrom"]:
+            if (name in ds_store.coords) != (name in ds.coords) or (
+                name in ds.coords
+                and not np.array_equal(ds_store[name].values, ds[name].values)
+            ):
+                raise ValueError(f"The batch differs from {store} in {name}")
+        old_sample = ds_store["sample"].values
+        if np.isin(ds["sample"].values, old_sample).any():
+            raise ValueError(f"The batch has samples already in {store}")
+
+        try:
+            stored = read_summary(store)
+        except (OSError, KeyError, ValueError):
+            stored = None
+        if stored is None or not np.array_equal(stored["sample"], old_sample):
+            _logger.info(f"Summarizing the samples in {store}")
+            stored = summary_stats(ds_store, lad_ancestry, chunk_size, max_memory)
+        n_batch = stored.attrs.get("n_batch", 1)
+        # raises before the store is changed if the summaries do not match
+        summary = merge_summary(stored, summary)
+
+        N = old_sample.shape[0]
+        for name, da in ds.data_vars.items():
+            if "sample" in da.dims:
+                _append_along_sample(store, da, N)
+        if "locanc_by_sample" in ds_store:
+            by_sample = ds["locanc"].transpose("sample", "marker", "ploidy", "ancestry")
+            _append_along_sample(
+                companion_store(store), by_sample.rename("locanc_by_sample"), N
+            )
+
+    summary.attrs["n_batch"] = n_batch + 1
+    _write_summary(store, summary)
+
+    if pgen is not None:
+        from .pgen_write import write_pgen
+
+        prefix = f"{pgen}.batch{n_batch}"
+        write_pgen(
+            prefix, ds, pgen_ancestry, chunk_size=chunk_size, max_memory=max_memory
+        )
+        with open(f"{pgen}.pmerge_list", "a") as f:
+            f.write(f"{prefix}\n")
+
+    return summary
@@ -0,0 +1,260 @@
+"""Pipelined conversion of local ancestry between formats
+
+| :func:`pipeline` connects a chunked reader to a chunked writer. A thread
+| pulls chunks from the reader and submits them to a thread pool, while the
+| caller consumes the transformed chunks in order. Queues between the stages
+| are bounded, so a slow writer blocks the reader instead of buffering the
+| whole input. Parsing, numpy reductions and pgen encoding release the GIL,
+| so the stages of different chunks run concurrently in threads.
+"""
+
+import contextlib
+import functools
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Union
+
+import numpy as np
+import pgenlib as pg
+import xarray as xr
+
+from .. import _kernels, instrument
+from ..encoding import ancestry_dosage
+from ..plan import plan_chunks, plan_dataset
+from ..util import _marker_slices
+from .pgen_write import _pvar_frame, _write_psam
+from .rfmix_read import (
+    _iter_rfmix_fb,
+    _iter_rfmix_msp,
+    _read_fb_header,
+    _read_msp_header,
+)
+
+_logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put ``item`` into ``q``, blocking until there is room or ``stop`` is set"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def pipeline(
+    chunks: Iterable,
+    func: Callable,
+    n_workers: int = None,
+    queue_size: int = 4,
+    name: str = "read",
+) -> Iterator:
+    """Apply ``func`` to chunks concurrently and yield the results in order
+
+    | ``chunks`` is iterated in a reader thread and every chunk is submitted
+    | to a pool of ``n_workers`` threads. At most ``queue_size`` submitted
+    | chunks wait for the consumer, so reading runs ahead of writing by a
+    | bounded number of chunks. An exception in any stage is raised in the
+    | consumer and stops the reader.
+
+    Args:
+        chunks: iterable of chunks, e.g. Datasets of consecutive markers
+        func: function applied to every chunk
+        n_workers: number of threads applying ``func``
+        queue_size: number of chunks read ahead of the consumer
+        name: name of the reader phase reported to :mod:`latool.instrument`
+
+    Yields:
+        ``func(chunk)`` for every chunk in the order of ``chunks``
+
+    Example
+    -------
+    >>> from latool.io import pipeline
+    >>> list(pipeline(range(5), lambda x: x * x, n_workers=2))
+    [0, 1, 4, 9, 16]
+
+    """
+    pending = queue.Queue(queue_size)
+    stop = threading.Event()
+    parent = instrument.current()
+
+    with ThreadPoolExecutor(n_workers) as executor:
+
+        def read():
+            try:
+                with instrument.phase(name, parent):
+                    for chunk in chunks:
+                        if not _put(pending, executor.submit(func, chunk), stop):
+                            return
+            except BaseException as e:
+                future = Future()
+                future.set_exception(e)
+                _put(pending, future, stop)
+                return
+            _put(pending, _DONE, stop)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                future = pending.get()
+                if future is _DONE:
+                    break
+                yield future.result()
+        finally:
+            stop.set()
+            reader.join()
+            while not pending.empty():
+                future = pending.get()
+                if future is not _DONE:
+                    future.cancel()
+
+
+def _count_data_lines(fname: str, block_size: int = 2**24) -> int:
+    """Number of non-empty lines in a text file, counting a last line without newline"""
+    n_line, last = 0, b"\n"
+    with open(fname, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            newline = np.frombuffer(last + block, dtype=np.uint8) == ord("\n")
+            # blank lines, e.g. trailing ones, are skipped by the parser, so a
+            # line ends at a newline that does not follow another one
+            n_line += np.count_nonzero(newline[1:] & ~newline[:-1])
+            last = block[-1:]
+    return n_line + (last != b"\n")
+
+
+def _open_source(
+    source: Union[str, xr.Dataset], chunk_size: int, max_memory: int, n_chunks: int
+):
+    """Samples, ancestries, number of markers and chunk iterator of a source"""
+    if isinstance(source, xr.Dataset):
+        if not {"locanc", "locanc_packed", "locanc_quantized"} & set(source.data_vars):
+            raise KeyError("No local ancestry data_vars is found in the dataset")
+        if chunk_size is None:
+            chunk_size = plan_dataset("dosage", source, max_memory, n_chunks).marker
+        M = source.sizes["marker"]
+        chunks = (source.isel(marker=s) for s in _marker_slices(M, chunk_size))
+        return source["sample"].values, source["ancestry"].values, M, chunks
+
+    if source.endswith(".fb.tsv"):
+        read_header, iter_chunks = _read_fb_header, _iter_rfmix_fb
+    elif source.endswith(".msp.tsv"):
+        # ancestry codes are reduced to dosage without one-hot encoding
+        read_header = _read_msp_header
+        iter_chunks = functools.partial(_iter_rfmix_msp, one_hot=False)
+    else:
+        raise ValueError(f"Unknown input format of {source}")
+    with open(source) as f:
+        pops, indiv = read_header(f)
+    # the two header lines are not markers
+    M = _count_data_lines(source) - 2
+    if chunk_size is None:
+        chunk_size = plan_chunks(
+            "parse",
+            indiv.shape[0],
+            len(pops),
+            M,
+            max_memory=max_memory,
+            n_workers=n_chunks,
+        ).marker
+    return indiv, np.array(pops), M, iter_chunks(source, chunk_size)
+
+
+@instrument.instrumented
+def convert_pgen(
+    source: Union[str, xr.Dataset],
+    out: str,
+    anc_name: str,
+    pos_coord: str = "marker",
+    chrom: int = 1,
+    chunk_size: int = None,
+    n_workers: int = None,
+    queue_size: int = 4,
+    max_memory: int = None,
+) -> None:
+    """Convert local ancestry to plink2 .pgen .psam .pvar in a pipeline
+
+    | Produces the same files as :func:`latool.io.write_pgen`, with parsing,
+    | ancestry dosage and pgen encoding of different chunks overlapping
+    | through :func:`pipeline`. The .psam is written from the header and the
+    | .pvar rows of every chunk are appended in a separate thread, concurrently
+    | with the pgen body. At most ``queue_size + 2`` chunks are in memory, and
+    | the chunk size is planned so that they fit in ``max_memory``.
+
+    Args:
+        source: path to RFMIX .fb.tsv or .msp.tsv output, or a Dataset
+            containing ``locanc``, ``locanc_packed`` or ``locanc_quantized``
+        out: output filename prefix
+        anc_name: name of target ancestry. Must be present in the coords ``ancestry``
+        pos_coord: the name of coordinates used as position
+        chrom: chromosome written to .pvar, unless ``chrom`` is a coordinate
+        chunk_size: number of markers parsed, computed and written at a time,
+            planned from ``max_memory`` by default
+        n_workers: number of threads computing ancestry dosage
+        queue_size: number of chunks read ahead of the pgen writer
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    """
+    # chunks queued, submitted by the blocked reader and held by the writer
+    n_chunks = queue_size + 2
+    iid, ancestries, M, chunks = _open_source(source, chunk_size, max_memory, n_chunks)
+    if anc_name not in ancestries:
+        raise KeyError(f"No ancestry {anc_name} found")
+    N = iid.shape[0]
+
+    parent = instrument.current()
+
+    code = int(np.flatnonzero(ancestries == anc_name)[0])
+
+    def compute(ds):
+        with instrument.phase("compute", parent):
+            if "locanc_code" in ds:
+                dosage = _kernels.code_dosage(ds["locanc_code"].values, code)
+            else:
+                dosage = ancestry_dosage(ds, anc_name, ds.sizes["marker"]).values
+            if "chrom" in ds.coords:
+                chrom_chunk = ds["chrom"].values
+            else:
+                chrom_chunk = np.repeat(chrom, ds.sizes["marker"])
+            pvar_df = _pvar_frame(chrom_chunk, ds[pos_coord].values)
+            instrument.progress(rows=dosage.shape[0])
+        return np.ascontiguousarray(dosage, dtype=np.float32), pvar_df
+
+    with open(f"{out}.pvar", "w") as pvar, ThreadPoolExecutor(1) as sidecar:
+        psam = sidecar.submit(_write_psam, out, iid, parent)
+        pvar_parts = []
+
+        results = pipeline(chunks, compute, n_workers, queue_size)
+        with instrument.phase("pgen"), contextlib.closing(results), pg.PgenWriter(
+            f"{out}.pgen".encode("utf-8"), N, M, False, dosage_present=True
+        ) as pgwrite:
+            for dosage, pvar_df in results:
+                pgwrite.append_dosages_batch(dosage)
+                instrument.progress(rows=dosage.shape[0])
+                # the single sidecar thread appends chunks in submission order
+                pvar_parts.append(
+                    sidecar.submit(_append_pvar, pvar, pvar_df, not pvar_parts, parent)
+                )
+
+        psam.result()
+        for part in pvar_parts:
+            part.result()
+
+
+def _append_pvar(f_handle, pvar_df, header: bool, parent: str = None):
+    """Append .pvar rows of a chunk to an open file"""
+    with instrument.phase("pvar", parent):
+        start = f_handle.tell()
+        pvar_df.to_csv(f_handle, header=header, index=False, sep="\t")
+        instrument.progress(
+            rows=pvar_df.shape[0], bytes_written=f_handle.tell() - start
+        )
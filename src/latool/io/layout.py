@@ -0,0 +1,153 @@
+"""Module for the sample-major companion layout of a zarr store
+
+| Readers write ``locanc`` marker-major, i.e. of dims (marker, sample,
+| ploidy, ancestry), which suits writers working marker by marker. Per-sample
+| work, like global ancestry, tracts or sharing, strides through the whole
+| array of such a store. :func:`write_sample_major` transposes the store to a
+| companion store next to it, ``example.sample_major.zarr`` for
+| ``example.zarr``, where the markers of a sample are contiguous.
+| :func:`open_store` opens both as one Dataset, with the companion as the
+| ``locanc_by_sample`` data variable, which is used by the functions it suits.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+from .. import instrument
+from ..plan import _chunk_size
+from ..util import _block_slices
+
+_logger = logging.getLogger(__name__)
+
+# bytes of an uncompressed chunk of the companion store
+_CHUNK_BYTES = 16 << 20
+
+
+def companion_store(store: str, kind: str = "sample_major") -> str:
+    """Path of a companion of a zarr store, e.g. the sample-major layout"""
+    root, ext = os.path.splitext(os.path.normpath(store))
+    return f"{root}.{kind}{ext or '.zarr'}"
+
+
+def _move_into_place(tmp_dir: str, out: str):
+    """Replace ``out`` by the directory ``tmp_dir`` of the same parent"""
+    if os.path.exists(out):
+        # a stale directory is moved aside, as only empty directories are replaced
+        parent, name = os.path.split(os.path.abspath(out))
+        stale = tempfile.mkdtemp(prefix=f".{name}.", dir=parent)
+        os.replace(out, stale)
+        shutil.rmtree(stale, ignore_errors=True)
+    os.replace(tmp_dir, out)
+
+
+@instrument.instrumented
+def write_sample_major(
+    store: str,
+    out: str = None,
+    chunk_size: int = None,
+    sample_chunk: int = None,
+    max_memory: int = None,
+) -> str:
+    """Transpose ``locanc`` of a zarr store to a sample-major companion store
+
+    | Blocks of markers of all samples are read once, following the marker
+    | chunks of the store, and written transposed as chunks of
+    | ``sample_chunk`` samples, so memory is bounded by one block whatever
+    | the size of the store. The companion is written to a temporary
+    | directory and moved into place, so a partial companion is never opened.
+
+    Args:
+        store: path to a zarr store with ``locanc`` of dims (marker, sample,
+            ploidy, ancestry)
+        out: path of the companion store, :func:`companion_store` by default
+        chunk_size: number of markers per block for stores without marker
+            chunks, planned from ``max_memory`` by default
+        sample_chunk: number of samples per chunk of the companion, such that
+            chunks are about 16 MiB by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Path of the companion store
+
+    """
+    ds = xr.open_zarr(store)
+    da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+    M, N, P, A = da_locanc.shape
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    slices = list(_block_slices(da_locanc, chunk_size))
+    if sample_chunk is None:
+        chunk_bytes = slices[0].stop * P * A * da_locanc.dtype.itemsize
+        sample_chunk = min(N, max(1, _CHUNK_BYTES // chunk_bytes))
+
+    out = companion_store(store) if out is None else out
+    parent, name = os.path.split(os.path.abspath(out))
+    tmp_dir = tempfile.mkdtemp(prefix=f".{name}.", dir=parent)
+    try:
+        for i, s in enumerate(slices):
+            block = xr.Dataset(
+                data_vars={
+                    "locanc_by_sample": (
+                        ["sample", "marker", "ploidy", "ancestry"],
+                        da_locanc[s].values.transpose(1, 0, 2, 3),
+                    )
+                },
+                coords={"marker": da_locanc["marker"].values[s]},
+            )
+            if i == 0:
+                block = block.assign_coords(
+                    sample=da_locanc["sample"].values,
+                    ploidy=da_locanc["ploidy"].values,
+                    ancestry=da_locanc["ancestry"].values,
+                )
+                chunks = (sample_chunk, s.stop, P, A)
+                block.to_zarr(
+                    tmp_dir,
+                    mode="w",
+                    encoding={"locanc_by_sample": {"chunks": chunks}},
+                )
+            else:
+                block.to_zarr(tmp_dir, append_dim="marker")
+            instrument.progress(rows=s.stop - s.start)
+
+        _move_into_place(tmp_dir, out)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return out
+
+
+def open_store(store: str) -> xr.Dataset:
+    """Open a zarr store of local ancestry with its sample-major companion
+
+    | The companion, if any, is added as ``locanc_by_sample`` of dims
+    | (sample, marker, ploidy, ancestry). A companion whose samples or
+    | markers differ from the store, e.g. after appending to the store, is
+    | ignored with a warning.
+
+    Args:
+        store: path to a zarr store written by latool
+
+    Returns:
+        Lazily loaded Dataset
+
+    """
+    ds = xr.open_zarr(store)
+    companion = companion_store(store)
+    if not os.path.isdir(companion):
+        return ds
+
+    by_sample = xr.open_zarr(companion)
+    if not (
+        np.array_equal(by_sample["sample"].values, ds["sample"].values)
+        and np.array_equal(by_sample["marker"].values, ds["marker"].values)
+    ):
+        _logger.warning(f"Ignoring {companion}, as it does not match {store}")
+        return ds
+    da = by_sample["locanc_by_sample"]
+    ds["locanc_by_sample"] = (da.dims, da.data)
+    return ds
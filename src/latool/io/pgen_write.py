@@ -1,17 +1,26 @@
-import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import pgenlib as pg
 import xarray as xr
 
+from .. import instrument
+from ..encoding import ancestry_dosage
+from ..plan import _chunk_size
+from ..util import _marker_slices
 
+
+@instrument.instrumented
 def write_pgen(
     out: str,
     ds: xr.Dataset,
     anc_name: str,
     pos_coord: str = "marker",
     chrom: int = 1,
+    chunk_size: int = None,
+    max_memory: int = None,
 ) -> None:
     """Writing local ancestry dosage to plink2 .pgen .fam .psam
 
@@ -20,38 +29,76 @@ def write_pgen(
 
     Args:
         out: output filename prefix
-        ds: xarray Dataset containing ``locanc`` in the data_vars
+        ds: xarray Dataset containing ``locanc``, ``locanc_packed`` or
+            ``locanc_quantized`` in the data_vars
         anc_name: name of target ancestry. Must be present in the coords ``ancestry``
         pos_coord: the name of coordinates used as position
+        chrom: chromosome written to .pvar, unless ``chrom`` is a coordinate
+        chunk_size: number of markers computed and written at a time, planned
+            from ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
 
     """
+    chunk_size = _chunk_size("dosage", ds, chunk_size, max_memory)
 
-    if "locanc" not in ds:
+    if not {"locanc", "locanc_packed", "locanc_quantized"} & set(ds.data_vars):
         raise KeyError("No local ancestry data_vars is found in the dataset")
     if anc_name not in ds["ancestry"]:
         raise KeyError(f"No ancestry {anc_name} found")
 
-    N, M = ds.dims["sample"], ds.dims["marker"]
+    N, M = ds.sizes["sample"], ds.sizes["marker"]
     pos = ds[pos_coord].values
-    iid = ds["sample"].values
-
-    # pgen
-    da_locanc = ds["locanc"].sel(ancestry=anc_name).sum(dim="ploidy").compute()
-    with pg.PgenWriter(
-        f"{out}.pgen".encode("utf-8"), N, M, False, dosage_present=True
-    ) as pgwrite:
-        for i in range(M):
-            pgwrite.append_dosages(np.float32(da_locanc[i]))
-    logging.info("Finish writing pgen file")
-
-    # psam
-    psam_df = pd.DataFrame({"#IID": iid}).assign(SEX="NA")
-    psam_df.to_csv(f"{out}.psam", index=False, sep="\t")
-    logging.info("Finish writing psam file")
-
-    # pvar
-    pvar_df = pd.DataFrame(
-        {"#CHROM": np.repeat(chrom, M), "POS": pos, "ID": [f"{chrom}:{p}" for p in pos]}
+    if "chrom" in ds.coords:
+        chrom = ds["chrom"].values
+    else:
+        chrom = np.repeat(chrom, M)
+
+    # psam and pvar are written in a thread while the pgen body is encoded
+    parent = instrument.current()
+    with ThreadPoolExecutor(1) as sidecar:
+        psam = sidecar.submit(_write_psam, out, ds["sample"].values, parent)
+        pvar = sidecar.submit(_write_pvar, out, chrom, pos, parent)
+
+        # pgen
+        da_locanc = ancestry_dosage(ds, anc_name, chunk_size)
+        with instrument.phase("pgen"), pg.PgenWriter(
+            f"{out}.pgen".encode("utf-8"), N, M, False, dosage_present=True
+        ) as pgwrite:
+            for s in _marker_slices(M, chunk_size):
+                pgwrite.append_dosages_batch(
+                    np.ascontiguousarray(da_locanc[s].values, dtype=np.float32)
+                )
+                instrument.progress(rows=s.stop - s.start)
+
+        psam.result()
+        pvar.result()
+
+
+def _write_psam(out: str, iid: np.ndarray, parent: str = None):
+    """Write ``<out>.psam`` of the sample IDs"""
+    with instrument.phase("psam", parent):
+        psam_df = pd.DataFrame({"#IID": iid}).assign(SEX="NA")
+        psam_df.to_csv(f"{out}.psam", index=False, sep="\t")
+        instrument.progress(
+            rows=iid.shape[0], bytes_written=os.path.getsize(f"{out}.psam")
+        )
+
+
+def _pvar_frame(chrom: np.ndarray, pos: np.ndarray) -> pd.DataFrame:
+    """.pvar rows of markers at ``pos`` on ``chrom``"""
+    return pd.DataFrame(
+        {
+            "#CHROM": chrom,
+            "POS": pos,
+            "ID": [f"{c}:{p}" for c, p in zip(chrom, pos)],
+        }
     ).assign(REF="T", ALT="A")
-    pvar_df.to_csv(f"{out}.pvar", index=False, sep="\t")
-    logging.info("Finish writing pvar file")
+
+
+def _write_pvar(out: str, chrom: np.ndarray, pos: np.ndarray, parent: str = None):
+    """Write ``<out>.pvar`` of all markers"""
+    with instrument.phase("pvar", parent):
+        _pvar_frame(chrom, pos).to_csv(f"{out}.pvar", index=False, sep="\t")
+        instrument.progress(
+            rows=pos.shape[0], bytes_written=os.path.getsize(f"{out}.pvar")
+        )
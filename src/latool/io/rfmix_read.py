@@ -1,18 +1,265 @@
+import atexit
+import functools
+import glob
+import io
 import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Union
 
 import numpy as np
+import pandas as pd
 import xarray as xr
-from numba import guvectorize
 
+from .. import _kernels, instrument
+from ..annotate import GeneticMap, genetic_distance
+from ..encoding import pack_locanc, quantize_locanc
+from ..plan import default_max_memory, parse_memory, plan_chunks
 
-@guvectorize(["(uint32[:], uint8[:], uint8[:])"], "(), (n) -> (n)")
-def _ohe(value_in, _, arr_out):
-    arr_out[:] = 0
-    arr_out[value_in] = 1
+_logger = logging.getLogger(__name__)
 
 
+def _read_fb_header(f_handle):
+    """Read ancestries and individuals from the two header lines of .fb.tsv"""
+    # Read ancestry line
+    comment = f_handle.readline()
+    pops = comment.strip().split("\t")[1:]
+    n_pops = len(pops)
+
+    # header line
+    # RFMIX output dim: (marker , (sample x ploidy x ancestry))
+    header = f_handle.readline()
+    indiv = list(map(lambda x: x.split(":::")[0], header.strip().split("\t")[4:]))
+    indiv = np.array(indiv[:: (2 * n_pops)], dtype=str)
+
+    return pops, indiv
+
+
+def _read_msp_header(f_handle):
+    """Read ancestries and individuals from the two header lines of .msp.tsv"""
+    # Read ancestry line
+    comment = f_handle.readline()
+    popcode = comment.strip().split(" ")[-1].split("\t")
+    pops = [pc.split("=")[0] for pc in popcode]
+
+    # header line
+    # RFMIX output dim: (marker by (sample x ploidy))
+    header = f_handle.readline()
+    indiv = list(map(lambda x: x[:-2], header.strip().split("\t")[6:]))
+    indiv = np.array(indiv[::2], dtype=str)
+
+    return pops, indiv
+
+
+class _ByteRange(io.RawIOBase):
+    """Binary file limited to the bytes from its position up to ``end``"""
+
+    def __init__(self, f_handle, end: int):
+        self.f_handle, self.end = f_handle, end
+        self.name = f_handle.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = max(0, min(len(buf), self.end - self.f_handle.tell()))
+        data = self.f_handle.read(n)
+        buf[: len(data)] = data
+        return len(data)
+
+    def tell(self):
+        return self.f_handle.tell()
+
+    def close(self):
+        self.f_handle.close()
+        super().close()
+
+
+def _open_data_lines(fname: str, read_header, byte_range: Tuple[int, int] = None):
+    """Read the header of an RFMIX file, and open its data lines in text mode,
+    only those within ``byte_range`` if given
+
+    Returns:
+        ancestries, individuals and the open file
+    """
+    f_handle = open(fname, "r")
+    pops, indiv = read_header(f_handle)
+    if byte_range is not None:
+        f_handle.close()
+        f_bytes = open(fname, "rb")
+        f_bytes.seek(byte_range[0])
+        f_handle = io.TextIOWrapper(
+            io.BufferedReader(_ByteRange(f_bytes, byte_range[1]))
+        )
+    return pops, indiv, f_handle
+
+
+def _sample_columns(
+    indiv: np.ndarray, samples, n_info: int, width: int
+) -> Tuple[np.ndarray, list]:
+    """Individuals kept in file order, and the columns of the info and their
+    ``width`` values each"""
+    if samples is None:
+        return indiv, None
+    missing = np.setdiff1d(samples, indiv)
+    if missing.shape[0] > 0:
+        raise KeyError(f"Samples not in the file: {missing[:5].tolist()}")
+    index = np.flatnonzero(np.isin(indiv, samples))
+    cols = (n_info + width * index[:, None] + np.arange(width)).ravel()
+    return indiv[index], list(range(n_info)) + cols.tolist()
+
+
+def _iter_csv_chunks(
+    f_handle, n_info: int, n_col: int, dtype, chunk_size: int, usecols: list = None
+):
+    """Parse data lines with the pandas C parser, ``chunk_size`` lines at a time
+
+    | Only the columns in ``usecols`` are converted, if given, which must start
+    | with the ``n_info`` info columns.
+    """
+    if usecols is None:
+        usecols = range(n_info + n_col)
+    col_dtype = {i: dtype for i in usecols if i >= n_info}
+    col_dtype[0] = str
+    # the header lines are counted with the first chunk of a whole file, and
+    # a byte range is read from its start
+    if isinstance(getattr(f_handle.buffer, "raw", None), _ByteRange):
+        offset = f_handle.buffer.tell()
+    else:
+        offset = 0
+    try:
+        reader = pd.read_csv(
+            f_handle,
+            sep="\t",
+            header=None,
+            na_values=".",
+            dtype=col_dtype,
+            usecols=usecols,
+            chunksize=chunk_size or 1_000_000_000,
+        )
+    except pd.errors.EmptyDataError:
+        raise ValueError(f"No markers in {f_handle.name}") from None
+    for df in reader:
+        if instrument.enabled():
+            bytes_read = f_handle.buffer.tell() - offset
+            offset += bytes_read
+            instrument.progress(rows=df.shape[0], bytes_read=bytes_read)
+        yield df
+
+
+def _iter_rfmix_fb(
+    fname: str,
+    chunk_size: int = None,
+    byte_range: Tuple[int, int] = None,
+    samples=None,
+):
+    """Yield Datasets of ``chunk_size`` consecutive markers in a .fb.tsv file
+
+    | Only the lines in ``byte_range`` of the file and the columns of
+    | ``samples`` are parsed, if given.
+    """
+    pops, indiv, f_handle = _open_data_lines(fname, _read_fb_header, byte_range)
+    with f_handle:
+        n_col, n_pops = indiv.shape[0] * 2 * len(pops), len(pops)
+        indiv, usecols = _sample_columns(indiv, samples, 4, 2 * n_pops)
+        N = indiv.shape[0]
+
+        # data lines
+        # Reshape to (marker, sample, ploidy, ancestry) array, then xarray
+        for df in _iter_csv_chunks(f_handle, 4, n_col, np.float32, chunk_size, usecols):
+            LA_matrix = df.iloc[:, 4:].to_numpy(np.float32).reshape(-1, N, 2, n_pops)
+            genetic_pos = df[2].to_numpy(np.float32)
+            pos = df[1].to_numpy(np.uint32)
+
+            ds = xr.Dataset(
+                data_vars={
+                    "locanc": (["marker", "sample", "ploidy", "ancestry"], LA_matrix),
+                    "genetic_position": ("marker", genetic_pos),
+                },
+                coords={
+                    "marker": pos,
+                    "chrom": ("marker", df[0].to_numpy(str)),
+                    "sample": np.array(indiv, dtype=str),
+                    "ploidy": np.array([0, 1], dtype=np.int8),
+                    "ancestry": np.array(pops, dtype=str),
+                },
+            )
+
+            yield ds
+
+
+def _iter_rfmix_msp(
+    fname: str,
+    chunk_size: int = None,
+    one_hot: bool = True,
+    byte_range: Tuple[int, int] = None,
+    samples=None,
+):
+    """Yield Datasets of ``chunk_size`` consecutive markers in a .msp.tsv file
+
+    Without ``one_hot``, the ancestry codes are kept as ``locanc_code`` of dims
+    (marker, sample, ploidy) in place of ``locanc``. Only the lines in
+    ``byte_range`` of the file and the columns of ``samples`` are parsed, if
+    given.
+    """
+    pops, indiv, f_handle = _open_data_lines(fname, _read_msp_header, byte_range)
+    with f_handle:
+        n_col, n_pops = indiv.shape[0] * 2, len(pops)
+        indiv, usecols = _sample_columns(indiv, samples, 6, 2)
+        N = indiv.shape[0]
+
+        # data lines
+        # reshape to (marker, sample, ploidy)
+        # one hot encode to expand entry to (ancestry, )
+        for df in _iter_csv_chunks(f_handle, 6, n_col, np.uint32, chunk_size, usecols):
+            LA_matrix = df.iloc[:, 6:].to_numpy(np.uint32).reshape(-1, N, 2)
+            if one_hot:
+                locanc = (
+                    ["marker", "sample", "ploidy", "ancestry"],
+                    _kernels.one_hot(LA_matrix, n_pops),
+                )
+            else:
+                locanc = (["marker", "sample", "ploidy"], LA_matrix)
+            lpos, rpos = df[1].to_numpy(np.uint32), df[2].to_numpy(np.uint32)
+            pos = np.uint32(0.5 * (lpos.astype(np.float64) + rpos))
+
+            ds = xr.Dataset(
+                data_vars={
+                    "locanc" if one_hot else "locanc_code": locanc,
+                    "left_position": ("marker", lpos),
+                    "right_position": ("marker", rpos),
+                },
+                coords={
+                    "marker": pos,
+                    "chrom": ("marker", df[0].to_numpy(str)),
+                    "sample": np.array(indiv, dtype=str),
+                    "ploidy": np.array([0, 1], dtype=np.int8),
+                    "ancestry": np.array(pops, dtype=str),
+                },
+            )
+
+            yield ds
+
+
+def _parse_chunk_size(fname: str, read_header, itemsize: int, max_memory: int):
+    """Markers parsed at a time, planned from the header of an RFMIX file"""
+    with open(fname, "r") as f_handle:
+        pops, indiv = read_header(f_handle)
+    plan = plan_chunks(
+        "parse", indiv.shape[0], len(pops), itemsize=itemsize, max_memory=max_memory
+    )
+    return plan.marker
+
+
+@instrument.instrumented
 def read_rfmix_fb(
     fname: str,
+    chunk_size: int = None,
+    quantize: str = None,
+    max_memory: int = None,
 ) -> xr.Dataset:
     """Reader for RFMIX .fb.tsv output
 
@@ -21,6 +268,11 @@ def read_rfmix_fb(
 
     Args:
         fname: Path to RFMIX output
+        chunk_size: number of markers parsed at a time, planned from
+            ``max_memory`` by default
+        quantize: ``uint8`` or ``uint16`` to quantize probabilities chunk by
+            chunk with :func:`latool.encoding.quantize_locanc`
+        max_memory: memory budget in bytes for :mod:`latool.plan`
 
     Return:
         Dataset containing local ancestry
@@ -34,6 +286,7 @@ def read_rfmix_fb(
     Dimensions:           (marker: 8, sample: 39, ploidy: 2, ancestry: 2)
     Coordinates:
       * marker            (marker) int64 1 6 12 20 25 31 36 43
+        chrom             (marker) <U1 '1' '1' '1' '1' '1' '1' '1' '1'
       * sample            (sample) <U6 'HCB182' 'HCB190' ... 'JPT266' 'JPT267'
       * ploidy            (ploidy) int8 0 1
       * ancestry          (ancestry) <U3 'HCB' 'JPT'
@@ -43,69 +296,30 @@ def read_rfmix_fb(
 
     """
 
-    # Read ancestry line
-    f_handle = open(fname, "r")
-    comment = f_handle.readline()
-    pops = comment.strip().split("\t")[1:]
-    n_pops = len(pops)
-
-    # header line
-    # RFMIX output dim: (marker , (sample x ploidy x ancestry))
-    header = f_handle.readline()
-    indiv = list(map(lambda x: x.split(":::")[0], header.strip().split("\t")[4:]))
-    indiv = np.array(indiv[:: (2 * n_pops)], dtype=str)
-    N = indiv.shape[0]
-
-    # data lines
-    # Reshape to (marker, sample, ploidy, ancestry) array, then xarray
-    chrom = None
-    pos = []
-    genetic_pos = []
-
-    LA_matrix = []  # read into (marker by (sample x ploidy x ancestry))
-    for i, line in enumerate(f_handle):
-        if i % 100 == 0:
-            logging.info(f"processing {i}-th marker")
-
-        line_split = line.strip().split("\t")
-        LA_matrix.append(line_split[4:])
-
-        pos.append(int(line_split[1]))
-        if line_split[2] == ".":
-            genetic_pos.append(np.nan)
-        else:
-            genetic_pos.append(line_split[2])
-
-        if chrom is None:
-            chrom = int(line_split[0])
-
-    LA_matrix = np.float32(LA_matrix).reshape(-1, N, 2, n_pops)
-    genetic_pos = np.float32(genetic_pos)
-    pos = np.uint32(pos)
-
-    ds = xr.Dataset(
-        data_vars={
-            "locanc": (["marker", "sample", "ploidy", "ancestry"], LA_matrix),
-            "genetic_position": ("marker", genetic_pos),
-        },
-        coords={
-            "marker": pos,
-            "sample": np.array(indiv, dtype=str),
-            "ploidy": np.array([0, 1], dtype=np.int8),
-            "ancestry": np.array(pops, dtype=str),
-        },
-    )
-
-    return ds
+    if chunk_size is None:
+        chunk_size = _parse_chunk_size(fname, _read_fb_header, 4, max_memory)
+    ds_iter = _iter_rfmix_fb(fname, chunk_size)
+    if quantize is not None:
+        ds_iter = (quantize_locanc(ds, quantize) for ds in ds_iter)
+    return xr.concat(list(ds_iter), dim="marker")
 
 
+@instrument.instrumented
 def read_rfmix_msp(
     fname: str,
+    chunk_size: int = None,
+    packed: bool = False,
+    max_memory: int = None,
 ) -> xr.Dataset:
     """Reader for RFMIX .msp.tsv output
 
     Args:
         fname: Path to RFMIX output
+        chunk_size: number of markers parsed at a time, planned from
+            ``max_memory`` by default
+        packed: bit-pack two-way ancestry chunk by chunk with
+            :func:`latool.encoding.pack_locanc`
+        max_memory: memory budget in bytes for :mod:`latool.plan`
 
     Return:
         Dataset containing local ancestry
@@ -115,58 +329,131 @@ def read_rfmix_msp(
 
     """
 
-    # Read ancestry line
-    f_handle = open(fname, "r")
-    comment = f_handle.readline()
-    popcode = comment.strip().split(" ")[-1].split("\t")
-    pops = [pc.split("=")[0] for pc in popcode]
-    n_pops = len(pops)
+    if chunk_size is None:
+        chunk_size = _parse_chunk_size(fname, _read_msp_header, 1, max_memory)
+    ds_iter = _iter_rfmix_msp(fname, chunk_size)
+    if packed:
+        ds_iter = (pack_locanc(ds) for ds in ds_iter)
+    return xr.concat(list(ds_iter), dim="marker")
 
-    # header line
-    # RFMIX output dim: (marker by (sample x ploidy))
-    header = f_handle.readline()
-    indiv = list(map(lambda x: x[:-2], header.strip().split("\t")[6:]))
-    indiv = np.array(indiv[::2], dtype=str)
-    N = indiv.shape[0]
-
-    # data lines
-    # reshape to (marker, sample, ploidy)
-    # one hot encode to expand entry to (ancestry, )
-    chrom = None
-    lpos, rpos, pos = [], [], []
-
-    LA_matrix = []  # read into (marker by (sample x ploidy x ancestry))
-    for i, line in enumerate(f_handle):
-        if i % 100 == 0:
-            logging.info(f"processing {i}-th marker")
-
-        line_split = line.strip().split("\t")
-        LA_matrix.append(line_split[6:])
-
-        lpos.append(int(line_split[1]))
-        rpos.append(int(line_split[2]))
-        pos.append(0.5 * (rpos[-1] + lpos[-1]))
-
-        if chrom is None:
-            chrom = int(line_split[0])
-
-    LA_matrix = np.uint32(LA_matrix).reshape(-1, N, 2)
-    LA_matrix = _ohe(LA_matrix, np.zeros(n_pops).astype("uint8"))
-    lpos, rpos = np.uint32(lpos), np.uint32(rpos)
-    pos = np.uint32(pos)
-
-    ds = xr.Dataset(
-        data_vars={
-            "locanc": (["marker", "sample", "ploidy", "ancestry"], LA_matrix),
-            "left_position": ("marker", lpos),
-            "right_position": ("marker", rpos),
-        },
-        coords={
-            "marker": pos,
-            "sample": np.array(indiv, dtype=str),
-            "ploidy": np.array([0, 1], dtype=np.int8),
-            "ancestry": np.array(pops, dtype=str),
-        },
-    )
+
+def _chrom_key(chrom: str):
+    """Sort chromosomes numerically, then by name"""
+    chrom = chrom[3:] if chrom.startswith("chr") else chrom
+    return (0, int(chrom), "") if chrom.isdigit() else (1, 0, chrom)
+
+
+def _read_to_zarr(fname: str, store: str, max_memory: int = None) -> str:
+    """Stream an RFMIX file chunk by chunk into a zarr store under ``store``"""
+    if fname.endswith(".fb.tsv"):
+        iter_rfmix, read_header, itemsize = _iter_rfmix_fb, _read_fb_header, 4
+    else:
+        iter_rfmix, read_header, itemsize = _iter_rfmix_msp, _read_msp_header, 1
+    chunk_size = _parse_chunk_size(fname, read_header, itemsize, max_memory)
+
+    out = os.path.join(store, os.path.basename(fname) + ".zarr")
+    for i, ds in enumerate(iter_rfmix(fname, chunk_size)):
+        if i == 0:
+            ds.to_zarr(out, mode="w")
+        else:
+            ds.to_zarr(out, append_dim="marker")
+    return out
+
+
+def _genome_store() -> str:
+    """Temporary directory for the zarr stores of a genome, removed at exit"""
+    store = tempfile.mkdtemp(prefix="latool_genome_")
+    atexit.register(shutil.rmtree, store, ignore_errors=True)
+    _logger.info(f"Writing chromosomes to temporary zarr stores in {store}")
+    return store
+
+
+@instrument.instrumented
+def read_rfmix_genome(
+    pattern: str,
+    genetic_map: Union[str, GeneticMap] = None,
+    n_workers: int = None,
+    chunk_size: int = None,
+    max_memory: int = None,
+    store: str = None,
+) -> xr.Dataset:
+    """Reader for per-chromosome RFMIX output of a whole genome
+
+    | Files matching ``pattern`` are read in a process pool according to
+    | their suffix, annotated with genetic positions per chromosome, and
+    | concatenated along ``marker`` in chromosome order. The ``chrom``
+    | coordinate tells the chromosome of each marker.
+    | With ``chunk_size`` or ``store``, every process streams its file into a
+    | zarr store in ``store``, and the stores are opened lazily, so neither
+    | the processes nor the parent hold a whole chromosome. Otherwise files
+    | are read in memory with :func:`read_rfmix_fb` or :func:`read_rfmix_msp`.
+
+    Args:
+        pattern: glob pattern of the RFMIX .fb.tsv or .msp.tsv files
+        genetic_map: path to a genetic map or a GeneticMap, used to annotate
+            ``genetic_position``
+        n_workers: number of processes
+        chunk_size: if given, chunk the result along marker
+        max_memory: memory budget in bytes for :mod:`latool.plan`, shared by
+            the processes reading files
+        store: directory of the per-chromosome zarr stores, a temporary
+            directory removed at exit by default when ``chunk_size`` is given
+
+    Return:
+        Dataset containing local ancestry of all chromosomes
+
+    """
+    fnames = sorted(glob.glob(pattern))
+    if len(fnames) == 0:
+        raise FileNotFoundError(f"No file matches {pattern}")
+    if all(f.endswith(".fb.tsv") for f in fnames):
+        reader = read_rfmix_fb
+    elif all(f.endswith(".msp.tsv") for f in fnames):
+        reader = read_rfmix_msp
+    else:
+        raise ValueError("Files must be all .fb.tsv or all .msp.tsv")
+
+    n_workers = min(len(fnames), n_workers or os.cpu_count() or 1)
+    max_memory = parse_memory(max_memory or default_max_memory())
+    if store is None and chunk_size is not None:
+        store = _genome_store()
+    if store is not None:
+        os.makedirs(store, exist_ok=True)
+        reader = functools.partial(
+            _read_to_zarr, store=store, max_memory=max_memory // n_workers
+        )
+    else:
+        reader = functools.partial(reader, max_memory=max_memory // n_workers)
+
+    ds_list = []
+    # numba's parallel runtime is not fork-safe once kernels have run here
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+        for ds in executor.map(reader, fnames):
+            if store is not None:
+                ds = xr.open_zarr(ds)
+            instrument.progress(rows=ds.sizes["marker"])
+            ds_list.append(ds)
+
+    for fname, ds in zip(fnames, ds_list):
+        if ds.sizes["marker"] == 0:
+            raise ValueError(f"No markers in {fname}")
+    ds_list.sort(key=lambda ds: _chrom_key(str(ds["chrom"].values[0])))
+    for ds in ds_list:
+        if not np.array_equal(ds["sample"].values, ds_list[0]["sample"].values):
+            chrom = ds["chrom"].values[0]
+            raise ValueError(f"Samples of chromosome {chrom} differ from other files")
+
+    if genetic_map is not None:
+        if not isinstance(genetic_map, GeneticMap):
+            genetic_map = GeneticMap.from_file(genetic_map)
+        ds_list = [
+            genetic_distance(ds, genetic_map, str(ds["chrom"].values[0]))
+            for ds in ds_list
+        ]
+
+    ds = xr.concat(ds_list, dim="marker")
+    if chunk_size is not None:
+        ds = ds.chunk({"marker": chunk_size})
 
     return ds
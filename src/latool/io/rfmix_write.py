@@ -1,19 +1,39 @@
+import logging
+
 import pandas as pd
 import xarray as xr
 
+from .. import instrument
+from ..encoding import dense_locanc, global_ancestry
+from ..plan import _chunk_size
+from ..util import _marker_slices
+
+_logger = logging.getLogger(__name__)
+
 
+@instrument.instrumented
 def write_Q(
     ds: xr.Dataset,
     out: str,
+    chunk_size: int = None,
+    max_memory: int = None,
 ) -> pd.DataFrame:
     """Write global ancestry in rfmix.Q format
 
+    | Samples are read in blocks from the sample-major companion of
+    | :func:`open_store` when it is present.
+
     args:
-        ds: xarray Dataset containing ``locanc`` in the data_vars
+        ds: xarray Dataset containing ``locanc``, ``locanc_packed`` or
+            ``locanc_quantized`` in the data_vars
         out: output filename
+        chunk_size: number of markers decoded at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
 
     """
-    ga = ds.locanc.mean(dim=["marker", "ploidy"]).to_dataframe().reset_index()
+    chunk_size = _chunk_size("encode", ds, chunk_size, max_memory)
+    ga = global_ancestry(ds, chunk_size, max_memory).to_dataframe().reset_index()
     ga = ga.pivot(index="sample", columns="ancestry", values="locanc").reset_index()
     ga = ga.rename({"sample": "#sample"}, axis=1)
 
@@ -24,10 +44,25 @@ def write_Q(
     return ga
 
 
+@instrument.instrumented
 def write_rfmix_fb(
     ds: xr.Dataset,
     out: str,
+    chunk_size: int = None,
+    max_memory: int = None,
 ):
+    """Write local ancestry in RFMIX .fb.tsv format
+
+    args:
+        ds: xarray Dataset containing ``locanc``, ``locanc_packed`` or
+            ``locanc_quantized`` in the data_vars
+        out: output filename
+        chunk_size: number of markers computed and written at a time, planned
+            from ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    """
+    chunk_size = _chunk_size("format", ds, chunk_size, max_memory)
     samples = ds["sample"].values
     ancestries = ds["ancestry"].values
     samples_col = [
@@ -46,14 +81,20 @@ def write_rfmix_fb(
 
     header = "\n".join(header)
 
-    locanc_2d = ds["locanc"].values.reshape(ds.dims["marker"], -1)
+    da_locanc = dense_locanc(ds, chunk_size)
+    da_locanc = da_locanc.transpose("marker", "sample", "ploidy", "ancestry")
+    if "chrom" in ds.coords:
+        chrom = ds["chrom"].values
+    else:
+        chrom = ["1"] * pos.shape[0]
 
-    f = open(out, "w")
-
-    print(header, file=f)
-    for i, row in enumerate(locanc_2d):
-        if i % 10000 == 0:
-            print(f"Writing {i+1} / {pos.shape[0]} marker")
-
-        row_str = f"1\t{pos[i]}\t.\t{i}\t" + "\t".join(row.astype(str))
-        print(row_str, file=f)
+    with open(out, "w") as f:
+        print(header, file=f)
+        for s in _marker_slices(pos.shape[0], chunk_size):
+            locanc_2d = da_locanc[s].values.reshape(s.stop - s.start, -1)
+            lines = "".join(
+                f"{chrom[i]}\t{pos[i]}\t.\t{i}\t" + "\t".join(row.astype(str)) + "\n"
+                for i, row in zip(range(s.start, s.stop), locanc_2d)
+            )
+            f.write(lines)
+            instrument.progress(rows=s.stop - s.start, bytes_written=len(lines))
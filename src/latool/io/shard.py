@@ -0,0 +1,339 @@
+"""Module for sharded reading of local ancestry across processes or nodes
+
+| A read is planned by :func:`plan_shards` as independent tasks over shards
+| of samples or of the genome, written to ``plan.json`` in a directory that
+| all workers can reach. Every task is run by :func:`run_shard`, e.g. on a
+| cluster node given the directory and the task index, and writes its shard
+| to a zarr store ``shard-00000.zarr`` chunked along marker, followed by a
+| manifest ``shard-00000.json``. Manifests are moved into place once the
+| store is complete, so a task can be rerun until its manifest exists.
+| :func:`merge_shards` opens the stores lazily and concatenates them into one
+| Dataset, so no data is copied. :func:`run_shards` runs the pending tasks in
+| local processes.
+
+| Tree sequences are sharded by individuals, traced with ``keep``, or by
+| intervals of the genome, traced on the tree sequence restricted to each
+| interval, so segments are cut at the interval boundaries, which adds a
+| marker at the start of every interval. RFMIX files are sharded by samples,
+| whose columns alone are converted, or by byte ranges of whole lines, so
+| that each task reads its own part of the file.
+
+Example
+-------
+>>> from latool.io import merge_shards, plan_shards, run_shards
+>>> tasks = plan_shards("example.msp.tsv", "shards", by="region", n_shards=4)
+>>> run_shards("shards", n_workers=4)
+>>> ds = merge_shards("shards")
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+import xarray as xr
+
+from .. import instrument
+
+_logger = logging.getLogger(__name__)
+
+
+def _source_format(source: str) -> str:
+    for suffix, fmt in [(".fb.tsv", "fb"), (".msp.tsv", "msp")]:
+        if source.endswith(suffix):
+            return fmt
+    if source.endswith((".ts", ".trees")):
+        return "ts"
+    raise ValueError(f"Cannot shard {source}: not .fb.tsv, .msp.tsv or .ts")
+
+
+def _line_ranges(fname: str, n_shards: int) -> List[List[int]]:
+    """Byte ranges of about equal size of the data lines of an RFMIX file"""
+    with open(fname, "rb") as f_handle:
+        f_handle.readline()
+        f_handle.readline()
+        start = f_handle.tell()
+        size = os.fstat(f_handle.fileno()).st_size
+        bounds = [start]
+        for i in range(1, n_shards):
+            f_handle.seek(max(start + (size - start) * i // n_shards - 1, bounds[-1]))
+            f_handle.readline()
+            bounds.append(min(f_handle.tell(), size))
+    bounds.append(size)
+    return [[a, b] for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _shard_tasks(source: str, fmt: str, by: str, n_shards: int, admixpop: str):
+    """Reader arguments of every shard"""
+    if fmt == "ts":
+        import tskit
+
+        from .ts_read import _admixed_nodes
+
+        ts = tskit.load(source)
+        if by == "sample":
+            nodes = _admixed_nodes(ts, admixpop)
+            individual = ts.tables.nodes.individual[nodes]
+            groups = np.array_split(np.unique(individual), n_shards)
+            return [
+                {"keep": nodes[np.isin(individual, g)].tolist()}
+                for g in groups
+                if g.shape[0] > 0
+            ]
+        edges = ts.tables.edges
+        bounds = np.linspace(edges.left.min(), edges.right.max(), n_shards + 1)
+        return [{"interval": [a, b]} for a, b in zip(bounds[:-1], bounds[1:])]
+
+    if by == "sample":
+        from .rfmix_read import _read_fb_header, _read_msp_header
+
+        read_header = _read_fb_header if fmt == "fb" else _read_msp_header
+        with open(source) as f_handle:
+            _, indiv = read_header(f_handle)
+        groups = np.array_split(indiv, n_shards)
+        return [{"samples": g.tolist()} for g in groups if g.shape[0] > 0]
+    return [{"byte_range": r} for r in _line_ranges(source, n_shards)]
+
+
+def plan_shards(
+    source: str,
+    out_dir: str,
+    by: str = "sample",
+    n_shards: int = None,
+    admixpop: str = None,
+    ancpop: List[str] = None,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> List[dict]:
+    """Plan a sharded read and write the tasks to ``<out_dir>/plan.json``
+
+    Args:
+        source: path to a tree sequence (.ts, .trees), .fb.tsv or .msp.tsv
+        out_dir: directory of the plan, shards and manifests, reachable by
+            all workers
+        by: ``sample`` or ``region``
+        n_shards: number of shards, the number of CPUs by default
+        admixpop: population name of the admixed population of a tree sequence
+        ancpop: names of the ancestral populations of a tree sequence
+        chunk_size: number of markers per chunk of the shards, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes of every task, for
+            :mod:`latool.plan`
+
+    Returns:
+        The tasks, also found in ``plan.json``
+
+    """
+    fmt = _source_format(source)
+    if by not in ["sample", "region"]:
+        raise ValueError(f"Unknown shard {by}")
+    if fmt == "ts" and (admixpop is None or ancpop is None):
+        raise ValueError("admixpop and ancpop are required for tree sequences")
+    n_shards = n_shards or os.cpu_count() or 1
+
+    tasks = [
+        dict(
+            index=i,
+            source=os.path.abspath(source),
+            format=fmt,
+            by=by,
+            admixpop=admixpop,
+            ancpop=None if ancpop is None else list(ancpop),
+            chunk_size=chunk_size,
+            max_memory=max_memory,
+            store=f"shard-{i:05d}.zarr",
+            manifest=f"shard-{i:05d}.json",
+            **args,
+        )
+        for i, args in enumerate(_shard_tasks(source, fmt, by, n_shards, admixpop))
+    ]
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "plan.json"), "w") as f:
+        json.dump({"by": by, "tasks": tasks}, f, indent=1)
+    _logger.info(f"Planned {len(tasks)} shards by {by} of {source} in {out_dir}")
+    return tasks
+
+
+def _read_plan(out_dir: str) -> dict:
+    with open(os.path.join(out_dir, "plan.json")) as f:
+        return json.load(f)
+
+
+def _iter_shard(task: dict):
+    """Yield the Datasets of a shard, chunk by chunk"""
+    fmt = task["format"]
+    if fmt == "ts":
+        import tskit
+
+        from .ts_read import read_msp_ts
+
+        ts = tskit.load(task["source"])
+        if "interval" in task:
+            ts = ts.keep_intervals([task["interval"]], simplify=False)
+        ds = read_msp_ts(
+            ts,
+            task["admixpop"],
+            task["ancpop"],
+            keep=task.get("keep"),
+            chunk_size=task["chunk_size"],
+            max_memory=task["max_memory"],
+        )
+        if ds.sizes["marker"] > 0:
+            yield ds
+        return
+
+    from . import rfmix_read
+
+    if fmt == "fb":
+        read_header, iter_rfmix, itemsize = (
+            rfmix_read._read_fb_header,
+            rfmix_read._iter_rfmix_fb,
+            4,
+        )
+    else:
+        read_header, iter_rfmix, itemsize = (
+            rfmix_read._read_msp_header,
+            rfmix_read._iter_rfmix_msp,
+            1,
+        )
+    chunk_size = task["chunk_size"]
+    if chunk_size is None:
+        chunk_size = rfmix_read._parse_chunk_size(
+            task["source"], read_header, itemsize, task["max_memory"]
+        )
+    kwargs = {"byte_range": task.get("byte_range"), "samples": task.get("samples")}
+    yield from iter_rfmix(task["source"], chunk_size, **kwargs)
+
+
+@instrument.instrumented
+def run_shard(out_dir: str, index: int) -> dict:
+    """Run a task of ``<out_dir>/plan.json`` and write its manifest
+
+    Args:
+        out_dir: directory of the plan
+        index: index of the task
+
+    Returns:
+        The manifest of the shard
+
+    """
+    task = _read_plan(out_dir)["tasks"][index]
+    store = os.path.join(out_dir, task["store"])
+    tmp_dir = tempfile.mkdtemp(prefix=f".{task['store']}.", dir=out_dir)
+    try:
+        n_marker, n_sample = 0, 0
+        for ds in _iter_shard(task):
+            if "chrom" in ds.coords:
+                # variable-length strings, so chromosomes of any name can be appended
+                ds["chrom"] = ds["chrom"].astype(object)
+            if n_marker == 0:
+                ds.to_zarr(tmp_dir, mode="w")
+            else:
+                ds.to_zarr(tmp_dir, append_dim="marker")
+            n_marker += ds.sizes["marker"]
+            n_sample = ds.sizes["sample"]
+            instrument.progress(rows=ds.sizes["marker"])
+        if n_marker > 0:
+            shutil.rmtree(store, ignore_errors=True)
+            os.replace(tmp_dir, store)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    manifest = {
+        "index": index,
+        "store": task["store"] if n_marker > 0 else None,
+        "n_marker": n_marker,
+        "n_sample": n_sample,
+    }
+    tmp_file = os.path.join(out_dir, f".{task['manifest']}")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, os.path.join(out_dir, task["manifest"]))
+    return manifest
+
+
+def _pending(out_dir: str) -> List[int]:
+    tasks = _read_plan(out_dir)["tasks"]
+    return [
+        t["index"]
+        for t in tasks
+        if not os.path.exists(os.path.join(out_dir, t["manifest"]))
+    ]
+
+
+def run_shards(out_dir: str, n_workers: int = None) -> List[dict]:
+    """Run the tasks of ``<out_dir>/plan.json`` without a manifest in local
+    processes
+
+    Args:
+        out_dir: directory of the plan
+        n_workers: number of processes
+
+    Returns:
+        Manifests of the tasks run
+
+    """
+    pending = _pending(out_dir)
+    n_workers = max(1, min(len(pending), n_workers or os.cpu_count() or 1))
+    # numba's parallel runtime is not fork-safe once kernels have run here
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+        return list(executor.map(run_shard, [out_dir] * len(pending), pending))
+
+
+@instrument.instrumented
+def merge_shards(out_dir: str) -> xr.Dataset:
+    """Open the shards of a completed plan as one lazily loaded Dataset
+
+    | Shards by sample are concatenated along ``sample`` and shards by region
+    | along ``marker``, as dask arrays backed by the zarr stores of the shards.
+    | Shards of a tree sequence by sample are traced at different markers, so
+    | each is reindexed lazily to all markers, with the ancestry of the
+    | previous marker.
+
+    Args:
+        out_dir: directory of the plan
+
+    Returns:
+        Dataset containing local ancestry of all shards
+
+    """
+    plan = _read_plan(out_dir)
+    pending = _pending(out_dir)
+    if pending:
+        raise FileNotFoundError(f"Shards without a manifest in {out_dir}: {pending}")
+
+    ds_list = []
+    for task in plan["tasks"]:
+        with open(os.path.join(out_dir, task["manifest"])) as f:
+            manifest = json.load(f)
+        if manifest["store"] is not None:
+            ds_list.append(xr.open_zarr(os.path.join(out_dir, manifest["store"])))
+    if len(ds_list) == 0:
+        raise ValueError(f"No markers in the shards in {out_dir}")
+
+    dim, other = (
+        ("sample", "marker") if plan["by"] == "sample" else ("marker", "sample")
+    )
+    if plan["by"] == "sample" and plan["tasks"][0]["format"] == "ts":
+        # markers are the starts of the segments traced in each shard, and
+        # ancestry is constant from a marker to the next
+        marker = np.unique(np.concatenate([ds["marker"].values for ds in ds_list]))
+        ds_list = [ds.reindex(marker=marker, method="ffill") for ds in ds_list]
+    for ds in ds_list[1:]:
+        if not np.array_equal(ds[other].values, ds_list[0][other].values):
+            raise ValueError(f"Shards by {plan['by']} have different {other}s")
+    # variables along the other dims are taken from the first shard
+    return xr.concat(
+        ds_list,
+        dim=dim,
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        join="override",
+    )
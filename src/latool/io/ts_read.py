@@ -5,89 +5,96 @@ Output from software to be supported:
 
 """
 import logging
-from typing import Any, List
+from typing import Any, List, Union
 
 import msprime
 import numpy as np
-import pandas as pd
 import tskit
 import xarray as xr
 
-_logger = logging.getLogger(__name__)
-
-def _trace_anc(
-    treeseq: tskit.TreeSequence,
-    node_admixed: List[int],
-    node_ancestor: List[int],
-    ancestries: List[Any],
-) -> xr.Dataset:
-    """Trace ancestry
+from .. import instrument
+from ..encoding import pack_locanc
+from ..plan import plan_chunks
 
-    Args:
-        treeseq: Tree sequence
-        node_admixed: list of admixed node in the tree sequence
-        node_ancestor: list of ancestor node in the tree sequence at census time
-        ancestries: list of ancestry names
+_logger = logging.getLogger(__name__)
 
-    Returns:
-        Dataset containing local ancestries
 
+def _fill_block(
+    start: int,
+    stop: int,
+    seg_start: np.ndarray,
+    seg_stop: np.ndarray,
+    seg_hap: np.ndarray,
+    seg_anc: np.ndarray,
+    n_sample: int,
+    n_anc: int,
+) -> np.ndarray:
+    """One-hot ancestry of markers [start, stop) from traced segments
+
+    Segments are given as marker index ranges [seg_start, seg_stop) of a
+    haplotype ``seg_hap = 2 * sample + ploidy`` and its ancestry index
+    ``seg_anc``, -1 if not among the ancestral populations. Markers not covered
+    by any segment are NaN.
     """
-    anc_dict = {i.metadata["name"]: i.id for i in treeseq.populations()}
-    # Trace ancestor id at census time
-    locanc_tbl = treeseq.tables.link_ancestors(node_admixed, node_ancestor)
-
-    # Convert ancestors id to pop id
-    # Convert child's haplotype id to individual id
-    traced_pop = [treeseq.node(i).population for i in locanc_tbl.parent]
-    traced_indiv = [treeseq.node(i).individual for i in locanc_tbl.child]
-
-    # ploidy id: 0 if even else 1.
-    ds_dict = {
-        "Start": locanc_tbl.left,
-        "Node": locanc_tbl.child % 2,
-        "individual": traced_indiv,
-    }
-
-    # one hot encode ancestries
-    for a in ancestries:
-        ds_dict[a] = np.equal(anc_dict[a], traced_pop).astype(np.int8)
-
-    # prep dict for making xarray
-    loc_arr = pd.DataFrame(ds_dict)
-    loc_arr.columns = ["marker", "ploidy", "sample"] + ancestries
-    loc_arr = pd.melt(
-        loc_arr,
-        id_vars=["marker", "ploidy", "sample"],
-        var_name="ancestry",
-        value_vars=ancestries,
-        value_name="locanc",
+    overlap = (seg_start < stop) & (seg_stop > start)
+    left = np.maximum(seg_start[overlap], start) - start
+    right = np.minimum(seg_stop[overlap], stop) - start
+    length = right - left
+
+    # marker offsets of all cells covered by the segments
+    offset = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+    code = np.full((stop - start, 2 * n_sample), -2, dtype=np.int64)
+    code[np.repeat(left, length) + offset, np.repeat(seg_hap[overlap], length)] = (
+        np.repeat(seg_anc[overlap], length)
     )
-    loc_arr.set_index(["marker", "sample", "ploidy", "ancestry"], inplace=True)
 
-    # Convert pandas to xarray.Dataset, propagate all entry to the following nan
-    ds = xr.Dataset.from_dataframe(loc_arr)
+    locanc = (code[..., None] == np.arange(n_anc)).astype(np.float32)
+    locanc[code == -2] = np.nan
+    return locanc.reshape(stop - start, n_sample, 2, n_anc)
 
-    return ds
+
+def _admixed_nodes(ts: tskit.TreeSequence, admixpop: str) -> np.ndarray:
+    """Sample nodes at time 0 of the admixed population"""
+    return np.array(
+        [
+            i.id
+            for i in ts.nodes()
+            if ts.population(i.population).metadata["name"] == admixpop
+            and i.time == 0.0
+        ]
+    )
 
 
+@instrument.instrumented
 def read_msp_ts(
-    fname: str,
+    fname: Union[str, tskit.TreeSequence],
     admixpop: str,
     ancpop: List[str],
     keep: Any = None,
     extract: Any = None,
+    packed: bool = False,
+    chunk_size: int = None,
+    max_memory: int = None,
 ) -> xr.Dataset:
 
     """Trace ancestry in tree sequence output from msprime
 
     The ancestors and the population they belong to at the census time are traced.
+    All haplotypes are traced with one ``link_ancestors`` call, and local ancestry
+    is filled onto the markers from the traced segments, chunk by chunk when
+    ``chunk_size`` is given.
 
     Args:
-        fname: path to tree sequence
+        fname: path to tree sequence, or a loaded tree sequence
         admixpop: population name of the admixed population
         ancpop: list of names of the ancestral populations
         keep: id of admixed individuals to be included
+        packed: bit-pack two-way ancestry with
+            :func:`latool.encoding.pack_locanc`
+        chunk_size: if given, ``locanc`` is a dask array filled lazily in
+            chunks of ``chunk_size`` markers
+        max_memory: if given, ``locanc`` is filled lazily in chunks of markers
+            planned by :mod:`latool.plan` within this memory budget in bytes
 
     Returns:
         Dataset containing local ancestry
@@ -100,35 +107,39 @@ def read_msp_ts(
     ...     admixpop='ADMIX',
     ...     ancpop=['EUR', 'AFR'])
     >>> ds
-    <xarray.Dataset>
-    Dimensions:         (marker: 5, sample: 10, ploidy: 2, ancestry: 2)
+    <xarray.Dataset> Size: 944B
+    Dimensions:   (marker: 5, sample: 10, ploidy: 2, ancestry: 2)
     Coordinates:
-      * marker          (marker) uint64 15472077 15671821 15704336 15776649 15883331
-      * sample          (sample) int64 0 1 2 3 4 5 6 7 8 9
-      * ploidy          (ploidy) int64 0 1
-      * ancestry        (ancestry) object 'AFR' 'EUR'
+      * marker    (marker) float64 40B 1.53e+07 1.565e+07 ... 1.571e+07 1.584e+07
+      * sample    (sample) object 80B 'indiv0' 'indiv1' ... 'indiv8' 'indiv9'
+      * ploidy    (ploidy) int32 8B 0 1
+      * ancestry  (ancestry) object 16B 'AFR' 'EUR'
     Data variables:
-        locanc          (marker, sample, ploidy, ancestry) float32 1.0 0.0 ... 0.0
-        left_position   (marker) uint64 15295879 15648276 15695366 15713306 15839992
-        right_position  (marker) uint64 15648276 15695366 15713306 15839992 15926670
+        locanc    (marker, sample, ploidy, ancestry) float32 800B 1.0 0.0 ... 0.0
+    >>> ds["marker"].values
+    array([15295879., 15648276., 15695366., 15713306., 15839992.])
+
+    Markers are the left ends of the traced segments. With ``chunk_size``,
+    the same ``locanc`` is a dask array filled on compute
+
+    >>> ds = read_msp_ts(
+    ...     fname="tests/testdata/example.ts",
+    ...     admixpop='ADMIX',
+    ...     ancpop=['EUR', 'AFR'],
+    ...     chunk_size=2)
+    >>> ds["locanc"].chunks[0]
+    (2, 2, 1)
 
     """
 
-    ts = tskit.load(fname)
+    ts = fname if isinstance(fname, tskit.TreeSequence) else tskit.load(fname)
     ancpop = list(ancpop)
 
     # nodes to be traced
-    node_admixed = np.array(
-        [
-            i.id
-            for i in ts.nodes()
-            if ts.population(i.population).metadata["name"] == admixpop
-            and i.time == 0.0
-        ]
-    )
+    node_admixed = _admixed_nodes(ts, admixpop)
 
     if keep is not None:
-        node_admixed = node_admixed[np.in1d(node_admixed, keep)]
+        node_admixed = node_admixed[np.isin(node_admixed, keep)]
 
     _logger.info(f"Number of admixed individuals kept: {len(node_admixed)//2}")
     node_ancestor = [i.id for i in ts.nodes() if i.flags == msprime.NODE_IS_CEN_EVENT]
@@ -138,50 +149,79 @@ def read_msp_ts(
     if len(node_ancestor) == 0:
         raise RuntimeError("No Census event found: No ancestors can be traced")
 
-    def indiv_batch_generator(nodes, size=20):
-        n = len(nodes)
-        for left in range(0, n, size):
-            right = min(left + size, n)
-            yield nodes[left:right]
-
-    xarr_list = []
-    for idx, batch in enumerate(indiv_batch_generator(node_admixed)):
-        if idx % 10 == 0:
-            _logger.info(f"tracing {idx+1}-th batch of {len(batch)//2} individuals")
-        xarr_list.append(
-            _trace_anc(
-                treeseq=ts,
-                node_admixed=batch,
-                node_ancestor=node_ancestor,
-                ancestries=ancpop,
-            )
+    # Trace ancestor id at census time, as segments of the admixed haplotypes
+    edges = ts.tables.link_ancestors(node_admixed, node_ancestor)
+    nodes = ts.tables.nodes
+    instrument.progress(rows=len(node_admixed) // 2)
+
+    # markers are the starts of traced segments, as in the per-sample tables
+    marker = np.unique(edges.left)
+    seg_start = np.searchsorted(marker, edges.left)
+    seg_stop = np.searchsorted(marker, edges.right)
+
+    # haplotype index from individual, ploidy id: 0 if even else 1
+    individual = nodes.individual[node_admixed]
+    sample_id = np.unique(individual)
+    seg_hap = 2 * np.searchsorted(sample_id, nodes.individual[edges.child])
+    seg_hap += edges.child % 2
+
+    # ancestry index of the population of the ancestor
+    ancestries = np.array(sorted(ancpop), dtype=object)
+    pop_anc = np.array(
+        [
+            ancestries.tolist().index(name) if name in ancpop else -1
+            for name in (pop.metadata["name"] for pop in ts.populations())
+        ]
+    )
+    seg_anc = pop_anc[nodes.population[edges.parent]]
+
+    M, N, A = marker.shape[0], sample_id.shape[0], len(ancpop)
+    fill_args = (seg_start, seg_stop, seg_hap, seg_anc, N, A)
+    if chunk_size is None and max_memory is not None:
+        chunk_size = plan_chunks("trace", N, A, M, max_memory=max_memory).marker
+    if chunk_size is None:
+        locanc = _fill_block(0, M, *fill_args)
+    else:
+        import dask.array
+
+        index = dask.array.arange(M, chunks=chunk_size)
+        locanc = dask.array.map_blocks(
+            lambda idx: _fill_block(idx[0], idx[-1] + 1, *fill_args),
+            index,
+            new_axis=[1, 2, 3],
+            chunks=(index.chunks[0], (N,), (2,), (A,)),
+            dtype=np.float32,
         )
-    if extract is not None:
-        _logger.info(f"Extracting markers to keep")
-        for di, _ in enumerate(xarr_list):
-            xarr_list[di] = xarr_list[di].ffill(dim='marker')
-            xarr_list[di] = xarr_list[di].sel(marker=extract, method='ffill')
-            xarr_list[di]['marker'] = extract
-
-    _logger.info(f"Stacking bataches")
-    xarr_ = xr.concat(xarr_list, dim="sample")
-    # xarr_ = laxr_simplify(xarr_)
 
+    xarr_ = xr.Dataset(
+        data_vars={"locanc": (["marker", "sample", "ploidy", "ancestry"], locanc)},
+        coords={
+            "marker": marker,
+            "sample": np.array([f"indiv{s:d}" for s in sample_id], dtype=object),
+            "ploidy": np.array([0, 1], dtype=np.int32),
+            "ancestry": ancestries,
+        },
+    )
+    # markers not covered by a segment keep the ancestry of the previous marker
     xarr_ = xarr_.ffill(dim="marker")
 
-    rmost_pos = ts.sequence_length
-    lpos = np.uint(xarr_.marker.values)
-    rpos = np.append(xarr_.marker.values[1:], rmost_pos).astype(np.uint)
+    if extract is not None:
+        _logger.info(f"Extracting markers to keep")
+        xarr_ = xarr_.sel(marker=extract, method="ffill")
+        xarr_["marker"] = extract
 
     # set marker to mid(lpos, rpos). Annotate left pos and right pos.
     # xarr_["marker"] = np.uint(0.5 * (lpos + rpos))
     # xarr_["left_position"] = ("marker", lpos)
     # xarr_["right_position"] = ("marker", rpos)
-    xarr_['sample'] = np.array([f"indiv{s:d}" for s in xarr_['sample']], dtype=object)
+
+    if packed:
+        xarr_ = pack_locanc(xarr_)
 
     return xarr_
 
 
+@instrument.instrumented
 def read_msp_mutations(
     fname: str,
     admixpop: str,
@@ -201,7 +241,7 @@ def read_msp_mutations(
         ]
     )
     if keep is not None:
-        node_admixed = node_admixed[np.in1d(node_admixed, keep)]
+        node_admixed = node_admixed[np.isin(node_admixed, keep)]
 
     sample_id = [ ts.node(node_admixed[i]).individual for i in range(0, len(node_admixed), 2)]
     sample = np.array([f"indiv{s:d}" for s in sample_id], dtype=object)
@@ -0,0 +1,238 @@
+import gzip
+import logging
+import re
+from typing import Iterator, List
+
+import numpy as np
+import xarray as xr
+
+from .. import _kernels, instrument
+from ..plan import plan_chunks
+
+_logger = logging.getLogger(__name__)
+
+# fewest bytes read at a time
+_BLOCK_BYTES = 1 << 20
+
+
+def _open(fname: str):
+    """Open plain or (b)gzip-compressed VCF in binary mode"""
+    with open(fname, "rb") as f_handle:
+        magic = f_handle.read(2)
+    return gzip.open(fname, "rb") if magic == b"\x1f\x8b" else open(fname, "rb")
+
+
+def _read_la_vcf_header(f_handle):
+    """Read ancestries, samples and FORMAT ids from the VCF header
+
+    | Ancestries are read from the ``##ANCESTRY=<AFR=0,EUR=1>`` line written by
+    | FLARE.
+    """
+    pops, formats = None, set()
+    for line in f_handle:
+        line = line.decode().rstrip("\r\n")
+        if line.startswith("##ANCESTRY=<"):
+            codes = dict(
+                item.split("=") for item in line[len("##ANCESTRY=<") : -1].split(",")
+            )
+            pops = sorted(codes, key=lambda a: int(codes[a]))
+        elif line.startswith("##FORMAT=<ID="):
+            formats.add(line[len("##FORMAT=<ID=") :].split(",")[0])
+        elif line.startswith("#CHROM"):
+            indiv = np.array(line.split("\t")[9:], dtype=str)
+            break
+    else:
+        raise ValueError("No #CHROM header line in the VCF")
+    if pops is None:
+        raise ValueError("No ##ANCESTRY header line in the VCF")
+    return pops, indiv, formats
+
+
+def _parse_region(region: str):
+    """(chrom, start, end) of ``chrom``, ``chrom:start`` or ``chrom:start-end``"""
+    match = re.fullmatch(r"([^:]+)(?::([\d,]+)(?:-([\d,]+))?)?", region)
+    if match is None:
+        raise ValueError(f"Invalid region {region}")
+    chrom, start, end = match.groups()
+    start = int(start.replace(",", "")) if start else 0
+    end = int(end.replace(",", "")) if end else np.iinfo(np.int64).max
+    return chrom, start, end
+
+
+def _iter_line_blocks(f_handle, chunk_size: int) -> Iterator[np.ndarray]:
+    """Yield uint8 arrays of ``chunk_size`` complete lines, the last one shorter"""
+    buf, block_bytes = b"", _BLOCK_BYTES
+    while True:
+        data = f_handle.read(block_bytes)
+        buf += data
+        if not data and buf and not buf.endswith(b"\n"):
+            buf += b"\n"
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        ends = np.flatnonzero(arr == ord("\n")) + 1
+
+        # complete chunks, and the remaining lines at the end of the file
+        bounds = ends[chunk_size - 1 :: chunk_size]
+        if not data and ends.shape[0] % chunk_size:
+            bounds = np.append(bounds, arr.shape[0])
+        start = 0
+        for end in bounds:
+            yield arr[start:end]
+            start = end
+        if not data:
+            return
+
+        buf = buf[start:]
+        if ends.shape[0] > 0:
+            # read about a chunk at once, once the length of a line is known
+            line_bytes = ends[-1] / ends.shape[0]
+            block_bytes = max(_BLOCK_BYTES, int(line_bytes * chunk_size))
+
+
+def _iter_la_vcf(
+    fname: str,
+    chunk_size: int = None,
+    samples: List[str] = None,
+    region: str = None,
+    posterior: bool = None,
+    one_hot: bool = True,
+    max_memory: int = None,
+) -> Iterator[xr.Dataset]:
+    """Yield Datasets of ``chunk_size`` consecutive markers in a VCF"""
+    with _open(fname) as f_handle:
+        pops, indiv, formats = _read_la_vcf_header(f_handle)
+        if posterior is None:
+            posterior = {"ANP1", "ANP2"} <= formats
+
+        # output index of every sample column
+        out_col = np.arange(indiv.shape[0])
+        if samples is not None:
+            samples = np.asarray(samples, dtype=str)
+            index = {s: i for i, s in enumerate(indiv)}
+            missing = [s for s in samples if s not in index]
+            if missing:
+                raise KeyError(f"Samples not in the VCF: {missing[:5]}")
+            out_col = np.full(indiv.shape[0], -1)
+            out_col[[index[s] for s in samples]] = np.arange(samples.shape[0])
+            indiv = samples
+
+        if chunk_size is None:
+            itemsize = 4 if posterior else 1
+            chunk_size = plan_chunks(
+                "parse",
+                indiv.shape[0],
+                len(pops),
+                itemsize=itemsize,
+                max_memory=max_memory,
+            ).marker
+        region = _parse_region(region) if region is not None else None
+
+        found = False
+        for block in _iter_line_blocks(f_handle, chunk_size):
+            parsed = _kernels.parse_la_vcf(block, out_col, len(pops), posterior, region)
+            malformed = np.flatnonzero(parsed.status == 2)
+            if malformed.shape[0] > 0:
+                start = parsed.starts[malformed[0]]
+                line = block[start : start + 60].tobytes().decode(errors="replace")
+                raise ValueError(f"Malformed local ancestry in VCF line: {line}")
+
+            # chromosome names are decoded once per run of lines
+            run = np.cumsum(parsed.chrom_new) - 1
+            first = parsed.starts[parsed.chrom_new]
+            names = np.array(
+                [
+                    block[s : s + np.argmax(block[s:] == ord("\t"))].tobytes().decode()
+                    for s in first
+                ],
+                dtype=str,
+            )
+
+            keep = parsed.status == 0
+            instrument.progress(rows=int(keep.sum()), bytes_read=block.shape[0])
+            if not keep.any():
+                # a sorted VCF has no more lines in the region
+                if found:
+                    break
+                continue
+            found = True
+
+            codes = parsed.codes[keep]
+            if posterior:
+                locanc = (
+                    ["marker", "sample", "ploidy", "ancestry"],
+                    parsed.probs[keep],
+                )
+            elif one_hot:
+                locanc = (
+                    ["marker", "sample", "ploidy", "ancestry"],
+                    _kernels.one_hot(codes, len(pops)),
+                )
+            else:
+                if codes.size and codes.max() >= len(pops):
+                    raise ValueError(f"Ancestry codes must be in [0, {len(pops)})")
+                locanc = (["marker", "sample", "ploidy"], codes)
+
+            yield xr.Dataset(
+                data_vars={
+                    "locanc" if posterior or one_hot else "locanc_code": locanc,
+                },
+                coords={
+                    "marker": parsed.pos[keep].astype(np.uint32),
+                    "chrom": ("marker", names[run[keep]]),
+                    "sample": np.array(indiv, dtype=str),
+                    "ploidy": np.array([0, 1], dtype=np.int8),
+                    "ancestry": np.array(pops, dtype=str),
+                },
+            )
+
+            # stop after the region, once lines past its end are skipped
+            if region is not None and parsed.status[-1] == 1:
+                break
+
+
+@instrument.instrumented
+def read_la_vcf(
+    fname: str,
+    samples: List[str] = None,
+    region: str = None,
+    posterior: bool = None,
+    one_hot: bool = True,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Reader for local ancestry in VCF, as written by FLARE
+
+    | Ancestry calls of each haplotype are read from the ``AN1`` and ``AN2``
+    | FORMAT fields, and posteriors from ``ANP1`` and ``ANP2``, with the
+    | ancestries named by the ``##ANCESTRY=<AFR=0,EUR=1>`` header line. Lines
+    | are parsed ``chunk_size`` markers at a time by a compiled kernel working
+    | on the raw bytes, so no Python object is created per genotype field.
+    | Columns of samples that are not selected are skipped, and so are lines
+    | outside ``region``. Reading stops at the end of the region, assuming
+    | the VCF is sorted. Plain and bgzip-compressed files are supported.
+
+    Args:
+        fname: Path to the VCF
+        samples: samples to read, in this order. All samples by default
+        region: ``chrom``, ``chrom:start`` or ``chrom:start-end`` with 1-based
+            inclusive positions
+        posterior: read posteriors as float32 ``locanc``, like
+            :func:`read_rfmix_fb`. By default, if ``ANP1`` and ``ANP2`` are
+            declared in the header
+        one_hot: without posteriors, one-hot encode the calls to ``locanc``
+            like :func:`read_rfmix_msp`, or keep ancestry codes of dims
+            (marker, sample, ploidy) as ``locanc_code``
+        chunk_size: number of markers parsed at a time, planned from
+            ``max_memory`` by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Return:
+        Dataset containing local ancestry
+
+    """
+    ds_iter = _iter_la_vcf(
+        fname, chunk_size, samples, region, posterior, one_hot, max_memory
+    )
+    ds_list = list(ds_iter)
+    if len(ds_list) == 0:
+        raise ValueError(f"No markers in {fname}" + (f" {region}" if region else ""))
+    return xr.concat(ds_list, dim="marker")
@@ -0,0 +1,262 @@
+"""Module for planning chunk sizes within a memory budget
+
+| Readers, writers, encodings and statistics process local ancestry in
+| blocks of markers. Without an explicit ``chunk_size``, they ask
+| :func:`plan_chunks` for the largest blocks whose working memory fits in
+| ``max_memory``, from the shape and dtype of the input and a per-operation
+| estimate of the temporaries held per (sample, ploidy, ancestry) cell. If
+| not even a few markers of all samples fit, blocks are split along
+| ``sample`` as well, for operations that support it.
+
+| The budget defaults to 1 GiB, or ``LATOOL_MAX_MEMORY`` in the environment,
+| e.g. ``LATOOL_MAX_MEMORY=4G``. Plans are logged at DEBUG level.
+
+Example
+-------
+>>> from latool.plan import plan_chunks
+>>> plan = plan_chunks("reduce", n_sample=1000, n_ancestry=3, max_memory="64M")
+>>> plan.marker, plan.sample
+(399, 1000)
+>>> print(plan)
+reduce: 399 markers x 1000 samples per chunk, 63.9 MB of 64.0 MB with 1 worker
+"""
+
+import logging
+import os
+import re
+from typing import NamedTuple, Union
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_MEMORY = 2**30
+
+# fewest markers per chunk before chunks are split along sample
+MIN_MARKER = 16
+
+# working bytes per (sample, ploidy, ancestry) cell of a marker, on top of the
+# input block, and whether the operation can work on a subset of samples
+_OPERATIONS = {
+    # text, float64 columns of the pandas parser and the reshaped output
+    "parse": (48, False),
+    # float32 output of traced segments
+    "trace": (4, False),
+    # one decoded copy of the block
+    "encode": (8, False),
+    # contiguous byte rows compared with the previous marker
+    "compare": (4, False),
+    # float32 dosage summed over ploidy and its pgen encoding
+    "dosage": (8, False),
+    # text of .fb.tsv lines
+    "format": (32, False),
+    # float64 working copies of a block
+    "reduce": (24, False),
+    # two float64 tiles of samples multiplied together
+    "tile": (16, True),
+}
+
+
+class ChunkPlan(NamedTuple):
+    """Chunk sizes of an operation
+
+    Args:
+        operation: one of ``parse``, ``trace``, ``encode``, ``compare``,
+            ``dosage``, ``format``, ``reduce`` and ``tile``
+        marker: number of markers per chunk
+        sample: number of samples per chunk
+        n_sample: number of samples of the input
+        bytes_per_marker: estimated working bytes of one marker of all samples
+        max_memory: memory budget in bytes
+        n_workers: number of chunks processed at the same time
+
+    """
+
+    operation: str
+    marker: int
+    sample: int
+    n_sample: int
+    bytes_per_marker: int
+    max_memory: int
+    n_workers: int = 1
+
+    @property
+    def memory(self) -> int:
+        """Estimated peak working memory in bytes"""
+        fraction = self.sample / max(self.n_sample, 1)
+        return int(self.marker * fraction * self.bytes_per_marker * self.n_workers)
+
+    @property
+    def chunks(self) -> dict:
+        """Chunks along ``marker`` and ``sample`` for ``Dataset.chunk``"""
+        return {"marker": self.marker, "sample": self.sample}
+
+    def __str__(self):
+        return (
+            f"{self.operation}: {self.marker} markers x {self.sample} samples "
+            f"per chunk, {self.memory / 2**20:.1f} MB of "
+            f"{self.max_memory / 2**20:.1f} MB with {self.n_workers} "
+            f"worker{'s' if self.n_workers > 1 else ''}"
+        )
+
+
+def parse_memory(memory: Union[str, int]) -> int:
+    """Parse memory size like ``512M`` or ``4G`` to bytes
+
+    Args:
+        memory: size with an optional K, M, G or T suffix, or bytes as int
+
+    Returns:
+        Number of bytes
+
+    """
+    if isinstance(memory, int):
+        return memory
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)B?", memory.strip().upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size {memory}")
+    unit = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}[match.group(2)]
+    return int(float(match.group(1)) * unit)
+
+
+def default_max_memory() -> int:
+    """Memory budget from ``LATOOL_MAX_MEMORY``, or :data:`DEFAULT_MAX_MEMORY`"""
+    memory = os.environ.get("LATOOL_MAX_MEMORY")
+    return DEFAULT_MAX_MEMORY if memory is None else parse_memory(memory)
+
+
+def plan_chunks(
+    operation: str,
+    n_sample: int,
+    n_ancestry: int,
+    n_marker: int = None,
+    n_ploidy: int = 2,
+    itemsize: float = 4,
+    max_memory: Union[str, int] = None,
+    n_workers: int = None,
+) -> ChunkPlan:
+    """Plan chunk sizes of an operation within a memory budget
+
+    Args:
+        operation: kind of work done on every chunk, see :class:`ChunkPlan`
+        n_sample: number of samples
+        n_ancestry: number of ancestries
+        n_marker: number of markers, if known, to cap the marker chunk
+        n_ploidy: number of haplotypes per sample
+        itemsize: bytes per (sample, ploidy, ancestry) cell of the input, e.g.
+            4 for float32, 1 for uint8 and 1 / 64 for bit-packed two-way
+            ancestry
+        max_memory: memory budget in bytes or as ``4G``, shared by all workers.
+            :func:`default_max_memory` by default
+        n_workers: number of chunks processed at the same time
+
+    Returns:
+        ChunkPlan
+
+    """
+    if operation not in _OPERATIONS:
+        raise ValueError(f"Unknown operation {operation}")
+    working, split_sample = _OPERATIONS[operation]
+    if max_memory is None:
+        max_memory = default_max_memory()
+    max_memory = parse_memory(max_memory)
+    n_workers = n_workers or 1
+
+    n_cell = max(n_sample, 1) * n_ploidy * max(n_ancestry, 1)
+    bytes_per_marker = max(1, int(n_cell * (itemsize + working)))
+    budget = max_memory // n_workers
+
+    marker, sample = max(1, budget // bytes_per_marker), n_sample
+    if marker < MIN_MARKER and split_sample:
+        marker = MIN_MARKER
+        bytes_per_sample = bytes_per_marker / max(n_sample, 1)
+        sample = min(n_sample, max(1, int(budget // (marker * bytes_per_sample))))
+    if n_marker is not None:
+        marker = max(1, min(marker, n_marker))
+
+    plan = ChunkPlan(
+        operation, marker, sample, n_sample, bytes_per_marker, max_memory, n_workers
+    )
+    if plan.memory > max_memory:
+        _logger.warning(f"Chunks exceed the memory budget. {plan}")
+    else:
+        _logger.debug(plan)
+    return plan
+
+
+def _input_shape(ds):
+    """Samples, ancestries, markers and bytes per cell of local ancestry"""
+    sizes = ds.sizes
+    n_sample = sizes.get("sample", 1)
+    n_ancestry = sizes.get("ancestry", 1)
+    n_ploidy = sizes.get("ploidy", 2 if "ancestry" in sizes else 1)
+    n_marker = sizes.get("marker")
+
+    if hasattr(ds, "data_vars"):
+        for name in ["locanc", "locanc_quantized", "locanc_packed", "genotype"]:
+            if name in ds.data_vars:
+                data = ds[name]
+                break
+        else:
+            raise KeyError("No local ancestry data_vars is found in the dataset")
+    else:
+        data = ds
+    n_cell = max(n_sample * n_ploidy * n_ancestry, 1)
+    itemsize = data.nbytes / max(n_marker or 1, 1) / n_cell
+    return n_sample, n_ancestry, n_marker, n_ploidy, itemsize
+
+
+def plan_dataset(
+    operation: str,
+    ds,
+    max_memory: Union[str, int] = None,
+    n_workers: int = None,
+) -> ChunkPlan:
+    """Plan chunk sizes of an operation on a Dataset or DataArray
+
+    Args:
+        operation: kind of work done on every chunk, see :class:`ChunkPlan`
+        ds: Dataset containing ``locanc``, ``locanc_quantized``,
+            ``locanc_packed`` or ``genotype``, or a DataArray with dims among
+            ``marker``, ``sample``, ``ploidy`` and ``ancestry``
+        max_memory: memory budget in bytes or as ``4G``
+        n_workers: number of chunks processed at the same time
+
+    Returns:
+        ChunkPlan
+
+    """
+    n_sample, n_ancestry, n_marker, n_ploidy, itemsize = _input_shape(ds)
+    return plan_chunks(
+        operation,
+        n_sample,
+        n_ancestry,
+        n_marker,
+        n_ploidy,
+        itemsize,
+        max_memory,
+        n_workers,
+    )
+
+
+def _chunk_size(
+    operation: str,
+    ds,
+    chunk_size: int = None,
+    max_memory: Union[str, int] = None,
+    n_workers: int = None,
+) -> int:
+    """``chunk_size`` if given, otherwise the planned markers per chunk"""
+    if chunk_size is not None:
+        return chunk_size
+    return plan_dataset(operation, ds, max_memory, n_workers).marker
+
+
+def _sample_block(
+    operation: str,
+    ds,
+    max_memory: Union[str, int] = None,
+) -> int:
+    """Samples per block of a pass over all markers of a sample-major layout"""
+    plan = plan_dataset(operation, ds, max_memory)
+    n_marker = max(ds.sizes.get("marker", 1), 1)
+    bytes_per_sample = plan.bytes_per_marker * n_marker / max(plan.n_sample, 1)
+    return min(plan.n_sample, max(1, int(plan.max_memory // bytes_per_sample)))
@@ -1,14 +1,29 @@
+import logging
+from typing import Tuple
+
 import numpy as np
 import xarray as xr
 
+from .. import instrument
+from ..encoding import packed_corrcoef
+from ..plan import _chunk_size
+from ..util import _marker_slices
+
+_logger = logging.getLogger(__name__)
+
 
+@instrument.instrumented
 def empirical_LAD(
     da_locanc: xr.DataArray,
 ) -> xr.DataArray:
     """Compute empirical local ancestry linkage disequilibrium
 
     Args:
-        da_locanc: DataArray storing the local ancestry dosage
+        da_locanc: DataArray storing the local ancestry dosage, e.g. from
+            :func:`latool.encoding.ancestry_dosage`, or
+            ``locanc_packed`` from :func:`latool.encoding.pack_locanc`, whose
+            dosage is correlated with popcounts of the packed words. A
+            dask-backed dosage gives a lazy matrix
 
 
     Returns:
@@ -16,9 +31,18 @@ def empirical_LAD(
 
     """
 
+    if "word" in da_locanc.dims:
+        corr = packed_corrcoef(da_locanc)
+    elif da_locanc.chunks is not None:
+        import dask.array
+
+        corr = dask.array.corrcoef(da_locanc.data)
+    else:
+        corr = np.corrcoef(da_locanc.values)
+
     lad = xr.DataArray(
         name="Empirical LAD",
-        data=np.corrcoef(da_locanc.values),
+        data=corr,
         dims=["marker1", "marker2"],
         coords={
             "marker1": da_locanc.marker.values,
@@ -29,6 +53,7 @@ def empirical_LAD(
     return lad
 
 
+@instrument.instrumented
 def theoretical_LAD(
     approx: bool =True,
     genetic_map: xr.DataArray=None,
@@ -63,3 +88,139 @@ def theoretical_LAD(
     )
 
     return lad
+
+
+def _standardized_block(x: np.ndarray) -> np.ndarray:
+    """Standardize rows so that ``Z @ Z.T`` is the correlation matrix"""
+    x = x.reshape(x.shape[0], -1).astype(np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+    sd = np.sqrt((x**2).sum(axis=1, keepdims=True))
+    # monomorphic markers do not contribute to the spectrum
+    return np.divide(x, sd, out=np.zeros_like(x), where=sd > 0)
+
+
+def _gram_matmul(
+    da_locanc: xr.DataArray,
+    omega: np.ndarray,
+    chunk_size: int,
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Compute ``Z.T @ Z @ omega`` and ``(Z @ omega).T @ (Z @ omega)`` by marker blocks
+
+    Also returns the number of polymorphic markers, i.e. the trace of ``Z @ Z.T``
+    """
+    ztz_omega = np.zeros_like(omega)
+    t = np.zeros((omega.shape[1], omega.shape[1]))
+    trace = 0
+    for s in _marker_slices(da_locanc.shape[0], chunk_size):
+        z = _standardized_block(da_locanc[s].values)
+        z_omega = z @ omega
+        ztz_omega += z.T @ z_omega
+        t += z_omega.T @ z_omega
+        trace += int(np.count_nonzero(z.any(axis=1)))
+        instrument.progress(rows=s.stop - s.start)
+    return ztz_omega, t, trace
+
+
+@instrument.instrumented
+def LAD_eigvals(
+    da_locanc: xr.DataArray,
+    k: int = 100,
+    n_oversamples: int = 10,
+    n_iter: int = 4,
+    chunk_size: int = None,
+    max_memory: int = None,
+    seed: int = None,
+) -> xr.DataArray:
+    """Estimate the leading eigenvalues of the empirical LAD matrix
+
+    | The marker by marker correlation matrix is never formed. Its nonzero
+    | eigenvalues are shared with the sample by sample Gram matrix, which is
+    | sketched with randomized subspace iteration. Each iteration is a single
+    | pass over marker blocks, so the cost is O(M N (k + n_oversamples)) and
+    | only one block of ``da_locanc`` is in memory at a time.
+
+    Args:
+        da_locanc: DataArray storing the local ancestry dosage, with ``marker``
+            as the first dimension. The lazy output of
+            :func:`latool.encoding.ancestry_dosage` is decoded block by block
+        k: number of leading eigenvalues to return
+        n_oversamples: extra random vectors used to improve the estimate
+        n_iter: number of power iterations
+        chunk_size: number of markers per block, planned from ``max_memory`` by
+            default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+        seed: seed of the random test matrix
+
+    Returns:
+        Leading eigenvalues in descending order. The trace of the LAD matrix,
+        i.e. the number of polymorphic markers, is stored in ``attrs["trace"]``
+
+    """
+    chunk_size = _chunk_size("reduce", da_locanc, chunk_size, max_memory)
+    da_locanc = da_locanc.transpose("marker", ...)
+    n_col = int(np.prod(da_locanc.shape[1:]))
+    rank = min(k + n_oversamples, n_col)
+
+    rng = np.random.default_rng(seed)
+    q = rng.standard_normal((n_col, rank))
+    for _ in range(n_iter + 1):
+        q, _ = np.linalg.qr(q)
+        q, _, _ = _gram_matmul(da_locanc, q, chunk_size)
+    # Rayleigh-Ritz on the last orthonormal basis
+    q, _ = np.linalg.qr(q)
+    _, t, trace = _gram_matmul(da_locanc, q, chunk_size)
+
+    eigvals = np.linalg.eigvalsh(t)[::-1][:k]
+    eigvals = np.clip(eigvals, 0, None)
+
+    return xr.DataArray(
+        name="LAD eigenvalues",
+        data=eigvals,
+        dims=["component"],
+        attrs={"trace": trace},
+    )
+
+
+@instrument.instrumented
+def effective_tests(
+    eigvals: xr.DataArray,
+    alpha: float = 0.05,
+    method: str = "liji",
+    fraction: float = 0.995,
+) -> Tuple[float, float]:
+    """Effective number of independent tests and significance threshold
+
+    | ``liji``: Li and Ji (2005), sum of I(l >= 1) + (l - floor(l)). Eigenvalues
+    | not returned by :func:`LAD_eigvals` are all below 1, so their total is
+    | recovered from the trace.
+    | ``simpleM``: number of leading eigenvalues explaining ``fraction`` of the
+    | variance (Gao et al. 2008).
+
+    Args:
+        eigvals: output of :func:`LAD_eigvals`
+        alpha: family-wise error rate
+        method: ``liji`` or ``simpleM``
+        fraction: proportion of variance explained for ``simpleM``
+
+    Returns:
+        Effective number of tests and the per-test significance threshold
+
+    """
+    lam = np.asarray(eigvals.values, dtype=np.float64)
+    trace = eigvals.attrs["trace"]
+
+    if method == "liji":
+        if lam[-1] >= 1:
+            _logger.warning("Smallest estimated eigenvalue >= 1; increase k")
+        head = np.sum((lam >= 1) + (lam - np.floor(lam)))
+        meff = head + max(trace - lam.sum(), 0.0)
+    elif method == "simpleM":
+        explained = np.cumsum(lam) / trace
+        if explained[-1] < fraction:
+            _logger.warning(f"Eigenvalues explain {explained[-1]:.3f} < {fraction}")
+        meff = min(np.searchsorted(explained, fraction) + 1, lam.shape[0])
+    else:
+        raise ValueError(f"Unknown method {method}")
+
+    meff = float(meff)
+    return meff, alpha / meff
@@ -1,6 +1,52 @@
-from .LAD import *
+"""Statistics of local ancestry
+
+Submodules are imported on first access, so that e.g. computing LAD does not
+import scipy.
+"""
+
+import importlib
+
+_SUBMODULE = {
+    "empirical_LAD": "LAD",
+    "theoretical_LAD": "LAD",
+    "LAD_eigvals": "LAD",
+    "effective_tests": "LAD",
+    "admixture_scan": "scan",
+    "ancestry_allele_freq": "freq",
+    "ancestry_tracts": "tracts",
+    "tract_length_histogram": "tracts",
+    "admixture_time": "tracts",
+    "ancestry_sharing": "sharing",
+    "AncestryIndex": "window",
+    "summary_stats": "summary",
+    "merge_summary": "summary",
+    "summary_LAD": "summary",
+}
 
 __all__ = [
     "empirical_LAD",
     "theoretical_LAD",
+    "LAD_eigvals",
+    "effective_tests",
+    "admixture_scan",
+    "ancestry_allele_freq",
+    "ancestry_tracts",
+    "tract_length_histogram",
+    "admixture_time",
+    "ancestry_sharing",
+    "AncestryIndex",
+    "summary_stats",
+    "merge_summary",
+    "summary_LAD",
 ]
+
+
+def __getattr__(name):
+    if name in _SUBMODULE:
+        module = importlib.import_module(f".{_SUBMODULE[name]}", __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,79 @@
+"""Module for ancestry-specific allele frequencies"""
+
+import numpy as np
+import xarray as xr
+
+from .. import instrument
+from ..plan import _chunk_size
+from ..util import _marker_slices
+
+
+@instrument.instrumented
+def ancestry_allele_freq(
+    ds_gt: xr.Dataset,
+    ds_locanc: xr.Dataset,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Compute ancestry-specific allele counts and frequencies
+
+    | Each haplotype contributes its allele to the ancestries it carries,
+    | weighted by ``locanc``. Hard calls count the haplotypes of each ancestry,
+    | and RFMIX .fb posteriors give the expected counts. Missing genotypes
+    | (negative values) are masked. Sites are processed in blocks of
+    | ``chunk_size``, so both inputs can be backed by zarr or dask. Local
+    | ancestry is rarely called at the genotyped sites, e.g. the markers of
+    | :func:`latool.io.read_msp_ts` are the starts of the traced segments,
+    | while the sites of :func:`latool.io.read_msp_mutations` are those of the
+    | mutations. Resample it onto the sites first with
+    | :func:`latool.util.fill_pos`.
+
+    Args:
+        ds_gt: Dataset containing ``genotype`` (marker, sample, ploidy), e.g.
+            from :func:`latool.io.read_msp_mutations`
+        ds_locanc: Dataset containing ``locanc`` on the same markers, e.g.
+            ``fill_pos(ds, ds_gt["marker"].values)``
+        chunk_size: number of sites per block, planned from ``max_memory`` by
+            default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Dataset with ``alt_count``, ``allele_count`` and ``freq`` of dims
+        (marker, ancestry)
+
+    """
+    chunk_size = _chunk_size("reduce", ds_locanc, chunk_size, max_memory)
+    da_gt = ds_gt["genotype"].transpose("marker", "sample", "ploidy")
+    da_locanc = (
+        ds_locanc["locanc"]
+        .sel(sample=da_gt["sample"].values)
+        .transpose("marker", "sample", "ploidy", "ancestry")
+    )
+    if not np.array_equal(da_gt["marker"].values, da_locanc["marker"].values):
+        raise ValueError("genotype and locanc must be on the same markers")
+
+    M, A = da_gt.shape[0], da_locanc.shape[-1]
+    alt_count = np.zeros((M, A))
+    allele_count = np.zeros((M, A))
+    for s in _marker_slices(M, chunk_size):
+        gt = da_gt[s].values
+        weight = da_locanc[s].values.astype(np.float64)
+        weight = np.where((gt >= 0)[..., None], weight, 0)
+        alt_count[s] = np.einsum("msp,mspa->ma", gt > 0, weight, optimize=True)
+        allele_count[s] = weight.sum(axis=(1, 2))
+        instrument.progress(rows=s.stop - s.start)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        freq = alt_count / allele_count
+
+    return xr.Dataset(
+        data_vars={
+            "alt_count": (["marker", "ancestry"], alt_count),
+            "allele_count": (["marker", "ancestry"], allele_count),
+            "freq": (["marker", "ancestry"], freq),
+        },
+        coords={
+            "marker": da_gt["marker"].values,
+            "ancestry": da_locanc["ancestry"].values,
+        },
+    )
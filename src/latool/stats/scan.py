@@ -0,0 +1,165 @@
+"""Module for admixture mapping association scans"""
+
+import logging
+from typing import Union
+
+import numpy as np
+import xarray as xr
+from scipy import stats
+
+from .. import instrument
+from ..plan import _chunk_size
+from ..util import _marker_slices
+
+_logger = logging.getLogger(__name__)
+
+
+def _orthonormal_basis(C: np.ndarray) -> np.ndarray:
+    """Orthonormal basis of the column space of C, dropping collinear columns"""
+    u, s, _ = np.linalg.svd(C, full_matrices=False)
+    return u[:, s > s[0] * 1e-10]
+
+
+def _fit_logistic_null(y: np.ndarray, C: np.ndarray, max_iter: int = 50) -> np.ndarray:
+    """Fit the covariate-only logistic model with IRLS and return fitted means"""
+    beta = np.zeros(C.shape[1])
+    for _ in range(max_iter):
+        mu = 1 / (1 + np.exp(-C @ beta))
+        w = mu * (1 - mu)
+        step = np.linalg.lstsq(C.T @ (C * w[:, None]), C.T @ (y - mu), rcond=None)[0]
+        beta += step
+        if np.max(np.abs(step)) < 1e-8:
+            break
+    return 1 / (1 + np.exp(-C @ beta))
+
+
+def _mean_dosage(da_locanc: xr.DataArray, chunk_size: int) -> np.ndarray:
+    """Mean dosage of every sample across markers, accumulated block by block"""
+    total = np.zeros(da_locanc.shape[1])
+    for s in _marker_slices(da_locanc.shape[0], chunk_size):
+        total += da_locanc[s].values.sum(axis=0, dtype=np.float64)
+    return total / da_locanc.shape[0]
+
+
+@instrument.instrumented
+def admixture_scan(
+    da_locanc: xr.DataArray,
+    pheno: xr.DataArray,
+    covar: xr.DataArray = None,
+    global_ancestry: Union[bool, xr.DataArray] = True,
+    model: str = "linear",
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Regress phenotypes on local ancestry dosage at every marker
+
+    | Covariates are projected out once. Markers are then processed in blocks
+    | of ``chunk_size``, and all phenotypes are tested with the same matrix
+    | products, so ``da_locanc`` can be backed by zarr or dask.
+    | ``linear``: ordinary least squares t-test.
+    | ``logistic``: score test against the covariate-only model.
+    | Global ancestry has to be known before any marker is tested. Unless it
+    | is given, it is accumulated in a first pass over the same blocks.
+
+    Args:
+        da_locanc: DataArray storing the local ancestry dosage, (marker, sample)
+        pheno: phenotypes with dims (sample,) or (sample, trait)
+        covar: covariates with dims (sample, covariate). An intercept is always
+            included
+        global_ancestry: include the mean dosage across markers as a covariate,
+            or a DataArray of dims (sample,) with precomputed global ancestry,
+            e.g. from :func:`latool.encoding.global_ancestry`, to skip the
+            first pass
+        model: ``linear`` or ``logistic``
+        chunk_size: number of markers per block, planned from ``max_memory`` by
+            default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Dataset with ``beta``, ``se``, ``stat`` and ``pval`` of dims (marker, trait)
+
+    """
+    chunk_size = _chunk_size("reduce", da_locanc, chunk_size, max_memory)
+    if model not in ["linear", "logistic"]:
+        raise ValueError(f"Unknown model {model}")
+
+    da_locanc = da_locanc.transpose("marker", "sample")
+    sample = da_locanc["sample"].values
+
+    if pheno.ndim == 1:
+        pheno = pheno.expand_dims(trait=[pheno.name or "pheno"], axis=1)
+    pheno = pheno.transpose("sample", ...)
+    pheno = pheno.rename({pheno.dims[1]: "trait"}).sel(sample=sample)
+    Y = pheno.values.astype(np.float64)
+
+    C = [np.ones((sample.shape[0], 1))]
+    if covar is not None:
+        C.append(covar.sel(sample=sample).values.reshape(sample.shape[0], -1))
+    if isinstance(global_ancestry, xr.DataArray):
+        C.append(global_ancestry.sel(sample=sample).values.reshape(-1, 1))
+    elif global_ancestry:
+        C.append(_mean_dosage(da_locanc, chunk_size).reshape(-1, 1))
+    C = np.hstack(C).astype(np.float64)
+
+    keep = ~(np.isnan(Y).any(axis=1) | np.isnan(C).any(axis=1))
+    if not keep.all():
+        _logger.info(f"Dropping {np.sum(~keep)} samples with missing values")
+        da_locanc = da_locanc.isel(sample=keep)
+        Y, C = Y[keep], C[keep]
+    N, T = Y.shape
+
+    # covariates are projected out once for all markers and phenotypes
+    if model == "linear":
+        Q = _orthonormal_basis(C)
+        df = N - Q.shape[1] - 1
+        Y = Y - Q @ (Q.T @ Y)
+        yy = np.sum(Y**2, axis=0)
+    else:
+        mu = np.stack([_fit_logistic_null(Y[:, j], C) for j in range(T)], axis=1)
+        W = mu * (1 - mu)
+        R = Y - mu
+        # (sample, trait x covariate) so that all traits share one product
+        WC = (W[:, :, None] * C[:, None, :]).reshape(N, -1)
+        CWC_inv = np.linalg.pinv(np.einsum("nk,ntl->tkl", C, WC.reshape(N, T, -1)))
+
+    M = da_locanc.shape[0]
+    beta = np.full((M, T), np.nan)
+    se = np.full((M, T), np.nan)
+    for s in _marker_slices(M, chunk_size):
+        X = da_locanc[s].values.astype(np.float64)
+        if model == "linear":
+            X = X - (X @ Q) @ Q.T
+            xx = np.sum(X**2, axis=1)[:, None]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                beta[s] = (X @ Y) / xx
+                se[s] = np.sqrt((yy - beta[s] ** 2 * xx) / df / xx)
+        else:
+            U = X @ R
+            XWC = (X @ WC).reshape(X.shape[0], T, -1)
+            V = X**2 @ W - np.einsum("mtk,tkl,mtl->mt", XWC, CWC_inv, XWC)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                beta[s] = U / V
+                se[s] = 1 / np.sqrt(V)
+        instrument.progress(rows=s.stop - s.start)
+
+    stat = beta / se
+    if model == "linear":
+        pval = 2 * stats.t.sf(np.abs(stat), df)
+    else:
+        pval = stats.chi2.sf(stat**2, 1)
+
+    ds_scan = xr.Dataset(
+        data_vars={
+            "beta": (["marker", "trait"], beta),
+            "se": (["marker", "trait"], se),
+            "stat": (["marker", "trait"], stat),
+            "pval": (["marker", "trait"], pval),
+        },
+        coords={
+            "marker": da_locanc["marker"].values,
+            "trait": pheno["trait"].values,
+        },
+        attrs={"model": model, "n_sample": N},
+    )
+
+    return ds_scan
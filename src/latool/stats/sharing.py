@@ -0,0 +1,146 @@
+"""Module for pairwise local ancestry sharing"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from .. import instrument
+from ..plan import plan_dataset
+from ..util import _marker_slices, _marker_weight, _sample_major
+
+
+@instrument.instrumented
+def ancestry_sharing(
+    ds: xr.Dataset,
+    out: str = None,
+    level: str = "sample",
+    tile_size: int = None,
+    chunk_size: int = None,
+    n_threads: int = None,
+    max_memory: int = None,
+) -> xr.DataArray:
+    """Fraction of the genome where two haplotypes carry the same ancestry
+
+    | Sharing is the inner product of the ancestry of two haplotypes summed
+    | over markers, weighted by ``right_position - left_position`` when these
+    | are present. At ``sample`` level, the four haplotype pairs of two
+    | samples are averaged. Each chunk of markers is read once for all samples
+    | if it fits in ``max_memory``, and otherwise once for every pair of bands
+    | of samples that fit. Its contribution to the tiles on and above the
+    | diagonal is computed as a GEMM per tile, with tiles distributed over
+    | ``n_threads`` threads, and the tiles are mirrored to the lower triangle
+    | at the end. Bands are read from the sample-major companion of
+    | :func:`latool.io.open_store` when it is present, so that only the
+    | samples of a band are read.
+
+    Args:
+        ds: Dataset containing ``locanc`` in the data_vars
+        out: path to a .npy file. If given, the matrix is written to this
+            memory-mapped file instead of being held in memory
+        level: ``sample`` or ``haplotype``
+        tile_size: number of rows and columns per tile, planned from
+            ``max_memory`` by default
+        chunk_size: number of markers per block, planned from ``max_memory``
+            by default
+        n_threads: number of threads working on separate tiles
+        max_memory: memory budget in bytes for :mod:`latool.plan`, shared by
+            the threads
+
+    Returns:
+        Symmetric sharing matrix
+
+    """
+    da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+    M, N, P, _ = da_locanc.shape
+    sample, ploidy = da_locanc["sample"].values, da_locanc["ploidy"].values
+    if level == "sample":
+        R = 1
+        dims = ["sample1", "sample2"]
+        coords = {"sample1": sample, "sample2": sample}
+    elif level == "haplotype":
+        R = P
+        dims = ["haplotype1", "haplotype2"]
+        coords = {
+            "sample1": ("haplotype1", np.repeat(sample, P)),
+            "ploidy1": ("haplotype1", np.tile(ploidy, N)),
+            "sample2": ("haplotype2", np.repeat(sample, P)),
+            "ploidy2": ("haplotype2", np.tile(ploidy, N)),
+        }
+    else:
+        raise ValueError(f"Unknown level {level}")
+
+    sqrt_w = np.sqrt(_marker_weight(ds))
+    H = N * R
+
+    band = N
+    if chunk_size is None or tile_size is None:
+        plan = plan_dataset("tile", ds, max_memory, n_threads)
+        chunk_size = chunk_size or plan.marker
+        band = plan.sample
+        # a tile spans samples, or both haplotypes of the samples
+        tile_size = tile_size or min(1024, band * R)
+
+    if out is None:
+        sharing = np.zeros((H, H), dtype=np.float32)
+    else:
+        sharing = np.lib.format.open_memmap(
+            out, mode="w+", dtype=np.float32, shape=(H, H)
+        )
+
+    by_sample = _sample_major(ds)
+
+    def _load(s, b):
+        """Weighted rows of the samples in ``b``, reduced over ploidy per block"""
+        if by_sample is None:
+            x = da_locanc[s, b].values
+        else:
+            x = by_sample[b, s].values.transpose(1, 0, 2, 3)
+        if level == "sample":
+            x = x.mean(axis=2, dtype=np.float64)
+        x = x.reshape(x.shape[0], -1, x.shape[-1]) * sqrt_w[s, None, None]
+        return x.transpose(1, 0, 2).reshape(x.shape[1], -1)
+
+    def _tile(x1, x2, t1, t2):
+        """Add the product of two tiles of rows of the loaded bands"""
+        sharing[t1[0], t2[0]] += x1[t1[1]] @ x2[t2[1]].T
+
+    # tiles as (rows of the matrix, rows of their band)
+    bands = list(_marker_slices(N, band))
+    tiles = [
+        [
+            (slice(b.start * R + t.start, b.start * R + t.stop), t)
+            for t in _marker_slices((b.stop - b.start) * R, tile_size)
+        ]
+        for b in bands
+    ]
+    with ThreadPoolExecutor(n_threads) as executor:
+        for i, b1 in enumerate(bands):
+            for j in range(i, len(bands)):
+                pairs = [
+                    (t1, t2)
+                    for k, t1 in enumerate(tiles[i])
+                    for t2 in (tiles[j][k:] if i == j else tiles[j])
+                ]
+                for s in _marker_slices(M, chunk_size):
+                    x1 = _load(s, b1)
+                    x2 = x1 if i == j else _load(s, bands[j])
+                    futures = [
+                        executor.submit(_tile, x1, x2, t1, t2) for t1, t2 in pairs
+                    ]
+                    for f in futures:
+                        f.result()
+                    instrument.progress(rows=s.stop - s.start)
+                for t1, t2 in pairs:
+                    if t1 is not t2:
+                        sharing[t2[0], t1[0]] = sharing[t1[0], t2[0]].T
+
+    if out is not None:
+        sharing.flush()
+
+    return xr.DataArray(
+        name="ancestry sharing",
+        data=sharing,
+        dims=dims,
+        coords=coords,
+    )
@@ -0,0 +1,153 @@
+"""Module for sufficient statistics of local ancestry, updatable by sample batches"""
+
+import numpy as np
+import xarray as xr
+
+from .. import _kernels, instrument
+from ..encoding import ancestry_dosage
+from ..plan import _chunk_size, _sample_block
+from ..util import _marker_slices
+
+
+@instrument.instrumented
+def summary_stats(
+    ds: xr.Dataset,
+    lad_ancestry: str = None,
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Sufficient statistics of local ancestry, additive over samples
+
+    | Statistics of separate batches of samples are combined by
+    | :func:`merge_summary`, so a cohort growing by batches is summarized
+    | without reading earlier batches again. Ancestry sums and global ancestry
+    | are computed in one pass over blocks of markers. The LAD accumulators
+    | are the sum and cross products of the dosage of ``lad_ancestry`` over
+    | samples, in blocks of samples over all markers, from which
+    | :func:`summary_LAD` recovers the empirical LAD.
+
+    Args:
+        ds: Dataset containing ``locanc`` in the data_vars
+        lad_ancestry: ancestry of the LAD accumulators, which are not
+            computed by default as they hold ``marker * marker`` values
+        chunk_size: number of markers per block, planned from ``max_memory``
+            by default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Dataset with the number of samples ``n_sample``, ``locanc_sum`` of
+        dims (marker, ancestry) summed over samples and ploidy, and
+        ``global_ancestry`` of dims (sample, ancestry). With
+        ``lad_ancestry``, also ``lad_sum`` of dim marker and ``lad_cross``
+        of dims (marker1, marker2)
+
+    """
+    chunk_size = _chunk_size("reduce", ds, chunk_size, max_memory)
+    da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+    M, N, P, A = da_locanc.shape
+
+    locanc_sum = np.empty((M, A))
+    total = np.zeros((N, A))
+    for s in _marker_slices(M, chunk_size):
+        block = da_locanc[s].values
+        locanc_sum[s] = block.sum(axis=(1, 2), dtype=np.float64)
+        total += _kernels.marker_sum(block)
+        instrument.progress(rows=s.stop - s.start)
+
+    marker, ancestry = da_locanc["marker"].values, da_locanc["ancestry"].values
+    summary = xr.Dataset(
+        data_vars={
+            "n_sample": N,
+            "locanc_sum": (["marker", "ancestry"], locanc_sum),
+            "global_ancestry": (["sample", "ancestry"], total / (M * P)),
+        },
+        coords={
+            "marker": marker,
+            "sample": da_locanc["sample"].values,
+            "ancestry": ancestry,
+        },
+    )
+
+    if lad_ancestry is not None:
+        if lad_ancestry not in ancestry:
+            raise KeyError(f"No ancestry {lad_ancestry} found")
+        da_dosage = ancestry_dosage(ds, lad_ancestry, chunk_size)
+        lad_sum, lad_cross = np.zeros(M), np.zeros((M, M))
+        for b in _marker_slices(N, _sample_block("tile", ds, max_memory)):
+            x = da_dosage[:, b].values.astype(np.float64)
+            lad_sum += x.sum(axis=1)
+            lad_cross += x @ x.T
+        summary["lad_sum"] = ("marker", lad_sum)
+        summary["lad_cross"] = (["marker1", "marker2"], lad_cross)
+        summary = summary.assign_coords(marker1=marker, marker2=marker)
+        summary.attrs["lad_ancestry"] = lad_ancestry
+
+    return summary
+
+
+def merge_summary(summary: xr.Dataset, other: xr.Dataset) -> xr.Dataset:
+    """Combine the statistics of two disjoint sets of samples
+
+    Args:
+        summary: statistics from :func:`summary_stats`
+        other: statistics of other samples at the same markers
+
+    Returns:
+        Statistics of the samples of both
+
+    """
+    if not (
+        np.array_equal(summary["marker"].values, other["marker"].values)
+        and np.array_equal(summary["ancestry"].values, other["ancestry"].values)
+    ):
+        raise ValueError("Summaries of different markers or ancestries")
+    if summary.attrs.get("lad_ancestry") != other.attrs.get("lad_ancestry"):
+        raise ValueError("Summaries with LAD accumulators of different ancestries")
+    if np.isin(other["sample"].values, summary["sample"].values).any():
+        raise ValueError("Summaries of overlapping samples")
+
+    merged = xr.Dataset(
+        data_vars={
+            "n_sample": summary["n_sample"] + other["n_sample"],
+            "locanc_sum": summary["locanc_sum"] + other["locanc_sum"],
+            "global_ancestry": xr.concat(
+                [summary["global_ancestry"], other["global_ancestry"]], dim="sample"
+            ),
+        },
+        attrs=summary.attrs,
+    )
+    if "lad_sum" in summary:
+        merged["lad_sum"] = summary["lad_sum"] + other["lad_sum"]
+        merged["lad_cross"] = summary["lad_cross"] + other["lad_cross"]
+    return merged
+
+
+def summary_LAD(summary: xr.Dataset) -> xr.DataArray:
+    """Empirical LAD from the accumulators of :func:`summary_stats`
+
+    | Equal to :func:`latool.stats.empirical_LAD` of the dosage of all the
+    | samples summarized.
+
+    Args:
+        summary: statistics with ``lad_sum`` and ``lad_cross``
+
+    Returns:
+        A marker by marker matrix of empirical LAD
+
+    """
+    if "lad_cross" not in summary:
+        raise KeyError("No LAD accumulators in the summary")
+    n = float(summary["n_sample"])
+    mean = summary["lad_sum"].values / n
+    cov = summary["lad_cross"].values / n - np.outer(mean, mean)
+    sd = np.sqrt(np.diag(cov))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.outer(sd, sd)
+
+    marker = summary["marker"].values
+    return xr.DataArray(
+        name="Empirical LAD",
+        data=corr,
+        dims=["marker1", "marker2"],
+        coords={"marker1": marker, "marker2": marker},
+    )
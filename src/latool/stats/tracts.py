@@ -0,0 +1,262 @@
+"""Module for ancestry tracts and admixture time estimation"""
+
+from typing import Tuple
+
+import numpy as np
+import xarray as xr
+
+from .. import instrument
+from ..plan import _chunk_size, _sample_block
+from ..util import _block_slices, _marker_slices, _sample_major
+
+
+def _marker_bounds(ds: xr.Dataset, unit: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Left and right boundary of every marker in genetic (cM) or physical unit"""
+    if unit == "genetic":
+        if "genetic_position" not in ds:
+            raise KeyError("No genetic_position in the dataset")
+        pos = ds["genetic_position"].values.astype(np.float64)
+    elif unit == "physical":
+        if "left_position" in ds and "right_position" in ds:
+            return (
+                ds["left_position"].values.astype(np.float64),
+                ds["right_position"].values.astype(np.float64),
+            )
+        pos = ds["marker"].values.astype(np.float64)
+    else:
+        raise ValueError(f"Unknown unit {unit}")
+
+    # a marker spans until the next marker on the same chromosome, and the last
+    # marker of a chromosome by the mean spacing of its markers
+    first = np.zeros(pos.shape[0], dtype=bool)
+    first[:1] = True
+    if "chrom" in ds.coords:
+        chrom = ds["chrom"].values
+        first[1:] = chrom[1:] != chrom[:-1]
+    begin = np.flatnonzero(first)
+    end = np.append(begin[1:], pos.shape[0]) - 1
+    spacing = (pos[end] - pos[begin]) / np.maximum(end - begin, 1)
+
+    right = np.append(pos[1:], np.nan)
+    right[end] = pos[end] + spacing
+    return pos, right
+
+
+def _check_missing(block: np.ndarray, axis: int, offset: int):
+    """Raise on NaN posteriors, with the marker index of the first one"""
+    if block.dtype.kind == "f" and np.isnan(block).any():
+        axes = tuple(i for i in range(block.ndim) if i != axis)
+        marker = offset + np.flatnonzero(np.isnan(block).any(axis=axes))[0]
+        raise ValueError(f"Missing local ancestry at marker index {marker}")
+
+
+def _marker_major_starts(
+    da_locanc: xr.DataArray, chrom_start: np.ndarray, chunk_size: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Start marker, haplotype and ancestry code of the tracts, sorted by
+    haplotype, from blocks of markers of all haplotypes"""
+    M, N, P, _ = da_locanc.shape
+    starts, haps, codes = [], [], []
+    prev = None
+    for s in _marker_slices(M, chunk_size):
+        block = da_locanc[s].values
+        _check_missing(block, 0, s.start)
+        code = block.argmax(axis=-1).reshape(s.stop - s.start, N * P)
+        change = np.empty(code.shape, dtype=bool)
+        change[0] = True if prev is None else code[0] != prev
+        np.not_equal(code[1:], code[:-1], out=change[1:])
+        change |= chrom_start[s, None]
+        row, hap = np.nonzero(change)
+        starts.append(row + s.start)
+        haps.append(hap)
+        codes.append(code[row, hap])
+        prev = code[-1]
+        instrument.progress(rows=s.stop - s.start)
+
+    starts, haps = np.concatenate(starts), np.concatenate(haps)
+    codes = np.concatenate(codes)
+    order = np.lexsort((starts, haps))
+    return starts[order], haps[order], codes[order]
+
+
+def _sample_major_starts(
+    by_sample: xr.DataArray, chrom_start: np.ndarray, sample_block: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Start marker, haplotype and ancestry code of the tracts, sorted by
+    haplotype, from blocks of samples over all markers"""
+    _, M, P, _ = by_sample.shape
+    starts, haps, codes = [], [], []
+    for b in _block_slices(by_sample, sample_block):
+        block = by_sample[b].values
+        _check_missing(block, 1, 0)
+        # haplotype rows of markers, so tracts come out sorted
+        code = block.argmax(axis=-1).transpose(0, 2, 1).reshape(-1, M)
+        change = np.empty(code.shape, dtype=bool)
+        change[:, 0] = True
+        np.not_equal(code[:, 1:], code[:, :-1], out=change[:, 1:])
+        change |= chrom_start[None, :]
+        hap, row = np.nonzero(change)
+        starts.append(row)
+        haps.append(hap + b.start * P)
+        codes.append(code[hap, row])
+        instrument.progress(bytes_read=block.nbytes)
+    return np.concatenate(starts), np.concatenate(haps), np.concatenate(codes)
+
+
+@instrument.instrumented
+def ancestry_tracts(
+    ds: xr.Dataset,
+    unit: str = "genetic",
+    chunk_size: int = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Extract ancestry tracts of every haplotype
+
+    | Haplotypes are assigned the most likely ancestry at each marker. Tract
+    | boundaries are found by comparing each marker with the previous one,
+    | block by block with the last marker carried over, so the cost is linear
+    | in the number of markers and tracts. Tracts are split at chromosome
+    | boundaries given by the ``chrom`` coordinate. Without right positions,
+    | the last marker of a chromosome spans the mean marker spacing. Missing
+    | posteriors raise a ValueError, as no ancestry can be assigned. With the
+    | sample-major companion of :func:`latool.io.open_store`, blocks of
+    | samples are compared over all markers instead.
+
+    Args:
+        ds: Dataset containing ``locanc`` in the data_vars
+        unit: ``genetic`` to measure tracts with ``genetic_position`` in cM, or
+            ``physical`` to use ``left_position``/``right_position`` or ``marker``
+        chunk_size: number of markers per block, planned from ``max_memory`` by
+            default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
+
+    Returns:
+        Dataset of dim ``tract`` with the sample, ploidy, ancestry, marker
+        index range [start, end), left and right position, length, and whether
+        the tract is censored by the end of the chromosome
+
+    """
+    chunk_size = _chunk_size("reduce", ds, chunk_size, max_memory)
+    left_bound, right_bound = _marker_bounds(ds, unit)
+    da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+    M, N, P, _ = da_locanc.shape
+
+    # first marker of each chromosome
+    chrom_start = np.zeros(M, dtype=bool)
+    chrom_start[0] = True
+    if "chrom" in ds.coords:
+        chrom = ds["chrom"].values
+        chrom_start[1:] = chrom[1:] != chrom[:-1]
+
+    by_sample = _sample_major(ds)
+    if by_sample is None:
+        starts, haps, codes = _marker_major_starts(da_locanc, chrom_start, chunk_size)
+    else:
+        starts, haps, codes = _sample_major_starts(
+            by_sample, chrom_start, _sample_block("reduce", ds, max_memory)
+        )
+
+    # a tract ends where the next tract of the same haplotype starts
+    last = np.append(haps[1:] != haps[:-1], True)
+    ends = np.where(last, M, np.append(starts[1:], M))
+    censored = np.append(chrom_start[1:], True)[ends - 1]
+
+    left = left_bound[starts]
+    right = right_bound[ends - 1]
+
+    tracts = xr.Dataset(
+        data_vars={
+            "sample": ("tract", da_locanc["sample"].values[haps // P]),
+            "ploidy": ("tract", da_locanc["ploidy"].values[haps % P]),
+            "ancestry": ("tract", da_locanc["ancestry"].values[codes]),
+            "start": ("tract", starts),
+            "end": ("tract", ends),
+            "left": ("tract", left),
+            "right": ("tract", right),
+            "length": ("tract", right - left),
+            "censored": ("tract", censored),
+        },
+        attrs={"unit": unit},
+    )
+
+    return tracts
+
+
+@instrument.instrumented
+def tract_length_histogram(
+    tracts: xr.Dataset,
+    bins=50,
+) -> xr.DataArray:
+    """Histogram of tract lengths per ancestry
+
+    Args:
+        tracts: output of :func:`ancestry_tracts`
+        bins: number of bins or bin edges, passed to ``numpy.histogram``
+
+    Returns:
+        Tract counts of dims (ancestry, bin)
+
+    """
+    length = tracts["length"].values
+    edges = np.histogram_bin_edges(length, bins=bins)
+    ancestries = np.unique(tracts["ancestry"].values)
+    counts = np.stack(
+        [
+            np.histogram(length[tracts["ancestry"].values == a], bins=edges)[0]
+            for a in ancestries
+        ]
+    )
+
+    return xr.DataArray(
+        name="tract count",
+        data=counts,
+        dims=["ancestry", "bin"],
+        coords={
+            "ancestry": ancestries,
+            "bin_left": ("bin", edges[:-1]),
+            "bin_right": ("bin", edges[1:]),
+        },
+        attrs={"unit": tracts.attrs["unit"]},
+    )
+
+
+@instrument.instrumented
+def admixture_time(
+    tracts: xr.Dataset,
+) -> xr.DataArray:
+    """Estimate the number of generations since admixture from tract lengths
+
+    | Under a single pulse of admixture g generations ago, tracts of an
+    | ancestry with genome-wide proportion m are exponentially distributed
+    | with rate g(1 - m) per Morgan. The rate is estimated by maximum
+    | likelihood, treating tracts reaching the chromosome end as censored.
+
+    Args:
+        tracts: output of :func:`ancestry_tracts` with ``unit="genetic"``
+
+    Returns:
+        Estimated g per ancestry, which can be passed to
+        :func:`latool.stats.theoretical_LAD`
+
+    """
+    if tracts.attrs["unit"] != "genetic":
+        raise ValueError("Tract lengths must be in genetic unit")
+
+    length = tracts["length"].values / 100  # cM to Morgan
+    ancestry = tracts["ancestry"].values
+    ancestries = np.unique(ancestry)
+
+    total = length.sum()
+    g = []
+    for a in ancestries:
+        is_a = ancestry == a
+        n_complete = np.sum(is_a & ~tracts["censored"].values)
+        rate = n_complete / length[is_a].sum()
+        g.append(rate / (1 - length[is_a].sum() / total))
+
+    return xr.DataArray(
+        name="admixture time",
+        data=np.array(g),
+        dims=["ancestry"],
+        coords={"ancestry": ancestries},
+    )
@@ -0,0 +1,292 @@
+"""Module for windowed ancestry proportions from a prefix-sum index"""
+
+import json
+import logging
+import os
+from typing import Tuple
+
+import numpy as np
+import xarray as xr
+
+from .. import instrument
+from ..plan import plan_dataset
+from ..util import _marker_slices
+from .tracts import _check_missing, _marker_bounds
+
+_logger = logging.getLogger(__name__)
+
+
+class AncestryIndex:
+    """Length-weighted cumulative sums of ancestry over markers
+
+    | Row ``k`` of ``cumsum`` holds, for every sample and ancestry, the
+    | ancestry of markers ``0..k-1`` averaged over ploidy and weighted by the
+    | length of the markers. Within a marker ancestry is constant, so the
+    | cumulative sum at any position is interpolated linearly inside the
+    | marker that contains it. The mean ancestry of a window is the difference
+    | of the sums at its ends, divided by the length covered by markers, at a
+    | cost of two rows per window whatever its number of markers. Build the
+    | index once with :meth:`AncestryIndex.build`, to a directory that is
+    | memory-mapped by :meth:`AncestryIndex.load`. Sums are kept in float64,
+    | i.e. ``8 * (n_marker + 1) * n_sample * n_ancestry`` bytes.
+
+    Args:
+        cumsum: array of shape (marker + 1, sample, ancestry)
+        cohort: array of shape (marker + 1, ancestry), summed over samples
+        left: left boundary of every marker
+        right: right boundary of every marker
+        chrom: chromosome of every marker
+        sample: sample names
+        ancestry: ancestry names
+        unit: unit of the marker boundaries, ``physical`` or ``genetic``
+
+    """
+
+    def __init__(
+        self,
+        cumsum: np.ndarray,
+        cohort: np.ndarray,
+        left: np.ndarray,
+        right: np.ndarray,
+        chrom: np.ndarray,
+        sample: np.ndarray,
+        ancestry: np.ndarray,
+        unit: str = "physical",
+    ):
+        self.cumsum = cumsum
+        self.cohort = cohort
+        self.left = left
+        self.right = right
+        self.chrom = chrom
+        self.sample = sample
+        self.ancestry = ancestry
+        self.unit = unit
+
+        self._length = right - left
+        self._cum_length = np.concatenate([[0.0], np.cumsum(self._length)])
+        # markers of a chromosome are contiguous
+        first = np.ones(chrom.shape[0], dtype=bool)
+        first[1:] = chrom[1:] != chrom[:-1]
+        begin = np.flatnonzero(first)
+        end = np.append(begin[1:], chrom.shape[0])
+        self._chrom_range = {str(chrom[b]): (b, e) for b, e in zip(begin, end)}
+
+    @property
+    def chroms(self):
+        return list(self._chrom_range)
+
+    @classmethod
+    @instrument.instrumented
+    def build(
+        cls,
+        ds: xr.Dataset,
+        path: str = None,
+        unit: str = "physical",
+        chunk_size: int = None,
+        max_memory: int = None,
+    ) -> "AncestryIndex":
+        """Build the index from local ancestry, one block of markers at a time
+
+        Args:
+            ds: Dataset containing ``locanc`` in the data_vars, with markers
+                sorted by position within each chromosome. Missing posteriors
+                raise a ValueError
+            path: directory to write the index to. If given, the sums are
+                written to memory-mapped .npy files instead of being held in
+                memory
+            unit: ``physical`` for ``left_position`` and ``right_position``,
+                or marker positions, and ``genetic`` for ``genetic_position``
+            chunk_size: number of markers per block, planned from
+                ``max_memory`` by default
+            max_memory: memory budget in bytes for :mod:`latool.plan`
+
+        Returns:
+            AncestryIndex
+
+        """
+        da_locanc = ds["locanc"].transpose("marker", "sample", "ploidy", "ancestry")
+        M, N, _, A = da_locanc.shape
+        left, right = _marker_bounds(ds, unit)
+        if "chrom" in ds.coords:
+            chrom = ds["chrom"].values.astype(str)
+        else:
+            chrom = np.full(M, "", dtype=str)
+        sample = da_locanc["sample"].values.astype(str)
+        ancestry = da_locanc["ancestry"].values.astype(str)
+        if chunk_size is None:
+            chunk_size = plan_dataset("reduce", ds, max_memory).marker
+
+        if path is None:
+            cumsum = np.empty((M + 1, N, A), dtype=np.float64)
+            cohort = np.empty((M + 1, A), dtype=np.float64)
+        else:
+            os.makedirs(path, exist_ok=True)
+            if os.path.exists(os.path.join(path, "meta.json")):
+                os.remove(os.path.join(path, "meta.json"))
+            cumsum = np.lib.format.open_memmap(
+                os.path.join(path, "cumsum.npy"),
+                mode="w+",
+                dtype=np.float64,
+                shape=(M + 1, N, A),
+            )
+            cohort = np.lib.format.open_memmap(
+                os.path.join(path, "cohort.npy"),
+                mode="w+",
+                dtype=np.float64,
+                shape=(M + 1, A),
+            )
+        cumsum[0] = 0
+        cohort[0] = 0
+
+        length = right - left
+        for s in _marker_slices(M, chunk_size):
+            block = da_locanc[s].values
+            # a NaN would propagate to every later sum of the index
+            _check_missing(block, 0, s.start)
+            x = block.mean(axis=2, dtype=np.float64)
+            x *= length[s, None, None]
+            np.cumsum(x, axis=0, out=x)
+            x += cumsum[s.start]
+            cumsum[s.start + 1 : s.stop + 1] = x
+            cohort[s.start + 1 : s.stop + 1] = x.sum(axis=1)
+            instrument.progress(rows=s.stop - s.start)
+
+        if path is not None:
+            cumsum.flush()
+            cohort.flush()
+            np.save(os.path.join(path, "bounds.npy"), np.stack([left, right]))
+            np.save(os.path.join(path, "chrom.npy"), chrom)
+            # written last, so that an index is complete when it has metadata
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump(
+                    {
+                        "sample": sample.tolist(),
+                        "ancestry": ancestry.tolist(),
+                        "unit": unit,
+                    },
+                    f,
+                )
+
+        return cls(cumsum, cohort, left, right, chrom, sample, ancestry, unit)
+
+    @classmethod
+    def load(cls, path: str) -> "AncestryIndex":
+        """Memory-map an index written by :meth:`AncestryIndex.build`
+
+        Args:
+            path: directory of the index
+
+        Returns:
+            AncestryIndex
+
+        """
+        meta_file = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_file):
+            raise FileNotFoundError(f"No complete ancestry index in {path}")
+        with open(meta_file) as f:
+            meta = json.load(f)
+        left, right = np.load(os.path.join(path, "bounds.npy"))
+        return cls(
+            np.load(os.path.join(path, "cumsum.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "cohort.npy"), mmap_mode="r"),
+            left,
+            right,
+            np.load(os.path.join(path, "chrom.npy")),
+            np.array(meta["sample"], dtype=str),
+            np.array(meta["ancestry"], dtype=str),
+            meta["unit"],
+        )
+
+    def _markers(self, chrom) -> Tuple[int, int]:
+        """Range of the markers of a chromosome, with or without ``chr``"""
+        chrom = "" if chrom is None else str(chrom)
+        for key in [chrom, chrom[3:] if chrom.startswith("chr") else f"chr{chrom}"]:
+            if key in self._chrom_range:
+                return self._chrom_range[key]
+        if chrom == "" and len(self._chrom_range) == 1:
+            return next(iter(self._chrom_range.values()))
+        raise KeyError(f"Chromosome {chrom} not found in the index")
+
+    def _cumulative(self, sums: np.ndarray, chrom, pos: np.ndarray):
+        """Sums and covered length from the chromosome start up to ``pos``"""
+        begin, end = self._markers(chrom)
+        # last marker starting at or before pos, or the first marker
+        k = begin + np.searchsorted(self.left[begin:end], pos, side="right") - 1
+        k = np.maximum(k, begin)
+        length = self._length[k]
+        covered = np.clip(pos - self.left[k], 0, length)
+        frac = np.divide(covered, length, out=np.zeros_like(covered), where=length > 0)
+        lo, hi = np.asarray(sums[k]), np.asarray(sums[k + 1])
+        frac = frac.reshape((-1,) + (1,) * (lo.ndim - 1))
+        return lo + (hi - lo) * frac, self._cum_length[k] + covered
+
+    def windows(self, chrom, start, end, cohort: bool = False) -> xr.DataArray:
+        """Mean ancestry over windows of a chromosome
+
+        | Every window costs two rows of the index. Windows covering no marker
+        | are NaN.
+
+        Args:
+            chrom: chromosome of the windows, with or without the ``chr``
+                prefix. Optional if the index has a single chromosome
+            start: start of every window, in the unit of the index
+            end: end of every window
+            cohort: average over samples as well
+
+        Returns:
+            DataArray of dims (window, sample, ancestry), or (window,
+            ancestry) for the cohort
+
+        """
+        start, end = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(start, dtype=np.float64)),
+            np.atleast_1d(np.asarray(end, dtype=np.float64)),
+        )
+        sums = self.cohort if cohort else self.cumsum
+        s_start, l_start = self._cumulative(sums, chrom, start)
+        s_end, l_end = self._cumulative(sums, chrom, end)
+        covered = l_end - l_start
+        if cohort:
+            covered = covered * self.sample.shape[0]
+        covered = covered.reshape((-1,) + (1,) * (s_end.ndim - 1))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(covered > 0, (s_end - s_start) / covered, np.nan)
+
+        dims = ["window", "ancestry"] if cohort else ["window", "sample", "ancestry"]
+        coords = {
+            "start": ("window", start),
+            "end": ("window", end),
+            "ancestry": self.ancestry,
+        }
+        if not cohort:
+            coords["sample"] = self.sample
+        return xr.DataArray(name="ancestry", data=mean, dims=dims, coords=coords)
+
+    def scan(
+        self, size: float, step: float = None, chrom=None, cohort: bool = False
+    ) -> xr.DataArray:
+        """Mean ancestry over sliding windows
+
+        Args:
+            size: window size, in the unit of the index
+            step: distance between window starts, ``size`` by default
+            chrom: chromosome to scan, all chromosomes by default
+            cohort: average over samples as well
+
+        Returns:
+            DataArray of dims (window, sample, ancestry), or (window,
+            ancestry) for the cohort, with the ``chrom``, ``start`` and ``end``
+            of every window
+
+        """
+        step = size if step is None else step
+        if size <= 0 or step <= 0:
+            raise ValueError("size and step must be positive")
+        chroms = self.chroms if chrom is None else [chrom]
+        scans = []
+        for c in chroms:
+            begin, end = self._markers(c)
+            start = np.arange(self.left[begin], self.right[end - 1], step)
+            da = self.windows(c, start, start + size, cohort)
+            scans.append(da.assign_coords(chrom=("window", np.full(start.shape, c))))
+        return xr.concat(scans, dim="window")
@@ -1,20 +1,139 @@
 import numpy as np
 import xarray as xr
 
+from . import _kernels, instrument
+from .plan import _chunk_size
 
-def fill_pos(ds: xr.Dataset) -> xr.Dataset:
-    pass
 
+@instrument.instrumented
+def fill_pos(
+    ds: xr.Dataset,
+    positions: np.ndarray,
+    policy: str = "nan",
+    chunk_size: int = None,
+    chrom: str = None,
+    max_memory: int = None,
+) -> xr.Dataset:
+    """Resample local ancestry onto new marker positions
+
+    | Each target position takes the local ancestry of the marker interval
+    | [``left_position``, ``right_position``) containing it. Without interval
+    | bounds, a position takes the ancestry of the closest marker on its
+    | left. The lookup is a single ``searchsorted`` followed by a gather along
+    | ``marker``, which stays lazy for dask-backed data so the result can be
+    | streamed to zarr or pgen chunk by chunk.
+
+    args:
+        ds: xarray Dataset containing ``locanc`` in the data_vars
+        positions: target marker positions
+        policy: how to handle positions outside all marker intervals.
+            ``nan`` fills ``locanc`` with NaN, ``nearest`` takes the closest
+            interval, ``drop`` removes the positions and ``raise`` raises
+            a ValueError
+        chunk_size: if given, gather lazily in blocks of ``chunk_size`` markers
+        chrom: chromosome of ``positions``. Required if ``ds`` has markers on
+            several chromosomes
+        max_memory: if given, gather lazily in blocks of markers planned by
+            :mod:`latool.plan` within this memory budget in bytes
+
+    returns:
+        Dataset with ``positions`` as the ``marker`` coordinate
+
+    Example
+    -------
+    >>> from latool.io import read_rfmix_msp
+    >>> from latool.util import fill_pos
+    >>> ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    >>> fill_pos(ds, [0, 10, 1653, 7000], policy="drop")["marker"].values
+    array([  10, 1653])
+
+    """
+    positions = np.asarray(positions)
+
+    if "chrom" in ds.coords:
+        if chrom is not None:
+            ds = ds.isel(marker=ds["chrom"].values == str(chrom))
+        elif np.unique(ds["chrom"].values).shape[0] > 1:
+            raise ValueError("chrom is required for markers on several chromosomes")
+
+    if "left_position" in ds and "right_position" in ds:
+        left = ds["left_position"].values
+        right = ds["right_position"].values
+    else:
+        left = ds["marker"].values
+        right = np.append(left[1:], np.inf)
+    M = left.shape[0]
+
+    idx = np.searchsorted(left, positions, side="right") - 1
+    inside = (idx >= 0) & (positions < right[np.clip(idx, 0, M - 1)])
+
+    if policy == "raise" and not inside.all():
+        raise ValueError(f"{np.sum(~inside)} positions are outside marker intervals")
+    elif policy == "drop":
+        positions, idx, inside = positions[inside], idx[inside], inside[inside]
+    elif policy == "nearest":
+        lower = np.clip(idx, 0, M - 1)
+        upper = np.clip(idx + 1, 0, M - 1)
+        to_upper = (idx < 0) | (left[upper] - positions < positions - right[lower])
+        idx = np.where(inside, idx, np.where(to_upper, upper, lower))
+        inside[:] = True
+    elif policy not in ["nan", "raise"]:
+        raise ValueError(f"Unknown policy {policy}")
+
+    if chunk_size is None and max_memory is not None:
+        chunk_size = _chunk_size("encode", ds, None, max_memory)
+    if chunk_size is not None:
+        ds = ds.chunk({"marker": chunk_size})
+
+    genetic_position = None
+    if "genetic_position" in ds:
+        genetic_position = np.interp(
+            positions, ds["marker"].values, ds["genetic_position"].values
+        )
+
+    ds = ds.drop_vars(["left_position", "right_position"], errors="ignore")
+    ds = ds.isel(marker=np.clip(idx, 0, M - 1))
+    ds["marker"] = positions
+
+    if not inside.all():
+        locanc = ds["locanc"]
+        if not np.issubdtype(locanc.dtype, np.floating):
+            locanc = locanc.astype(np.float32)
+        ds["locanc"] = locanc.where(xr.DataArray(inside, dims="marker"))
+
+    if genetic_position is not None:
+        ds["genetic_position"] = ("marker", genetic_position)
 
+    return ds
+
+
+@instrument.instrumented
 def simplify(
     ds: xr.Dataset,
+    chunk_size: int = None,
+    max_memory: int = None,
 ) -> xr.Dataset:
     """Simplify the local ancestry data.
 
     Merge identical consecutive markers
 
+    | Markers are compared block by block with the last marker of the previous
+    | block carried over, so ``locanc`` can be backed by zarr or dask. Each
+    | marker is viewed as a single opaque byte string, and adjacent markers are
+    | compared in parallel by a compiled kernel stopping at the first differing
+    | byte, instead of an elementwise comparison over the full array. A merged
+    | marker spans from the ``left_position`` of the first to the
+    | ``right_position`` of the last marker it replaces. Markers on different
+    | chromosomes are never merged. Bit-packed ``locanc_packed`` and quantized
+    | ``locanc_quantized`` from :mod:`latool.encoding` are compared in their
+    | compact form.
+
     args:
-        ds: xarray Dataset containing ``locanc`` in the data_vars
+        ds: xarray Dataset containing ``locanc``, ``locanc_packed`` or
+            ``locanc_quantized`` in the data_vars
+        chunk_size: number of markers per block, planned from ``max_memory`` by
+            default
+        max_memory: memory budget in bytes for :mod:`latool.plan`
 
     returns:
         Dataset where markers are removed if the local ancestry
@@ -22,47 +141,115 @@ def simplify(
 
     Example
     -------
-    >>> from latool.io import read_msp_ts
+    >>> from latool.io import read_rfmix_msp
     >>> from latool.util import simplify
-    >>> ds = read_msp_ts(
-    ...     fname="tests/testdata/example.ts",
-    ...     admixpop='ADMIX',
-    ...     ancpop=['EUR', 'AFR'])
-    >>> ds
-    <xarray.Dataset>
-    Dimensions:         (marker: 5, sample: 10, ploidy: 2, ancestry: 2)
-    Coordinates:
-      * marker          (marker) uint64 15472077 15671821 15704336 15776649 15883331
-      * sample          (sample) int64 0 1 2 3 4 5 6 7 8 9
-      * ploidy          (ploidy) int64 0 1
-      * ancestry        (ancestry) object 'AFR' 'EUR'
-    Data variables:
-        locanc          (marker, sample, ploidy, ancestry) float32 1.0 0.0 ... 0.0
-        left_position   (marker) uint64 15295879 15648276 15695366 15713306 15839992
-        right_position  (marker) uint64 15648276 15695366 15713306 15839992 15926670
-    >>> ds.locanc[0] = ds.locanc[1]
-    >>> simplify(ds)
-    <xarray.Dataset>
-    Dimensions:         (marker: 4, sample: 10, ploidy: 2, ancestry: 2)
-    Coordinates:
-      * marker          (marker) uint64 15472077 15704336 15776649 15883331
-      * sample          (sample) int64 0 1 2 3 4 5 6 7 8 9
-      * ploidy          (ploidy) int64 0 1
-      * ancestry        (ancestry) object 'AFR' 'EUR'
-    Data variables:
-        locanc          (marker, sample, ploidy, ancestry) float32 1.0 0.0 ... 0.0
-        left_position   (marker) uint64 15295879 15695366 15713306 15839992
-        right_position  (marker) uint64 15648276 15713306 15839992 15926670
+    >>> ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    >>> ds.left_position.values, ds.right_position.values
+    (array([   1, 1653, 4963, 5025, 5553], dtype=uint32), \
+array([1653, 4963, 5025, 5553, 6762], dtype=uint32))
+    >>> ds.locanc[1] = ds.locanc[0]
+    >>> ds = simplify(ds)
+    >>> ds.left_position.values, ds.right_position.values
+    (array([   1, 4963, 5025, 5553], dtype=uint32), \
+array([4963, 5025, 5553, 6762], dtype=uint32))
 
     """
-    if ds.dims["marker"] == 1:
+    chunk_size = _chunk_size("compare", ds, chunk_size, max_memory)
+    M = ds.sizes["marker"]
+    if M == 1:
         return ds
 
-    arr = ds["locanc"].values
-    non_dup = np.append([True], (~np.all(np.equal(arr[1:], arr[:-1]), axis=(1, 2, 3))))
+    if "locanc_packed" in ds:
+        da_locanc = ds["locanc_packed"]
+    elif "locanc_quantized" in ds:
+        da_locanc = ds["locanc_quantized"]
+    else:
+        da_locanc = ds["locanc"].transpose("marker", ...)
+    non_dup = np.empty(M, dtype=bool)
+    prev = None
+    for s in _marker_slices(M, chunk_size):
+        block = np.ascontiguousarray(da_locanc[s].values)
+        first = block[0].tobytes()
+        non_dup[s.start] = prev is None or first != prev
+        non_dup[s.start + 1 : s.stop] = ~_kernels.adjacent_equal(block)[1:]
+        prev = block[-1].tobytes()
+        instrument.progress(rows=s.stop - s.start)
 
-    ds = ds.isel(marker=non_dup)
+    if "chrom" in ds.coords:
+        chrom = ds["chrom"].values
+        non_dup[1:] |= chrom[1:] != chrom[:-1]
 
-    # TODO: Update positions
+    # last marker of each run of identical markers
+    run_end = np.append(np.flatnonzero(non_dup)[1:], M) - 1
+
+    right_position = None
+    if "right_position" in ds:
+        right_position = ds["right_position"].values[run_end]
+
+    ds = ds.isel(marker=non_dup)
+    if right_position is not None:
+        ds["right_position"] = ("marker", right_position)
 
     return ds
+
+
+def _marker_slices(n_marker: int, chunk_size: int):
+    """Yield slices covering ``range(n_marker)`` in blocks of ``chunk_size``"""
+    for left in range(0, n_marker, chunk_size):
+        yield slice(left, min(left + chunk_size, n_marker))
+
+
+def _block_slices(da: xr.DataArray, chunk_size: int):
+    """Yield marker slices following the marker chunks of dask-backed ``da``,
+    or blocks of ``chunk_size`` markers otherwise"""
+    if da.chunks is None:
+        yield from _marker_slices(da.shape[0], chunk_size)
+        return
+    left = 0
+    for size in da.chunks[0]:
+        yield slice(left, left + size)
+        left += size
+
+
+def _sample_major(ds: xr.Dataset) -> xr.DataArray:
+    """``locanc`` of dims (sample, marker, ploidy, ancestry) from the
+    sample-major companion opened by :func:`latool.io.open_store`, or None"""
+    if "locanc_by_sample" not in ds:
+        return None
+    return ds["locanc_by_sample"].transpose("sample", "marker", "ploidy", "ancestry")
+
+
+def _marker_weight(ds: xr.Dataset) -> np.ndarray:
+    """Marker weights proportional to the length of the marker interval"""
+    if "left_position" in ds and "right_position" in ds:
+        w = ds["right_position"].values.astype(np.float64)
+        w = w - ds["left_position"].values
+    else:
+        w = np.ones(ds.sizes["marker"])
+    return w / w.sum()
+
+
+def _map_marker_blocks(func, da: xr.DataArray, shape: tuple, dtype, chunk_size: int):
+    """Apply ``func`` to blocks of markers of ``da``
+
+    | ``func`` maps an array of ``m`` markers to an array of shape
+    | ``(m,) + shape``. For dask-backed ``da`` the result is a dask array
+    | following the marker chunks of ``da``, otherwise a numpy array computed
+    | ``chunk_size`` markers at a time.
+    """
+    if da.chunks is None:
+        out = np.empty((da.shape[0],) + tuple(shape), dtype=dtype)
+        for s in _marker_slices(da.shape[0], chunk_size):
+            out[s] = func(da[s].values)
+            instrument.progress(rows=s.stop - s.start)
+        return out
+
+    data = da.chunk({dim: -1 for dim in da.dims[1:]}).data
+    n_in, n_out = data.ndim, 1 + len(shape)
+    return data.map_blocks(
+        func,
+        chunks=(data.chunks[0],) + tuple((n,) for n in shape),
+        drop_axis=list(range(n_out, n_in)),
+        new_axis=list(range(n_in, n_out)),
+        dtype=dtype,
+    )
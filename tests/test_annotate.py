@@ -0,0 +1,40 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from latool.annotate import GeneticMap, genetic_distance
+from latool.io import read_rfmix_msp
+
+
+def test_genetic_distance(tmp_path):
+    fname = str(tmp_path / "chr22.map")
+    shutil.copy("tests/testdata/chr22.map", fname)
+    ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    ds["marker"] = ds["marker"] + 16_000_000
+
+    df = pd.read_csv(fname, sep=" ")
+    expected = np.interp(ds["marker"], df.iloc[:, 1], df.iloc[:, 3])
+
+    np.testing.assert_allclose(
+        genetic_distance(ds, fname, 22)["genetic_position"], expected
+    )
+
+    # second load is served from the memory-mapped cache
+    genetic_map = GeneticMap.from_file(fname)
+    assert isinstance(genetic_map.maps["22"][0], np.memmap)
+    np.testing.assert_allclose(genetic_map.interpolate("chr22", ds["marker"]), expected)
+
+    # a changed map invalidates the LRU and the on-disk cache
+    df.iloc[:, 3] *= 2
+    df.to_csv(fname, sep=" ", index=False)
+    mtime_ns = os.stat(fname).st_mtime_ns + 10**9
+    os.utime(fname, ns=(mtime_ns, mtime_ns))
+    np.testing.assert_allclose(
+        genetic_distance(ds, fname, 22)["genetic_position"], 2 * expected
+    )
+    genetic_map = GeneticMap.from_file(fname)
+    assert isinstance(genetic_map.maps["22"][0], np.memmap)
+    np.testing.assert_allclose(genetic_map.interpolate(22, ds["marker"]), 2 * expected)
+    assert sorted(os.listdir(tmp_path)) == ["chr22.map", "chr22.map.latool_cache"]
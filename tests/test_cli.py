@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from latool.cli import main
+from latool.io import read_rfmix_msp
+
+
+def test_convert(tmp_path):
+    zarr_path = str(tmp_path / "example.zarr")
+    main(["convert", "tests/testdata/example.msp.tsv", zarr_path, "--chunk-size", "2"])
+    ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    np.testing.assert_array_equal(xr.open_zarr(zarr_path)["locanc"], ds["locanc"])
+
+    pgen_prefix = str(tmp_path / "example")
+    main(["convert", zarr_path, pgen_prefix + ".pgen", "--ancestry", "HCB"])
+    pvar = pd.read_csv(pgen_prefix + ".pvar", sep="\t")
+    np.testing.assert_array_equal(pvar["POS"], ds["marker"])
+
+
+def test_global_ancestry(tmp_path):
+    keep = tmp_path / "keep.txt"
+    keep.write_text("HCB182\nJPT267\n")
+    out = str(tmp_path / "example.Q")
+    main(
+        [
+            "global-ancestry",
+            "tests/testdata/example.msp.tsv",
+            out,
+            "--keep",
+            str(keep),
+            "--region",
+            "1:1000-6000",
+            "--max-memory",
+            "1M",
+        ]
+    )
+    ga = pd.read_csv(out, sep="\t", skiprows=1)
+    assert ga["#sample"].tolist() == ["HCB182", "JPT267"]
+
+
+def test_convert_vcf(tmp_path):
+    from latool.io import read_rfmix_fb
+
+    ds = read_rfmix_fb("tests/testdata/example.fb.tsv")
+    vcf = "tests/testdata/example.vcf"
+    keep = tmp_path / "keep.txt"
+    keep.write_text("HCB182\nJPT267\n")
+    zarr_path = str(tmp_path / "example.zarr")
+    main(["convert", vcf, zarr_path, "--keep", str(keep), "--region", "1:6-31"])
+    expected = ds["locanc"].sel(sample=["HCB182", "JPT267"], marker=slice(6, 31))
+    np.testing.assert_allclose(xr.open_zarr(zarr_path)["locanc"], expected)
+
+
+def test_convert_ts(tmp_path):
+    from latool.io import read_msp_ts
+
+    ts = "tests/testdata/example.ts"
+    ds = read_msp_ts(ts, "ADMIX", ["EUR", "AFR"])
+    keep = tmp_path / "keep.txt"
+    keep.write_text("indiv2\nindiv7\n")
+    zarr_path = str(tmp_path / "example.zarr")
+    main(
+        ["convert", ts, zarr_path, "--keep", str(keep), "--chunk-size", "2"]
+        + ["--admixpop", "ADMIX", "--ancpop", "EUR", "AFR"]
+    )
+    ds_keep = xr.open_zarr(zarr_path)
+    assert ds_keep["sample"].values.tolist() == ["indiv2", "indiv7"]
+    # markers are traced from the kept samples alone
+    expected = ds["locanc"].sel(sample=["indiv2", "indiv7"])
+    expected = expected.sel(marker=ds_keep["marker"].values, method="ffill")
+    np.testing.assert_array_equal(ds_keep["locanc"], expected)
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from latool.encoding import (
+    ancestry_dosage,
+    dense_locanc,
+    global_ancestry,
+    pack_locanc,
+    quantize_locanc,
+    unpack_locanc,
+)
+from latool.io import read_rfmix_fb, read_rfmix_msp, write_pgen, write_Q
+from latool.stats import LAD_eigvals, empirical_LAD
+from latool.util import simplify
+
+
+@pytest.fixture
+def ds_msp():
+    # 70 samples span three 64-bit words
+    rng = np.random.default_rng(0)
+    codes = np.repeat(rng.integers(0, 2, size=(20, 70, 2)), 3, axis=0)
+    return xr.Dataset(
+        data_vars={
+            "locanc": (
+                ["marker", "sample", "ploidy", "ancestry"],
+                np.eye(2, dtype=np.uint8)[codes],
+            )
+        },
+        coords={
+            "marker": np.arange(60) * 100,
+            "sample": [f"indiv{i}" for i in range(70)],
+            "ploidy": [0, 1],
+            "ancestry": ["AFR", "EUR"],
+        },
+    )
+
+
+def test_pack_roundtrip(ds_msp):
+    packed = pack_locanc(ds_msp, "AFR", chunk_size=7)
+    assert packed["locanc_packed"].shape == (60, 3)
+    assert unpack_locanc(packed, chunk_size=11).identical(ds_msp)
+
+    ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    packed = read_rfmix_msp("tests/testdata/example.msp.tsv", chunk_size=2, packed=True)
+    xr.testing.assert_identical(unpack_locanc(packed), ds)
+
+    with pytest.raises(ValueError):
+        pack_locanc(ds_msp.assign(locanc=ds_msp["locanc"] * 0.5))
+
+
+def test_packed_kernels(ds_msp, tmp_path):
+    packed = pack_locanc(ds_msp)
+    for anc in ["AFR", "EUR"]:
+        np.testing.assert_array_equal(
+            ancestry_dosage(packed, anc, chunk_size=7),
+            ancestry_dosage(ds_msp, anc),
+        )
+    np.testing.assert_allclose(
+        global_ancestry(packed), global_ancestry(ds_msp).transpose("sample", ...)
+    )
+
+    lad = empirical_LAD(ds_msp["locanc"].sel(ancestry="EUR").sum(dim="ploidy"))
+    np.testing.assert_allclose(empirical_LAD(packed["locanc_packed"]), lad, atol=1e-12)
+
+    simplified = simplify(packed, chunk_size=7)
+    assert simplified.sizes["marker"] == 20
+    xr.testing.assert_identical(unpack_locanc(simplified), simplify(ds_msp))
+
+    write_Q(packed, str(tmp_path / "packed.Q"))
+    write_Q(ds_msp, str(tmp_path / "dense.Q"))
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "packed.Q", sep="\t", skiprows=1),
+        pd.read_csv(tmp_path / "dense.Q", sep="\t", skiprows=1),
+    )
+
+    write_pgen(str(tmp_path / "packed"), packed, "AFR")
+    write_pgen(str(tmp_path / "dense"), ds_msp, "AFR")
+    assert (tmp_path / "packed.pgen").read_bytes() == (
+        tmp_path / "dense.pgen"
+    ).read_bytes()
+
+
+def test_quantize(tmp_path):
+    fb = "tests/testdata/example.fb.tsv"
+    ds = read_rfmix_fb(fb)
+    for dtype, scale in [("uint8", 255), ("uint16", 65535)]:
+        quantized = read_rfmix_fb(fb, chunk_size=3, quantize=dtype)
+        assert quantized["locanc_quantized"].dtype == dtype
+        assert quantized["locanc_quantized"].shape[-1] == ds.sizes["ancestry"] - 1
+        decoded = dense_locanc(quantized, chunk_size=3)
+        assert decoded.chunks is not None
+        np.testing.assert_allclose(decoded, ds["locanc"], atol=0.5 / scale)
+
+    np.testing.assert_allclose(
+        ancestry_dosage(quantized, "JPT"), ancestry_dosage(ds, "JPT"), atol=1e-4
+    )
+    lad = LAD_eigvals(ancestry_dosage(quantized, "JPT", chunk_size=3), k=3, seed=0)
+    np.testing.assert_allclose(
+        lad, LAD_eigvals(ancestry_dosage(ds, "JPT"), k=3, seed=0), atol=1e-3
+    )
+
+    ga = write_Q(quantized, str(tmp_path / "quantized.Q"))
+    np.testing.assert_allclose(
+        ga[["HCB", "JPT"]],
+        write_Q(ds, str(tmp_path / "dense.Q"))[["HCB", "JPT"]],
+        atol=1e-4,
+    )
+    write_pgen(str(tmp_path / "quantized"), quantized, "HCB", chunk_size=3)
+
+    # the implied last ancestry sums the errors of the A - 1 stored ones
+    A = 5
+    prob = np.random.default_rng(4).dirichlet(np.ones(A), size=(200, 10, 2))
+    ds5 = xr.Dataset(
+        {"locanc": (["marker", "sample", "ploidy", "ancestry"], prob)},
+        coords={"ancestry": [f"POP{a}" for a in range(A)]},
+    )
+    error = abs(dense_locanc(quantize_locanc(ds5)) - ds5["locanc"]).values
+    assert error[..., :-1].max() <= 0.5 / 255
+    assert 0.5 / 255 < error[..., -1].max() <= (A - 1) * 0.5 / 255
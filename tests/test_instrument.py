@@ -0,0 +1,64 @@
+import os
+
+from latool import instrument
+from latool.cli import main
+from latool.io import (
+    plan_shards,
+    read_rfmix_msp,
+    run_shard,
+    write_pgen,
+    write_rfmix_fb,
+)
+
+
+def test_events(tmp_path):
+    events = []
+    reporter = instrument.SummaryReporter()
+    with instrument.instrument(events.append, reporter):
+        ds = read_rfmix_msp("tests/testdata/example.msp.tsv", chunk_size=2)
+        write_rfmix_fb(ds, str(tmp_path / "example.fb.tsv"), chunk_size=3)
+        write_pgen(str(tmp_path / "example"), ds, "HCB")
+    assert not instrument.enabled()
+
+    read = [e for e in events if e.phase == "read_rfmix_msp"]
+    n_chunk = -(-ds.sizes["marker"] // 2)
+    assert [e.kind for e in read] == ["start"] + ["progress"] * n_chunk + ["end"]
+    assert read[-1].rows == ds.sizes["marker"]
+    assert read[-1].bytes_read == os.path.getsize("tests/testdata/example.msp.tsv")
+    assert read[-1].peak_rss > 0
+
+    written = reporter.totals["write_rfmix_fb"]
+    assert written["rows"] == ds.sizes["marker"]
+    assert 0 < written["bytes_written"] < os.path.getsize(tmp_path / "example.fb.tsv")
+    assert {"write_pgen/pgen", "write_pgen/psam", "write_pgen/pvar"} <= set(
+        reporter.totals
+    )
+    assert "write_pgen/pvar" in reporter.report()
+
+
+def test_disabled():
+    assert instrument.phase("noop") is instrument._NULL_PHASE
+    instrument.progress(rows=1)
+
+
+def test_cli_profile(tmp_path, capsys):
+    out = str(tmp_path / "example.Q")
+    main(["global-ancestry", "tests/testdata/example.msp.tsv", out, "--profile"])
+    err = capsys.readouterr().err
+    assert "global-ancestry/write_Q" in err
+    assert "input" in err
+
+
+def test_shard_bytes(tmp_path):
+    tasks = plan_shards(
+        "tests/testdata/example.msp.tsv", str(tmp_path), by="region", n_shards=3
+    )
+    events = []
+    with instrument.instrument(events.append):
+        for task in tasks:
+            run_shard(str(tmp_path), task["index"])
+    ends = [e for e in events if e.phase == "run_shard" and e.kind == "end"]
+    # every task reads its own byte range of the file
+    assert [e.bytes_read for e in ends] == [
+        b - a for a, b in (t["byte_range"] for t in tasks)
+    ]
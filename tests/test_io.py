@@ -0,0 +1,308 @@
+import gzip
+import os
+import time
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from latool.io import (
+    append_samples,
+    convert_pgen,
+    merge_shards,
+    open_store,
+    pipeline,
+    plan_shards,
+    read_la_vcf,
+    read_msp_ts,
+    read_rfmix_fb,
+    read_rfmix_genome,
+    read_rfmix_msp,
+    read_summary,
+    run_shard,
+    run_shards,
+    write_pgen,
+    write_Q,
+    write_sample_major,
+)
+from latool.stats import (
+    ancestry_sharing,
+    ancestry_tracts,
+    empirical_LAD,
+    summary_LAD,
+)
+
+
+def test_read_rfmix_genome(tmp_path):
+    with open("tests/testdata/example.msp.tsv") as f:
+        lines = f.readlines()
+    for chrom in ["2", "10"]:
+        with open(tmp_path / f"chr{chrom}.msp.tsv", "w") as f:
+            f.writelines(lines[:2] + [chrom + line[1:] for line in lines[2:]])
+
+    ds = read_rfmix_genome(str(tmp_path / "*.msp.tsv"), n_workers=2, chunk_size=3)
+    ds_chrom = read_rfmix_msp("tests/testdata/example.msp.tsv")
+
+    np.testing.assert_array_equal(ds["chrom"], ["2"] * 5 + ["10"] * 5)
+    np.testing.assert_array_equal(ds["locanc"][5:], ds_chrom["locanc"])
+    assert ds["locanc"].chunks[0] == (3, 3, 3, 1)
+
+    # chromosomes are streamed to zarr stores and opened lazily
+    store = tmp_path / "store"
+    ds_store = read_rfmix_genome(str(tmp_path / "*.msp.tsv"), n_workers=2, store=store)
+    assert sorted(os.listdir(store)) == ["chr10.msp.tsv.zarr", "chr2.msp.tsv.zarr"]
+    assert ds_store["locanc"].chunks is not None
+    xr.testing.assert_identical(ds_store.load(), ds.load())
+
+    with open(tmp_path / "chr3.msp.tsv", "w") as f:
+        f.writelines(lines[:2])
+    with pytest.raises(ValueError, match="No markers"):
+        read_rfmix_genome(str(tmp_path / "*.msp.tsv"), n_workers=2)
+
+
+def test_read_rfmix_genome_after_kernels(tmp_path):
+    # parallel kernels running in the parent before the process pool is created
+    read_rfmix_msp("tests/testdata/example.msp.tsv")
+    with open("tests/testdata/example.msp.tsv") as f:
+        lines = f.readlines()
+    for chrom in ["1", "2"]:
+        with open(tmp_path / f"chr{chrom}.msp.tsv", "w") as f:
+            f.writelines(lines[:2] + [chrom + line[1:] for line in lines[2:]])
+
+    ds = read_rfmix_genome(str(tmp_path / "*.msp.tsv"), n_workers=2)
+    assert ds.sizes["marker"] == 10
+
+
+def test_pipeline():
+    def slow_square(x):
+        time.sleep(0.01 * (x % 3))
+        return x * x
+
+    assert list(pipeline(range(20), slow_square, n_workers=4, queue_size=2)) == [
+        x * x for x in range(20)
+    ]
+
+    def fail(x):
+        if x == 5:
+            raise ValueError("bad chunk")
+        return x
+
+    read = []
+
+    def chunks():
+        for x in range(1000):
+            read.append(x)
+            yield x
+
+    with pytest.raises(ValueError, match="bad chunk"):
+        list(pipeline(chunks(), fail, n_workers=2, queue_size=2))
+    # the reader stops once the consumer fails, a bounded number of chunks ahead
+    assert len(read) < 20
+
+
+@pytest.mark.parametrize(
+    "source", ["tests/testdata/example.fb.tsv", "tests/testdata/example.msp.tsv"]
+)
+def test_convert_pgen(tmp_path, source):
+    reader = read_rfmix_fb if source.endswith(".fb.tsv") else read_rfmix_msp
+    ds = reader(source)
+    write_pgen(str(tmp_path / "expected"), ds, "HCB")
+
+    convert_pgen(source, str(tmp_path / "file"), "HCB", chunk_size=3, n_workers=2)
+    convert_pgen(
+        ds.chunk({"marker": 2}), str(tmp_path / "ds"), "HCB", chunk_size=2, queue_size=1
+    )
+
+    for prefix in ["file", "ds"]:
+        for suffix in ["pgen", "psam", "pvar"]:
+            with open(tmp_path / f"expected.{suffix}", "rb") as f:
+                expected = f.read()
+            with open(tmp_path / f"{prefix}.{suffix}", "rb") as f:
+                assert f.read() == expected
+
+    with pytest.raises(KeyError):
+        convert_pgen(source, str(tmp_path / "bad"), "YRI")
+
+    # blank lines at the end of the file are not markers
+    blank = str(tmp_path / os.path.basename(source))
+    with open(source) as f_in, open(blank, "w") as f_out:
+        f_out.write(f_in.read().rstrip("\n") + "\n\n\n")
+    convert_pgen(blank, str(tmp_path / "blank"), "HCB", chunk_size=3)
+    for suffix in ["pgen", "psam", "pvar"]:
+        with open(tmp_path / f"expected.{suffix}", "rb") as f:
+            expected = f.read()
+        with open(tmp_path / f"blank.{suffix}", "rb") as f:
+            assert f.read() == expected
+
+
+def test_read_la_vcf(tmp_path, monkeypatch):
+    # FLARE output with the posteriors of example.fb.tsv
+    ds_fb = read_rfmix_fb("tests/testdata/example.fb.tsv")
+    fname = "tests/testdata/example.vcf"
+
+    ds = read_la_vcf(fname, chunk_size=3)
+    xr.testing.assert_allclose(ds["locanc"], ds_fb["locanc"])
+    # lines split across reads
+    monkeypatch.setattr("latool.io.vcf_read._BLOCK_BYTES", 100)
+    xr.testing.assert_identical(read_la_vcf(fname, chunk_size=3), ds)
+    assert read_la_vcf(fname, chunk_size=3, posterior=False).sizes["marker"] == 8
+    np.testing.assert_array_equal(ds["chrom"], ds_fb["chrom"])
+
+    # calls only, one-hot or as codes
+    code = ds_fb["locanc"].argmax("ancestry")
+    ds_call = read_la_vcf(fname, posterior=False, chunk_size=5)
+    np.testing.assert_array_equal(ds_call["locanc"].argmax("ancestry"), code)
+    assert ds_call["locanc"].dtype == np.uint8
+    ds_code = read_la_vcf(fname, posterior=False, one_hot=False)
+    np.testing.assert_array_equal(ds_code["locanc_code"], code)
+
+    # sample and region pushdown, from a bgzip-compatible file
+    fname_gz = str(tmp_path / "example.vcf.gz")
+    with open(fname, "rb") as f, gzip.open(fname_gz, "wb") as f_gz:
+        f_gz.write(f.read())
+    samples = ["JPT267", "HCB190"]
+    ds_sub = read_la_vcf(fname_gz, samples=samples, region="1:6-31")
+    xr.testing.assert_allclose(
+        ds_sub["locanc"], ds_fb["locanc"].sel(sample=samples, marker=slice(6, 31))
+    )
+
+    with pytest.raises(KeyError):
+        read_la_vcf(fname, samples=["nobody"])
+    with pytest.raises(ValueError, match="No markers"):
+        read_la_vcf(fname, region="2")
+    with open(fname) as f:
+        lines = f.read().replace(":1,", ":x,", 1)
+    with open(tmp_path / "malformed.vcf", "w") as f:
+        f.write(lines)
+    with pytest.raises(ValueError, match="Malformed"):
+        read_la_vcf(str(tmp_path / "malformed.vcf"))
+
+
+def test_write_sample_major(tmp_path):
+    ds = read_rfmix_fb("tests/testdata/example.fb.tsv")
+    store = str(tmp_path / "example.zarr")
+    ds.drop_vars("chrom").chunk({"marker": 7}).to_zarr(store)
+
+    companion = write_sample_major(store, sample_chunk=4)
+    assert companion == str(tmp_path / "example.sample_major.zarr")
+    assert sorted(os.listdir(tmp_path)) == ["example.sample_major.zarr", "example.zarr"]
+
+    ds_both = open_store(store)
+    by_sample = ds_both["locanc_by_sample"]
+    assert by_sample.dims == ("sample", "marker", "ploidy", "ancestry")
+    assert by_sample.chunks[0][0] == 4 and by_sample.chunks[1][0] == 7
+    np.testing.assert_array_equal(
+        by_sample.values, ds["locanc"].values.transpose(1, 0, 2, 3)
+    )
+
+    # the same results from either layout, with blocks of a few samples
+    ds_marker = xr.open_zarr(store)
+    max_memory = 5 * ds.sizes["marker"] * 4 * 28
+    np.testing.assert_allclose(
+        write_Q(ds_both, str(tmp_path / "both.Q"), max_memory=max_memory).iloc[:, 1:],
+        write_Q(ds_marker, str(tmp_path / "marker.Q")).iloc[:, 1:],
+    )
+    tracts = ancestry_tracts(ds_both, unit="physical", max_memory=max_memory)
+    expected = ancestry_tracts(ds_marker, unit="physical")
+    xr.testing.assert_equal(tracts, expected)
+    np.testing.assert_allclose(
+        ancestry_sharing(ds_both, max_memory=20000).values,
+        ancestry_sharing(ds_marker, max_memory=20000).values,
+        rtol=1e-6,
+    )
+
+    # a companion of other markers is ignored
+    ds.isel(marker=slice(5)).drop_vars("chrom").to_zarr(store, mode="w")
+    assert "locanc_by_sample" not in open_store(store)
+
+
+def test_append_samples(tmp_path):
+    ds = read_rfmix_fb("tests/testdata/example.fb.tsv").drop_vars("chrom")
+    store, pgen = str(tmp_path / "cohort.zarr"), str(tmp_path / "cohort")
+    batches = [slice(0, 20), slice(20, 27), slice(27, 39)]
+
+    append_samples(store, ds.isel(sample=batches[0]), pgen, "HCB", "HCB", 3)
+    write_sample_major(store, sample_chunk=8)
+    for b in batches[1:]:
+        summary = append_samples(
+            store, ds.isel(sample=b), pgen, "HCB", "HCB", chunk_size=3
+        )
+
+    ds_store = open_store(store)
+    np.testing.assert_array_equal(ds_store["sample"], ds["sample"])
+    np.testing.assert_array_equal(ds_store["locanc"], ds["locanc"])
+    np.testing.assert_array_equal(
+        ds_store["locanc_by_sample"], ds["locanc"].transpose("sample", ...)
+    )
+    # the chunks of the first batch are left as they are
+    assert ds_store["locanc"].chunks[1] == (20, 19)
+
+    # statistics of the whole cohort
+    summary = read_summary(store)
+    assert int(summary["n_sample"]) == 39 and summary.attrs["n_batch"] == 3
+    np.testing.assert_allclose(
+        summary["locanc_sum"], ds["locanc"].sum(dim=["sample", "ploidy"]), rtol=1e-6
+    )
+    ga = write_Q(ds, str(tmp_path / "cohort.Q")).set_index("#sample")
+    np.testing.assert_allclose(summary["global_ancestry"], ga.values, rtol=1e-6)
+    dosage = ds["locanc"].sel(ancestry="HCB").sum(dim="ploidy").astype(np.float64)
+    np.testing.assert_allclose(
+        summary_LAD(summary), empirical_LAD(dosage), rtol=1e-6, atol=1e-9
+    )
+
+    # one pgen fileset per batch
+    with open(f"{pgen}.pmerge_list") as f:
+        prefixes = f.read().split()
+    assert prefixes == [f"{pgen}.batch{k}" for k in range(3)]
+    for prefix, b in zip(prefixes, batches):
+        psam = np.loadtxt(f"{prefix}.psam", dtype=str, skiprows=1)[:, 0]
+        np.testing.assert_array_equal(psam, ds["sample"].values[b])
+
+    with pytest.raises(ValueError, match="already"):
+        append_samples(store, ds.isel(sample=slice(0, 2)))
+    with pytest.raises(ValueError, match="marker"):
+        append_samples(store, ds.isel(sample=slice(0, 2), marker=slice(4)))
+
+
+@pytest.mark.parametrize(
+    "source,by",
+    [
+        ("tests/testdata/example.fb.tsv", "sample"),
+        ("tests/testdata/example.fb.tsv", "region"),
+        ("tests/testdata/example.msp.tsv", "sample"),
+        ("tests/testdata/example.msp.tsv", "region"),
+        ("tests/testdata/example.ts", "sample"),
+        ("tests/testdata/example.ts", "region"),
+    ],
+)
+def test_shards(tmp_path, source, by):
+    out_dir = str(tmp_path / "shards")
+    ts_kwargs = {}
+    if source.endswith(".ts"):
+        ts_kwargs = dict(admixpop="ADMIX", ancpop=["EUR", "AFR"])
+        expected = read_msp_ts(source, **ts_kwargs)
+    elif source.endswith(".fb.tsv"):
+        expected = read_rfmix_fb(source)
+    else:
+        expected = read_rfmix_msp(source)
+    tasks = plan_shards(source, out_dir, by, n_shards=3, chunk_size=2, **ts_kwargs)
+    assert len(tasks) == 3
+
+    # a task run elsewhere is not run again
+    assert run_shard(out_dir, 1)["index"] == 1
+    with pytest.raises(FileNotFoundError, match=r"\[0, 2\]"):
+        merge_shards(out_dir)
+    manifests = run_shards(out_dir, n_workers=2)
+    assert [m["index"] for m in manifests] == [0, 2]
+    assert sorted(os.listdir(out_dir)) == ["plan.json"] + [
+        f"shard-{i:05d}.{ext}" for i in range(3) for ext in ["json", "zarr"]
+    ]
+
+    ds = merge_shards(out_dir)
+    assert ds["locanc"].chunks is not None
+    if by == "region" and source.endswith(".ts"):
+        # segments are cut at the shard boundaries, adding markers
+        assert ds.sizes["marker"] > expected.sizes["marker"]
+        ds = ds.sel(marker=expected["marker"], method="ffill")
+        ds["marker"] = expected["marker"]
+    xr.testing.assert_equal(ds.load(), expected)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from latool import _kernels
+
+
+@pytest.fixture
+def codes():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 3, size=(50, 7, 2)).astype(np.uint32)
+
+
+def test_one_hot(codes):
+    np.testing.assert_array_equal(
+        _kernels.one_hot(codes, 3), np.eye(3, dtype=np.uint8)[codes]
+    )
+    with pytest.raises(ValueError):
+        _kernels.one_hot(codes, 2)
+
+
+def test_code_dosage(codes):
+    for code in range(3):
+        np.testing.assert_array_equal(
+            _kernels.code_dosage(codes, code), (codes == code).sum(axis=2)
+        )
+
+
+def test_ploidy_sum(codes):
+    locanc = np.eye(3, dtype=np.uint8)[codes]
+    prob = np.random.default_rng(1).random(locanc.shape).astype(np.float32)
+    for a in range(3):
+        dosage = _kernels.ploidy_sum(locanc, a)
+        assert dosage.dtype == np.uint8
+        np.testing.assert_array_equal(dosage, locanc[..., a].sum(axis=2))
+        dosage = _kernels.ploidy_sum(prob, a)
+        assert dosage.dtype == np.float32
+        np.testing.assert_allclose(dosage, prob[..., a].sum(axis=2), rtol=1e-6)
+
+
+def test_adjacent_equal(codes):
+    rows = np.repeat(codes, 2, axis=0)
+    rows[3, 6, 1] += 1
+    expected = np.r_[False, (rows[1:] == rows[:-1]).all(axis=(1, 2))]
+    np.testing.assert_array_equal(_kernels.adjacent_equal(rows), expected)
+    # compared as bytes, whatever the dtype
+    floats = rows.astype(np.float32)
+    np.testing.assert_array_equal(_kernels.adjacent_equal(floats), expected)
+
+
+def test_marker_sum(codes):
+    locanc = np.eye(3, dtype=np.float32)[codes]
+    weight = np.random.default_rng(2).random(codes.shape[0])
+    np.testing.assert_allclose(
+        _kernels.marker_sum(locanc), locanc.sum(axis=(0, 2)), rtol=1e-10
+    )
+    np.testing.assert_allclose(
+        _kernels.marker_sum(locanc, weight),
+        np.einsum("m,mnpa->na", weight, locanc),
+        rtol=1e-10,
+    )
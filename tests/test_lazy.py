@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+import xarray as xr
+from dask.callbacks import Callback
+
+from latool.annotate import genetic_distance
+from latool.encoding import (
+    ancestry_dosage,
+    dense_locanc,
+    pack_locanc,
+    quantize_locanc,
+    unpack_locanc,
+)
+from latool.io import read_msp_ts, write_pgen, write_Q, write_rfmix_fb
+from latool.stats import (
+    LAD_eigvals,
+    admixture_scan,
+    ancestry_sharing,
+    ancestry_tracts,
+    empirical_LAD,
+)
+from latool.util import fill_pos, simplify
+
+CHUNK = 20
+
+
+class MaxTaskResult(Callback):
+    """Record the size of the largest result of any dask task"""
+
+    def __init__(self):
+        super().__init__()
+        self.nbytes = 0
+
+    def _posttask(self, key, result, dsk, state, id):
+        self.nbytes = max(self.nbytes, getattr(result, "nbytes", 0))
+
+
+@pytest.fixture
+def ds_lazy():
+    rng = np.random.default_rng(0)
+    codes = np.repeat(rng.integers(0, 2, size=(100, 50, 2)), 2, axis=0)
+    pos = np.arange(200, dtype=np.uint32) * 1000 + 1
+    ds = xr.Dataset(
+        data_vars={
+            "locanc": (
+                ["marker", "sample", "ploidy", "ancestry"],
+                np.eye(2, dtype=np.float32)[codes],
+            ),
+            "left_position": ("marker", pos),
+            "right_position": ("marker", pos + 1000),
+            "genetic_position": ("marker", pos * 1e-6),
+        },
+        coords={
+            "marker": pos + 500,
+            "chrom": ("marker", np.full(200, "1", dtype=object)),
+            "sample": [f"indiv{i}" for i in range(50)],
+            "ploidy": [0, 1],
+            "ancestry": ["AFR", "EUR"],
+        },
+    )
+    return ds.chunk({"marker": CHUNK})
+
+
+def assert_no_materialization(ds, func):
+    """Run ``func`` and check that no task result holds a quarter of locanc"""
+    with MaxTaskResult() as callback:
+        result = func()
+    assert callback.nbytes < ds["locanc"].nbytes / 4
+    return result
+
+
+def test_lazy_output(ds_lazy, tmp_path):
+    genetic_map = tmp_path / "chr1.map"
+    genetic_map.write_text("chr pos rate cM\n1 0 1 0\n1 1000000 1 1\n")
+
+    lazy = {
+        "simplify": lambda: simplify(ds_lazy, chunk_size=CHUNK)["locanc"],
+        "fill_pos": lambda: fill_pos(ds_lazy, [1500, 2500])["locanc"],
+        "genetic_distance": lambda: genetic_distance(ds_lazy, str(genetic_map))[
+            "locanc"
+        ],
+        "pack": lambda: pack_locanc(ds_lazy)["locanc_packed"],
+        "unpack": lambda: unpack_locanc(pack_locanc(ds_lazy))["locanc"],
+        "quantize": lambda: quantize_locanc(ds_lazy)["locanc_quantized"],
+        "dequantize": lambda: dense_locanc(quantize_locanc(ds_lazy)),
+        "dosage": lambda: ancestry_dosage(ds_lazy, "AFR"),
+        "packed_dosage": lambda: ancestry_dosage(pack_locanc(ds_lazy), "AFR"),
+        "empirical_LAD": lambda: empirical_LAD(ancestry_dosage(ds_lazy, "AFR")),
+    }
+    for name, func in lazy.items():
+        da = assert_no_materialization(ds_lazy, func)
+        assert da.chunks is not None, name
+
+    ds = ds_lazy.compute()
+    xr.testing.assert_equal(unpack_locanc(pack_locanc(ds_lazy)).compute(), ds)
+    np.testing.assert_allclose(
+        empirical_LAD(ancestry_dosage(ds_lazy, "AFR")),
+        empirical_LAD(ancestry_dosage(ds, "AFR")),
+        atol=1e-12,
+    )
+
+
+def test_lazy_reductions(ds_lazy, tmp_path):
+    dosage = ancestry_dosage(ds_lazy, "AFR")
+    pheno = xr.DataArray(
+        np.random.default_rng(1).normal(size=50),
+        dims=["sample"],
+        coords={"sample": ds_lazy["sample"].values},
+    )
+    out = str(tmp_path / "out")
+    calls = [
+        lambda: write_pgen(out, ds_lazy, "AFR", chunk_size=CHUNK),
+        lambda: write_rfmix_fb(ds_lazy, out + ".fb.tsv", chunk_size=CHUNK),
+        lambda: write_Q(ds_lazy, out + ".Q"),
+        lambda: LAD_eigvals(dosage, k=5, chunk_size=CHUNK, seed=0),
+        lambda: admixture_scan(dosage, pheno, chunk_size=CHUNK),
+        lambda: ancestry_tracts(ds_lazy, chunk_size=CHUNK),
+        lambda: ancestry_sharing(ds_lazy, chunk_size=CHUNK),
+    ]
+    for func in calls:
+        assert_no_materialization(ds_lazy, func)
+
+
+def test_read_msp_ts_chunked():
+    kwargs = dict(fname="tests/testdata/example.ts", admixpop="ADMIX")
+    ds = read_msp_ts(ancpop=["EUR", "AFR"], **kwargs)
+    ds_lazy = read_msp_ts(ancpop=["EUR", "AFR"], chunk_size=2, **kwargs)
+    assert ds_lazy["locanc"].chunks[0] == (2, 2, 1)
+    xr.testing.assert_identical(ds_lazy.compute(), ds)
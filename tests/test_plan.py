@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from latool import instrument
+from latool.encoding import pack_locanc
+from latool.io import read_rfmix_fb, read_rfmix_msp
+from latool.plan import parse_memory, plan_chunks, plan_dataset
+from latool.stats import ancestry_sharing
+
+
+def test_plan_chunks():
+    plan = plan_chunks("reduce", n_sample=1000, n_ancestry=2, max_memory="10M")
+    assert plan.sample == 1000
+    assert plan.memory <= 10 * 2**20 < plan.memory + plan.bytes_per_marker
+
+    # workers share the budget
+    plan_threads = plan_chunks(
+        "reduce", n_sample=1000, n_ancestry=2, max_memory="10M", n_workers=4
+    )
+    assert plan_threads.marker == plan.marker // 4
+    assert plan_chunks("reduce", 1000, 2, n_marker=7).marker == 7
+
+    # samples are split when a few markers do not fit
+    plan = plan_chunks("tile", n_sample=10**6, n_ancestry=3, max_memory="64M")
+    assert plan.sample < 10**6 and plan.memory <= 64 * 2**20
+    plan = plan_chunks("reduce", n_sample=10**6, n_ancestry=3, max_memory="64M")
+    assert plan.marker == 1 and plan.sample == 10**6
+
+    with pytest.raises(ValueError):
+        plan_chunks("sort", 10, 2)
+
+
+def test_parse_memory(monkeypatch):
+    assert parse_memory("512M") == 512 * 2**20
+    assert parse_memory("1.5g") == 3 * 2**29
+    assert parse_memory(100) == 100
+    with pytest.raises(ValueError):
+        parse_memory("lots")
+
+    monkeypatch.setenv("LATOOL_MAX_MEMORY", "2M")
+    assert plan_chunks("reduce", 10, 2).max_memory == 2 * 2**20
+
+
+def test_plan_dataset():
+    ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    plan = plan_dataset("encode", ds, max_memory=5000)
+    # one-hot uint8 cells and an 8 byte working copy
+    assert plan.bytes_per_marker == ds.sizes["sample"] * 2 * 2 * 9
+    assert plan.marker == 5000 // plan.bytes_per_marker == 3
+
+    packed = plan_dataset("encode", pack_locanc(ds), max_memory=5000)
+    assert packed.bytes_per_marker < plan.bytes_per_marker
+    assert plan_dataset("encode", ds["locanc"].sum("ploidy")).marker == 5
+
+
+def test_planned_entry_points():
+    ds = read_rfmix_fb("tests/testdata/example.fb.tsv")
+    events = []
+    with instrument.instrument(events.append):
+        ds_planned = read_rfmix_fb("tests/testdata/example.fb.tsv", max_memory=20000)
+    progress = [e for e in events if e.kind == "progress"]
+    assert len(progress) > 1
+    assert ds_planned.equals(ds)
+
+    sharing = ancestry_sharing(ds, level="haplotype")
+    sharing_planned = ancestry_sharing(ds, level="haplotype", max_memory=2000)
+    np.testing.assert_allclose(sharing_planned, sharing, rtol=1e-5)
@@ -0,0 +1,39 @@
+import re
+import subprocess
+import sys
+
+HEAVY_MODULES = ["msprime", "tskit", "pgenlib", "numba", "scipy", "dask"]
+
+# generous bound on the cumulative import time of latool.io, in microseconds
+IMPORT_TIME_BUDGET = 500_000
+
+
+def _run(code):
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_import_io_is_lazy():
+    proc = _run(
+        "import sys, latool.io, latool.stats;"
+        f"print([m for m in {HEAVY_MODULES} if m in sys.modules])"
+    )
+    assert proc.stdout.strip() == "[]"
+
+
+def test_rfmix_reader_skips_heavy_backends():
+    proc = _run(
+        "import sys; from latool.io import read_rfmix_fb;"
+        f"print([m for m in {HEAVY_MODULES} if m in sys.modules])"
+    )
+    assert proc.stdout.strip() == "[]"
+
+
+def test_import_io_time():
+    proc = _run("import latool.io")
+    cumulative = re.search(r"\|\s*(\d+) \| latool.io$", proc.stderr, re.MULTILINE)
+    assert int(cumulative.group(1)) < IMPORT_TIME_BUDGET
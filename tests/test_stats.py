@@ -0,0 +1,270 @@
+import msprime
+import numpy as np
+import pytest
+import tskit
+import xarray as xr
+
+from latool import instrument
+from latool.io import read_msp_mutations, read_msp_ts
+from latool.stats import (
+    AncestryIndex,
+    LAD_eigvals,
+    admixture_scan,
+    admixture_time,
+    ancestry_allele_freq,
+    ancestry_sharing,
+    ancestry_tracts,
+    effective_tests,
+    empirical_LAD,
+)
+from latool.util import fill_pos
+
+
+@pytest.fixture
+def da_dosage():
+    """Ancestry dosage switching along 500 markers for 60 samples"""
+    rng = np.random.default_rng(0)
+    x = np.zeros((500, 60))
+    x[0] = rng.integers(0, 3, 60)
+    for i in range(1, 500):
+        switch = rng.random(60) < 0.05
+        x[i] = np.where(switch, rng.integers(0, 3, 60), x[i - 1])
+    return xr.DataArray(x, dims=["marker", "sample"], coords={"marker": np.arange(500)})
+
+
+def test_LAD_eigvals(da_dosage):
+    exact = np.linalg.eigvalsh(empirical_LAD(da_dosage).values)[::-1]
+
+    eigvals = LAD_eigvals(da_dosage, k=60, chunk_size=128, seed=0)
+    np.testing.assert_allclose(eigvals.values, exact[:60], atol=1e-8)
+    assert eigvals.attrs["trace"] == 500
+
+    lam = exact[exact > 1e-8]
+    meff, threshold = effective_tests(eigvals)
+    assert meff == pytest.approx(np.sum((lam >= 1) + (lam - np.floor(lam))))
+    assert threshold == pytest.approx(0.05 / meff)
+
+
+def test_admixture_scan(da_dosage):
+    rng = np.random.default_rng(1)
+    da_dosage = da_dosage.assign_coords(sample=np.arange(60))
+    covar = xr.DataArray(rng.normal(size=(60, 1)), dims=["sample", "covariate"])
+    y = 0.5 * da_dosage.values[10] + rng.normal(size=60)
+    pheno = xr.DataArray(y, dims=["sample"], name="y")
+
+    ds_scan = admixture_scan(da_dosage, pheno, covar=covar, chunk_size=64)
+    assert ds_scan["beta"].dims == ("marker", "trait")
+
+    design = np.c_[np.ones(60), covar.values, da_dosage.values.mean(0), da_dosage[10]]
+    beta, rss, _, _ = np.linalg.lstsq(design, y, rcond=None)
+    se = np.sqrt(rss[0] / (60 - 4) * np.linalg.inv(design.T @ design)[-1, -1])
+    np.testing.assert_allclose(ds_scan["beta"][10, 0], beta[-1])
+    np.testing.assert_allclose(ds_scan["se"][10, 0], se)
+
+    # traits first, and precomputed global ancestry
+    pheno2 = xr.DataArray(
+        np.c_[y, rng.normal(size=60)].T,
+        dims=["trait", "sample"],
+        coords={"trait": ["y", "z"], "sample": np.arange(60)},
+    )
+    ga = da_dosage.mean("marker")
+    ds_scan2 = admixture_scan(da_dosage, pheno2, covar, global_ancestry=ga)
+    np.testing.assert_allclose(ds_scan2["beta"].sel(trait="y"), ds_scan["beta"][:, 0])
+
+
+def test_admixture_scan_logistic(da_dosage):
+    rng = np.random.default_rng(3)
+    da_dosage = da_dosage.assign_coords(sample=np.arange(60))
+    y = (rng.random((60, 3)) < 0.2 + 0.2 * da_dosage.values[[5, 50, 200]].T) * 1.0
+    pheno = xr.DataArray(y, dims=["sample", "trait"])
+
+    ds_scan = admixture_scan(da_dosage, pheno, model="logistic", chunk_size=64)
+    for j in range(3):
+        ds_single = admixture_scan(
+            da_dosage, pheno[:, j], model="logistic", chunk_size=64
+        )
+        np.testing.assert_allclose(ds_scan["stat"][:, j], ds_single["stat"][:, 0])
+
+    # score test with the efficient information, per trait and marker
+    C = np.c_[np.ones(60), da_dosage.values.mean(0)]
+    x = da_dosage.values[5]
+    mu = np.full(60, y[:, 0].mean())
+    for _ in range(50):
+        w = mu * (1 - mu)
+        beta = np.linalg.solve(C.T @ (C * w[:, None]), C.T @ (y[:, 0] - mu))
+        mu = 1 / (1 + np.exp(-(np.log(mu / (1 - mu)) + C @ beta)))
+    w = mu * (1 - mu)
+    xwc = (x * w) @ C
+    V = (x**2 * w).sum() - xwc @ np.linalg.inv(C.T @ (C * w[:, None])) @ xwc
+    stat = x @ (y[:, 0] - mu) / np.sqrt(V)
+    np.testing.assert_allclose(ds_scan["stat"][5, 0], stat, rtol=1e-6)
+
+
+def test_ancestry_allele_freq():
+    rng = np.random.default_rng(2)
+    gt = rng.integers(0, 2, (20, 15, 2))
+    gt[0, 0, 0] = -1
+    code = rng.integers(0, 3, (20, 15, 2))
+    coords = {"marker": np.arange(20), "sample": np.arange(15), "ploidy": [0, 1]}
+    ds_gt = xr.Dataset(
+        {"genotype": (["marker", "sample", "ploidy"], gt)}, coords=coords
+    )
+    ds_locanc = xr.Dataset(
+        {"locanc": (["marker", "sample", "ploidy", "ancestry"], np.eye(3)[code])},
+        coords={**coords, "ancestry": ["A", "B", "C"]},
+    )
+
+    ds_freq = ancestry_allele_freq(ds_gt, ds_locanc, chunk_size=7)
+    for m in [0, 11]:
+        for a in range(3):
+            carrier = (code[m] == a) & (gt[m] >= 0)
+            assert ds_freq["allele_count"][m, a] == carrier.sum()
+            assert ds_freq["freq"][m, a] == pytest.approx(gt[m][carrier].mean())
+
+
+def test_ancestry_allele_freq_ts(tmp_path):
+    ts = msprime.sim_mutations(
+        tskit.load("tests/testdata/example.ts"), rate=1e-9, random_seed=1
+    )
+    fname = str(tmp_path / "mutations.ts")
+    ts.dump(fname)
+    kwargs = dict(admixpop="ADMIX", ancpop=["EUR", "AFR"])
+    ds_gt = read_msp_mutations(fname, **kwargs)
+    ds_locanc = read_msp_ts(fname, **kwargs)
+    assert ds_gt.sizes["marker"] > 0
+    # markers are the starts of the traced segments, not the sites
+    with pytest.raises(ValueError, match="same markers"):
+        ancestry_allele_freq(ds_gt, ds_locanc)
+
+    ds_locanc = fill_pos(ds_locanc, ds_gt["marker"].values, policy="raise")
+    ds_freq = ancestry_allele_freq(ds_gt, ds_locanc, chunk_size=7)
+    gt = ds_gt["genotype"].values
+    code = ds_locanc["locanc"].sel(sample=ds_gt["sample"]).values.argmax(axis=-1)
+    for a in range(2):
+        carrier = code == a
+        np.testing.assert_array_equal(
+            ds_freq["allele_count"][:, a], carrier.sum(axis=(1, 2))
+        )
+        np.testing.assert_array_equal(
+            ds_freq["alt_count"][:, a], (carrier & (gt > 0)).sum(axis=(1, 2))
+        )
+
+
+def test_ancestry_tracts():
+    code = np.array([[0, 1], [0, 1], [1, 1], [1, 0], [0, 0]])
+    ds = xr.Dataset(
+        {
+            "locanc": (
+                ["marker", "sample", "ploidy", "ancestry"],
+                np.eye(2)[code][:, None],
+            ),
+            "genetic_position": ("marker", [0.0, 10.0, 20.0, 30.0, 40.0]),
+        },
+        coords={"marker": np.arange(5), "ancestry": ["A", "B"]},
+    )
+
+    tracts = ancestry_tracts(ds, chunk_size=2)
+    np.testing.assert_array_equal(tracts["ploidy"], [0, 0, 0, 1, 1])
+    np.testing.assert_array_equal(tracts["ancestry"], ["A", "B", "A", "B", "A"])
+    np.testing.assert_array_equal(tracts["start"], [0, 2, 4, 0, 3])
+    # the last marker spans the mean spacing of 10 cM
+    np.testing.assert_array_equal(tracts["length"], [20, 20, 10, 30, 20])
+    np.testing.assert_array_equal(tracts["censored"], [0, 0, 1, 0, 1])
+
+    # A: 1 complete tract in 0.5 Morgan, B: 2 in 0.5 Morgan, both at m = 0.5
+    g = admixture_time(tracts)
+    assert g.dims == ("ancestry",)
+    np.testing.assert_allclose(g, [1 / 0.5 / 0.5, 2 / 0.5 / 0.5])
+
+    ds["locanc"][3, 0, 1] = np.nan
+    with pytest.raises(ValueError, match="marker index 3"):
+        ancestry_tracts(ds, chunk_size=2)
+
+
+def test_ancestry_sharing(tmp_path):
+    from latool.io import read_rfmix_msp
+
+    ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    weight = (ds["right_position"] - ds["left_position"]).values
+    x = ds["locanc"].values.mean(axis=2)
+    expected = np.einsum("m,mia,mja->ij", weight / weight.sum(), x, x)
+
+    sharing = ancestry_sharing(ds, out=tmp_path / "sharing.npy", tile_size=8)
+    np.testing.assert_allclose(sharing.values, expected, rtol=1e-6)
+    np.testing.assert_allclose(np.load(tmp_path / "sharing.npy"), expected, rtol=1e-6)
+
+    # markers are read once if all samples fit, else once per pair of 3 bands
+    for max_memory, n_pass in [(10**6, 1), (20000, 6)]:
+        events = []
+        with instrument.instrument(events.append):
+            sharing = ancestry_sharing(ds, max_memory=max_memory)
+        rows = sum(e.rows for e in events if e.kind == "end")
+        assert rows == n_pass * ds.sizes["marker"]
+        np.testing.assert_allclose(sharing.values, expected, rtol=1e-6)
+
+
+def test_ancestry_index(tmp_path):
+    rng = np.random.default_rng(0)
+    M, N = 40, 6
+    x = rng.random((M, N, 2, 3)).astype(np.float32)
+    x /= x.sum(axis=-1, keepdims=True)
+    chrom = np.repeat(["1", "2"], M // 2)
+    # markers with gaps between them on each chromosome
+    left = np.tile(np.cumsum(rng.integers(5, 20, M // 2)), 2).astype(float)
+    right = left + rng.integers(1, 5, M)
+    ds = xr.Dataset(
+        data_vars={
+            "locanc": (["marker", "sample", "ploidy", "ancestry"], x),
+            "left_position": ("marker", left),
+            "right_position": ("marker", right),
+        },
+        coords={"marker": left, "chrom": ("marker", chrom)},
+    )
+
+    def expected(c, start, end):
+        on_c = chrom == c
+        overlap = np.clip(
+            np.minimum(end[:, None], right[on_c])
+            - np.maximum(start[:, None], left[on_c]),
+            0,
+            None,
+        )
+        x_c = x[on_c].mean(axis=2, dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            return (
+                np.einsum("wm,mna->wna", overlap, x_c)
+                / overlap.sum(axis=1)[:, None, None]
+            )
+
+    index = AncestryIndex.build(ds, path=str(tmp_path / "index"), chunk_size=7)
+    assert index.chroms == ["1", "2"]
+    start = rng.uniform(0, left[M // 2 - 1], 50)
+    end = start + rng.uniform(5, 100, 50)
+    for loaded in [index, AncestryIndex.load(str(tmp_path / "index"))]:
+        da = loaded.windows("chr2", start, end)
+        assert da.dims == ("window", "sample", "ancestry")
+        np.testing.assert_allclose(da.values, expected("2", start, end))
+        np.testing.assert_allclose(
+            loaded.windows(2, start, end, cohort=True).values,
+            expected("2", start, end).mean(axis=1),
+        )
+    assert isinstance(AncestryIndex.load(str(tmp_path / "index")).cumsum, np.memmap)
+
+    # windows without markers
+    assert np.isnan(index.windows("1", -10, -5).values).all()
+
+    scan = index.scan(50, step=25)
+    for c in ["1", "2"]:
+        on_c = scan["chrom"].values == c
+        np.testing.assert_allclose(
+            scan.values[on_c],
+            expected(c, scan["start"].values[on_c], scan["end"].values[on_c]),
+        )
+    assert scan["start"].values[0] == left[0]
+    with pytest.raises(KeyError):
+        index.windows("3", 0, 10)
+
+    # missing posteriors would propagate to the sums of all later markers
+    ds["locanc"][25, 3, 1] = np.nan
+    with pytest.raises(ValueError, match="marker index 25"):
+        AncestryIndex.build(ds, chunk_size=7)
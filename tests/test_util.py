@@ -0,0 +1,29 @@
+import numpy as np
+
+from latool.io import read_rfmix_msp
+from latool.util import fill_pos, simplify
+
+
+def test_simplify_chunked():
+    ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    ds["locanc"][2] = ds["locanc"][1]
+    ds["locanc"][3] = ds["locanc"][1]
+
+    ds_simplified = simplify(ds.chunk({"marker": 2}), chunk_size=2)
+    np.testing.assert_array_equal(ds_simplified["marker"], [827, 3308, 6157])
+    np.testing.assert_array_equal(ds_simplified["left_position"], [1, 1653, 5553])
+    np.testing.assert_array_equal(ds_simplified["right_position"], [1653, 5553, 6762])
+    np.testing.assert_array_equal(ds_simplified["locanc"], ds["locanc"][[0, 1, 4]])
+
+
+def test_fill_pos():
+    ds = read_rfmix_msp("tests/testdata/example.msp.tsv")
+    positions = [0, 1652, 1653, 5000, 9000]
+
+    ds_filled = fill_pos(ds, positions, chunk_size=2)
+    np.testing.assert_array_equal(ds_filled["marker"], positions)
+    np.testing.assert_array_equal(ds_filled["locanc"][1:4], ds["locanc"][[0, 1, 2]])
+    assert np.isnan(ds_filled["locanc"][[0, 4]]).all()
+
+    ds_nearest = fill_pos(ds, positions, policy="nearest")
+    np.testing.assert_array_equal(ds_nearest["locanc"][[0, 4]], ds["locanc"][[0, 4]])